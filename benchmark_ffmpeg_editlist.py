@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+"""Benchmark ffmpeg-editlist on synthetic long-form inputs
+
+This generates an input video with ffmpeg's lavfi sources (testsrc and
+sine), a matching .srt file, and an editlist with many outputs and
+segments, then times planning, copy-mode cutting, re-encoding, concat,
+subtitle slicing, and finalization (using the --trace timing spans).
+The results are written as JSON, and can be compared to an earlier
+run (e.g. of another version) with --compare.
+
+Example: python benchmark_ffmpeg_editlist.py --scale large -o results.json
+"""
+
+import argparse
+import json
+import os
+from pathlib import Path
+import platform
+import subprocess
+import sys
+import time
+
+import ffmpeg_editlist
+from ffmpeg_editlist import humantime
+
+
+# Input duration (s), segments, outputs, subtitle cues
+SCALES = {
+    'tiny':  dict(duration=20, segments=4, outputs=2, cues=20),
+    'small': dict(duration=600, segments=20, outputs=5, cues=500),
+    'large': dict(duration=3*3600, segments=200, outputs=50, cues=5000),
+    }
+MODES = {
+    'plan': ['--dry-run'],
+    'copy': [ ],
+    'reencode': ['--reencode'],
+    }
+
+
+def generate_input(filename, duration, size='640x360'):
+    """Synthetic test video with audio, with a keyframe every 10 s."""
+    cmd = ['ffmpeg', '-loglevel', 'error', '-y',
+           '-f', 'lavfi', '-i', f'testsrc=size={size}:rate=30:duration={duration}',
+           '-f', 'lavfi', '-i', f'sine=frequency=440:duration={duration}',
+           '-c:v', 'libx264', '-preset', 'ultrafast', '-g', '300',
+           '-c:a', 'aac',
+           filename]
+    subprocess.run(cmd, check=True, stdin=subprocess.DEVNULL)
+
+
+def srt_time(t):
+    sec, ms = divmod(round(t * 1000), 1000)
+    return '%02d:%02d:%02d,%03d' % (sec // 3600, sec % 3600 // 60, sec % 60, ms)
+
+
+def generate_srt(filename, duration, cues):
+    """Evenly spaced subtitle cues, each shown for 80% of its slot."""
+    step = duration / cues
+    with open(filename, 'w') as f:
+        for i in range(cues):
+            f.write(f'{i+1}\n{srt_time(i*step)} --> {srt_time((i+0.8)*step)}\nCue number {i+1}\n\n')
+
+
+def generate_editlist(input, duration, segments, outputs):
+    """Editlist YAML: the input is split evenly between the outputs, and
+    each output has segments//outputs segments with a TOC entry each,
+    and a cover in its first segment."""
+    per_output = max(segments // outputs, 1)
+    slot = duration / outputs / per_output
+    lines = [f'- input: {input}']
+    for o in range(outputs):
+        lines.append(f'- output: out-{o:03d}.mkv')
+        lines.append(f'  title: Output {o}')
+        lines.append(f'  description: Synthetic benchmark output {o}')
+        lines.append('  editlist:')
+        for s in range(per_output):
+            start = (o*per_output + s) * slot
+            stop = start + 0.8*slot
+            lines.append(f'    - start: {humantime(start)}')
+            lines.append(f'    - {humantime(start + 1)}: Part {s}')
+            if s == 0:
+                lines.append(f'    - cover: {{begin: "{humantime(start + 1)}", end: "{humantime(start + 2)}"}}')
+            lines.append(f'    - stop: {humantime(stop)}')
+    return '\n'.join(lines) + '\n'
+
+
+def run_mode(mode, workdir, editlist, extra_args):
+    """Run ffmpeg-editlist in one mode, return wall time and stage totals."""
+    outdir = workdir / f'out-{mode}'
+    trace = workdir / f'trace-{mode}.json'
+    argv = [str(editlist), str(workdir), '-o', str(outdir), '--rebuild', '--force',
+            '--quiet', '--srt', '--trace', str(trace),
+            *MODES[mode], *extra_args]
+    t0 = time.perf_counter()
+    ffmpeg_editlist.main(argv)
+    wall = time.perf_counter() - t0
+    stages = { }
+    for event in json.load(open(trace))['traceEvents']:
+        name = f"{event['cat']}:{event['name']}"
+        stages[name] = stages.get(name, 0) + event['dur'] / 1e6
+    return {'wall': wall, 'stages': stages}
+
+
+def compare(old, new):
+    """Print a table of old vs new times."""
+    print(f"{'':<28} {'old s':>10} {'new s':>10} {'new/old':>8}")
+    for mode in new['results']:
+        if mode not in old['results']:
+            continue
+        rows = [('wall', old['results'][mode]['wall'], new['results'][mode]['wall'])]
+        for stage, t in sorted(new['results'][mode]['stages'].items()):
+            if stage in old['results'][mode]['stages']:
+                rows.append((stage, old['results'][mode]['stages'][stage], t))
+        print(f"{mode}:")
+        for name, t_old, t_new in rows:
+            ratio = t_new / t_old if t_old else float('nan')
+            print(f"  {name:<26} {t_old:>10.3f} {t_new:>10.3f} {ratio:>8.2f}")
+
+
+def main(argv=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scale', default='small', choices=list(SCALES),
+                        help='Size of the synthetic inputs, default small.')
+    parser.add_argument('--duration', type=float, help='Input duration in seconds (overrides --scale).')
+    parser.add_argument('--segments', type=int, help='Total number of segments (overrides --scale).')
+    parser.add_argument('--outputs', type=int, help='Number of outputs (overrides --scale).')
+    parser.add_argument('--cues', type=int, help='Number of subtitle cues (overrides --scale).')
+    parser.add_argument('--modes', default=','.join(MODES),
+                        help=f'Comma separated modes to run, default {",".join(MODES)}.')
+    parser.add_argument('--workdir', type=Path, default=Path('benchmark-work'),
+                        help='Where the synthetic inputs and outputs go.  Inputs are re-used '
+                             'between runs with the same parameters.  Default ./benchmark-work/.')
+    parser.add_argument('--output', '-o', type=Path, help='Write the results as JSON here.')
+    parser.add_argument('--compare', type=Path, help='Compare with the results of an earlier run.')
+    parser.add_argument('extra', nargs='*',
+                        help='Extra ffmpeg-editlist options (after --), e.g. -- --jobs 4 --preset ultrafast')
+    args = parser.parse_args(argv)
+
+    params = dict(SCALES[args.scale])
+    for name in params:
+        if getattr(args, name) is not None:
+            params[name] = getattr(args, name)
+    modes = args.modes.split(',')
+
+    workdir = args.workdir
+    os.makedirs(workdir, exist_ok=True)
+    input = f"synthetic-{params['duration']:g}s.mkv"
+    t0 = time.perf_counter()
+    if not (workdir/input).exists():
+        print(f"Generating {humantime(params['duration'])} of synthetic video...", file=sys.stderr)
+        generate_input(workdir/input, params['duration'])
+    generate_time = time.perf_counter() - t0
+    generate_srt(workdir/(os.path.splitext(input)[0]+'.srt'), params['duration'], params['cues'])
+    editlist = workdir / 'editlist.yaml'
+    editlist.write_text(generate_editlist(input, params['duration'], params['segments'], params['outputs']))
+
+    results = {
+        'version': ffmpeg_editlist.__version__,
+        'python': platform.python_version(),
+        'ffmpeg': subprocess.run(['ffmpeg', '-version'], capture_output=True, text=True).stdout.split('\n')[0],
+        'params': params,
+        'extra_args': args.extra,
+        'generate_input': generate_time,
+        'results': { },
+        }
+    for mode in modes:
+        print(f"Running {mode}...", file=sys.stderr)
+        results['results'][mode] = run_mode(mode, workdir, editlist, args.extra)
+        print(f"  {results['results'][mode]['wall']:.2f} s", file=sys.stderr)
+
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=1))
+    if args.compare:
+        compare(json.load(open(args.compare)), results)
+    elif not args.output:
+        print(json.dumps(results, indent=1))
+
+
+if __name__ == '__main__':
+    main()
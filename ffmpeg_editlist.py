@@ -6,12 +6,20 @@
 __version__ = '0.5.5'
 
 import argparse
+import array
+import asyncio
 import bisect
+import collections
+import concurrent.futures
 import contextlib
 import copy
+import dataclasses
 import datetime
 from datetime import timedelta
+import functools
+import hashlib
 import itertools
+import json
 import logging
 from math import floor
 import os
@@ -22,11 +30,13 @@ import shutil
 import subprocess
 import sys
 import tempfile
+import threading
+import time
+import uuid
 
 import yaml
 
 LOG = logging.getLogger(__name__)
-logging.basicConfig(level=logging.DEBUG)
 
 usage = """\
 
@@ -77,7 +87,6 @@ template_workshop = """\
 """
 
 FFMPEG_VIDEO_COPY = ['-vcodec', 'copy',]
-FFMPEG_VIDEO_ENCODE = ['-c:v', 'libx264', ] #'-preset', 'slow', '-crf', '22'
 FFMPEG_AUDIO_COPY = ['-acodec', 'copy',]
 FFMPEG_AUDIO_ENCODE = ['-acodec', 'aac', '-b:a', '160k', ]
 # x is horizontal, y is vertical, from top left
@@ -86,6 +95,51 @@ FFMPEG_COVER = \
 # Only used for images
 FFMPEG_FRAMERATE = 30
 
+# Video encoders for --encoder: ffmpeg codec (and the codec_name
+# ffprobe reports for its output), default preset, and the offset
+# added to --crf (the crf scales differ, these give roughly the same
+# quality as x264 at that --crf) and its maximum, any extra options,
+# and the pixel formats it can encode as they are.
+ENCODERS = {
+    'x264':   {'codec': 'libx264',   'codec_name': 'h264', 'preset': 'veryslow',
+               'crf_offset': 0,  'crf_max': 51,
+               'pix_fmts': ['yuv420p', 'yuvj420p', 'yuv422p', 'yuvj422p', 'yuv444p', 'yuvj444p']},
+    'x265':   {'codec': 'libx265',   'codec_name': 'hevc', 'preset': 'slow',
+               'crf_offset': 4,  'crf_max': 51, 'options': ['-x265-params', 'log-level=warning'],
+               'pix_fmts': ['yuv420p', 'yuvj420p', 'yuv422p', 'yuv444p',
+                            'yuv420p10le', 'yuv422p10le', 'yuv444p10le']},
+    'svtav1': {'codec': 'libsvtav1', 'codec_name': 'av1',  'preset': '6',
+               'crf_offset': 12, 'crf_max': 63, 'pix_fmts': ['yuv420p', 'yuv420p10le']},
+    }
+# Audio encoders for making segments' audio match the other segments
+# (ffprobe codec_name: ffmpeg encoder), aac for anything else.
+AUDIO_ENCODERS = {'aac': 'aac', 'mp3': 'libmp3lame', 'opus': 'libopus', 'vorbis': 'libvorbis',
+                  'flac': 'flac', 'ac3': 'ac3'}
+# x264 -profile:v for the H.264 profiles ffprobe reports.
+X264_PROFILES = {'Baseline': 'baseline', 'Constrained Baseline': 'baseline', 'Main': 'main',
+                 'High': 'high', 'High 10': 'high10', 'High 4:2:2': 'high422',
+                 'High 4:4:4 Predictive': 'high444'}
+# Encoder/presets tried by --calibrate, fastest first.
+CALIBRATION_PROFILES = [
+    ('x264', 'ultrafast'), ('x264', 'veryfast'), ('x264', 'medium'),
+    ('x264', 'slow'), ('x264', 'veryslow'),
+    ('x265', 'fast'), ('x265', 'medium'), ('x265', 'slow'),
+    ('svtav1', '10'), ('svtav1', '8'), ('svtav1', '6'),
+    ]
+
+class EditlistError(Exception):
+    """A problem with the editlist or its processing.
+
+    errors is the list of messages (there can be many, e.g. all
+    segment time problems are reported at once).
+    """
+    def __init__(self, errors):
+        if isinstance(errors, str):
+            errors = [errors]
+        self.errors = list(errors)
+        super().__init__('\n'.join(self.errors))
+
+
 def generate_cover(begin, end, w=10000, h=10000, x=0, y=0):
     begin = seconds(begin)
     end = seconds(end)
@@ -94,6 +148,36 @@ def generate_cover(begin, end, w=10000, h=10000, x=0, y=0):
 def generate_crop(w, h, x, y):
     return ['-filter:v', f"crop={w}:{h}:{x}:{y}"]
 
+# Where the camera goes on the screen, for layout:
+LAYOUT_POSITIONS = {
+    'top-right': 'W-w:0', 'top-left': '0:0',
+    'bottom-right': 'W-w:H-h', 'bottom-left': '0:H-h',
+    }
+def generate_layout(screen, camera=None, position='top-right', label=''):
+    """Filter for a screen share recording (e.g. Zoom) with the speaker's camera.
+
+    The screen and camera rectangles (dicts of w, h, x, y) are cropped
+    out of the frame and the camera is overlaid on the screen at
+    position (a LAYOUT_POSITIONS name or an ffmpeg overlay "x:y").  The
+    filter can be joined with others by ",".  label makes its link
+    labels unique, if there are several in one filtergraph.
+    """
+    crop_screen = "crop={w}:{h}:{x}:{y}".format(**screen)
+    if not camera:
+        return crop_screen
+    crop_camera = "crop={w}:{h}:{x}:{y}".format(**camera)
+    position = LAYOUT_POSITIONS.get(position, position)
+    s, c = f'layout{label}s', f'layout{label}c'
+    return (f'split[{s}][{c}];[{s}]{crop_screen}[{s}1];[{c}]{crop_camera}[{c}1];'
+            f'[{s}1][{c}1]overlay={position}')
+def test_generate_layout():
+    screen = dict(w=2230, h=1250, x=6, y=176)
+    assert generate_layout(screen) == 'crop=2230:1250:6:176'
+    layout = generate_layout(screen, dict(w=320, h=164, x=2240, y=710), label=3)
+    assert layout == ('split[layout3s][layout3c];[layout3s]crop=2230:1250:6:176[layout3s1];'
+                      '[layout3c]crop=320:164:2240:710[layout3c1];[layout3s1][layout3c1]overlay=W-w:0')
+    assert generate_layout(screen, dict(w=1, h=1, x=0, y=0), position='10:20').endswith('overlay=10:20')
+
 
 def is_time(x):
     m = re.match(r'((\d{1,2}:)?\d{1,2}:)?\d{1,2}(\.\d*)?$', x)
@@ -144,34 +228,441 @@ def test_humantime():
     assert humantime(7350) == "2:02:30"
     assert humantime(43950) == "12:12:30"
 
-def map_time(seg_n, lookup_table, time):
-    """Map a time from source time to output time
+class TimeMappingError(ValueError):
+    """A time (TOC entry, cover) that isn't inside any segment of the output."""
+    def __init__(self, time, segment_number, what=None):
+        self.time = time
+        self.segment_number = segment_number
+        self.what = what
+        super().__init__(f"{what+' ' if what else ''}at {humantime(time)} (={time}s) "
+                         f"is not inside segment {segment_number}")
+
+class TimeMap:
+    """Map between source (input) and output times of one output.
+
+    Built once from an output's segment_list: pairs of
+    [segment_number, start, output_start] and [segment_number, stop,
+    None] entries, in order.  A source time is given with the number of
+    the segment it belongs to, and must be within [start, stop) of
+    that segment.  Lookups are bisections, so mapping all TOC entries
+    and covers of an output is O(k log n).
     """
-    time_lookup_vals = [(x[0], x[1]) for x in lookup_table]
-    i = bisect.bisect_right(time_lookup_vals, (seg_n, time))
-    #print(f"lookup of {seg_n},{time} found at i={i}")
-    if lookup_table[i-1][1] is None:
-        #LOG.error("%s", lookup_table)
-        #LOG.error("%s", time)
-        LOG.error("Bad time lookup (type 1) for %s(=%ss)", humantime(time), time)
-        sys.exit(1)
-    if lookup_table[i-1][2] is None:
-        #LOG.error("%s", lookup_table)
-        #LOG.error("%s", time)
-        LOG.error("Bad time lookup (type 2) for %s(=%ss)", humantime(time), time)
-        sys.exit(1)
-    return time - lookup_table[i-1][1] + lookup_table[i-1][2]
+    def __init__(self, segment_list):
+        starts = segment_list[0::2]
+        stops = segment_list[1::2]
+        self.keys = [(n, start) for n, start, _ in starts]
+        self.stop_keys = [(n, stop) for n, stop, _ in stops]
+        self.out_starts = array.array('d', [out_start for _, _, out_start in starts])
+        self.out_stops = array.array('d', [out_start + stop - start for (_, start, out_start), (_, stop, _)
+                                           in zip(starts, stops)])
+    def to_output(self, segment_number, time, what=None, end=False):
+        """Output time of time in segment segment_number.
+
+        Raises TimeMappingError if it isn't inside that segment.  With
+        end (the end of a range, e.g. of a cover), the time must be in
+        (start, stop] instead.
+        """
+        key = (segment_number, time)
+        if end:
+            i = bisect.bisect_left(self.keys, key) - 1
+            inside = i >= 0 and key <= self.stop_keys[i]
+        else:
+            i = bisect.bisect_right(self.keys, key) - 1
+            inside = i >= 0 and key < self.stop_keys[i]
+        if not inside:
+            raise TimeMappingError(time, segment_number, what)
+        return time - self.keys[i][1] + self.out_starts[i]
+    def to_output_many(self, segment_numbers, times):
+        """to_output() of each (segment_number, time) pair."""
+        return [self.to_output(n, t) for n, t in zip(segment_numbers, times)]
+    def to_source(self, time):
+        """(segment_number, source time) of an output time."""
+        i = bisect.bisect_right(self.out_starts, time) - 1
+        if i < 0 or time >= self.out_stops[i]:
+            raise TimeMappingError(time, None, 'output time')
+        n, start = self.keys[i]
+        return n, time - self.out_starts[i] + start
+    def to_source_many(self, times):
+        """to_source() of each output time."""
+        return [self.to_source(t) for t in times]
+def test_time_map():
+    # Segment 1: 10-20 -> 0-10, segment 2: 50-55 -> 10-15
+    tmap = TimeMap([[1, 10, 0], [1, 20, None], [2, 50, 10], [2, 55, None]])
+    assert tmap.to_output(1, 10) == 0
+    assert tmap.to_output(1, 15) == 5
+    assert tmap.to_output(2, 52) == 12
+    assert tmap.to_output_many([1, 2], [19, 50]) == [9, 10]
+    for n, t in [(1, 5), (1, 20), (1, 30), (2, 40), (2, 55), (0, 15), (3, 1)]:
+        try:
+            tmap.to_output(n, t)
+        except TimeMappingError as exc:
+            assert exc.segment_number == n and exc.time == t
+        else:
+            assert False, (n, t)
+    assert tmap.to_output(1, 20, end=True) == 10
+    for n, t in [(1, 10), (1, 21), (2, 50)]:
+        try:
+            tmap.to_output(n, t, end=True)
+        except TimeMappingError:
+            pass
+        else:
+            assert False, (n, t)
+    assert tmap.to_source(5) == (1, 15)
+    assert tmap.to_source_many([0, 12]) == [(1, 10), (2, 52)]
+    for t in [-1, 15, 20]:
+        try:
+            tmap.to_source(t)
+        except TimeMappingError:
+            pass
+        else:
+            assert False, t
+
+def probe_keyframes(filename):
+    """Return the sorted keyframe times of the first video stream.
+
+    Times are in seconds from the start of the file (as used by -ss).
+    This reads the packet index with ffprobe, no decoding is done.
+    """
+    cmd = ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+           '-show_entries', 'format=start_time:packet=pts_time,flags',
+           '-of', 'compact', str(filename)]
+    ret = subprocess.run(cmd, capture_output=True, check=True, text=True)
+    keyframes = [ ]
+    start_time = 0
+    for line in ret.stdout.splitlines():
+        section, *fields = line.split('|')
+        fields = dict(x.split('=', 1) for x in fields)
+        if section == 'format' and fields.get('start_time', 'N/A') != 'N/A':
+            start_time = float(fields['start_time'])
+        elif section == 'packet' and 'K' in fields.get('flags', '') \
+                and fields.get('pts_time', 'N/A') != 'N/A':
+            keyframes.append(float(fields['pts_time']))
+    return sorted(x - start_time for x in keyframes)
+
+def probe_metadata(filename):
+    """Return (title, chapters, attachment names) of an (mkv) file.
+
+    chapters is [(start second, name), ...], with the start rounded to
+    whole seconds like the chapters we write.
+    """
+    cmd = ['ffprobe', '-v', 'error', '-show_format', '-show_chapters', '-show_streams',
+           '-of', 'json', str(filename)]
+    info = json.loads(subprocess.run(cmd, capture_output=True, check=True, text=True).stdout)
+    def tags(x):
+        return {k.lower(): v for k, v in x.get('tags', {}).items()}
+    title = tags(info.get('format', {})).get('title')
+    chapters = [(round(float(c['start_time'])), tags(c).get('title'))
+                for c in info.get('chapters', [])]
+    attachments = [tags(x).get('filename') for x in info.get('streams', [])
+                   if x.get('codec_type') == 'attachment']
+    return title, chapters, attachments
+
+def smart_cut_parts(keyframes, start, stop):
+    """Split start-stop into (start, stop, reencode) parts for smart cutting.
+
+    Only the part before the first keyframe in the range and after the
+    last one need re-encoding, the middle can be stream-copied.
+    """
+    i = bisect.bisect_left(keyframes, start)
+    j = bisect.bisect_right(keyframes, stop) - 1
+    if i >= len(keyframes) or j < 0 or keyframes[i] >= keyframes[j]:
+        return [(start, stop, True)]
+    k1, k2 = keyframes[i], keyframes[j]
+    parts = [ ]
+    if k1 > start:
+        parts.append((start, k1, True))
+    parts.append((k1, k2, False))
+    if stop > k2:
+        parts.append((k2, stop, True))
+    return parts
+def test_smart_cut_parts():
+    keyframes = [0, 2, 4, 6, 8]
+    assert smart_cut_parts(keyframes, 1, 7) == [(1, 2, True), (2, 6, False), (6, 7, True)]
+    assert smart_cut_parts(keyframes, 2, 6) == [(2, 6, False)]
+    assert smart_cut_parts(keyframes, 2.5, 3.5) == [(2.5, 3.5, True)]
+    assert smart_cut_parts(keyframes, 3, 5) == [(3, 5, True)]
+    assert smart_cut_parts([], 3, 5) == [(3, 5, True)]
+
+def splice_options(info, video_encode):
+    """Encoder options for parts that are joined to stream-copied parts.
+
+    Smart cut and covers re-encode only parts of a segment, which are
+    then concatenated with parts stream-copied from the input.  That
+    only decodes if the encoder makes the same codec, profile and pixel
+    format as the input (frame size and rate aren't changed in the
+    parts, and all parts are Matroska, with the same timebase).  info
+    is ffprobe output (MediaProbe.info()).  Returns the options to add
+    to video_encode for that, or raises ValueError saying why it can't.
+    """
+    video, _ = stream_params(info)
+    if video is None:
+        raise ValueError("no video stream")
+    codec = video_encode[video_encode.index('-c:v')+1]
+    enc = next((enc for enc in ENCODERS.values() if enc['codec'] == codec), None)
+    if enc is None or enc['codec_name'] != video['codec_name']:
+        raise ValueError(f"the input is {video['codec_name']}, but the encoder is {codec}")
+    if video['pix_fmt'] not in enc['pix_fmts']:
+        raise ValueError(f"{codec} can't encode the input's pixel format {video['pix_fmt']}")
+    options = ['-pix_fmt', video['pix_fmt']]
+    if video['codec_name'] == 'h264':
+        if video['profile'] not in X264_PROFILES:
+            raise ValueError(f"{codec} can't encode the input's profile {video['profile']}")
+        options.extend(['-profile:v', X264_PROFILES[video['profile']]])
+    return options
+def test_splice_options():
+    video = {'codec_type': 'video', 'codec_name': 'h264', 'profile': 'Main', 'width': 840, 'height': 1080,
+             'pix_fmt': 'yuv420p', 'r_frame_rate': '30/1'}
+    x264 = video_encode_options('x264')
+    assert splice_options({'streams': [video]}, x264) == ['-pix_fmt', 'yuv420p', '-profile:v', 'main']
+    for encoder, streams in [('x265', [video]), ('x264', [dict(video, codec_name='hevc')]),
+                             ('x264', [dict(video, pix_fmt='yuv420p10le')]),
+                             ('x264', [dict(video, profile='High 4:4:4 Intra')]), ('x264', [])]:
+        try:
+            splice_options({'streams': streams}, video_encode_options(encoder))
+        except ValueError:
+            pass
+        else:
+            assert False, (encoder, streams)
+    assert splice_options({'streams': [dict(video, codec_name='hevc', profile='Main 10', pix_fmt='yuv420p10le')]},
+                          video_encode_options('x265')) == ['-pix_fmt', 'yuv420p10le']
+
+def cover_parts(keyframes, start, stop, covers, reencode_ends=False):
+    """Split start-stop into (start, stop, reencode) parts for covers.
+
+    covers are the (begin, end) input times of the covers.  Only the
+    GOPs that overlap them are re-encoded: each cover is widened to
+    the keyframes around it (or the segment start/stop), overlapping
+    windows are merged, and the parts between them are stream-copied.
+    With reencode_ends (--smart-cut), the start and end of the segment
+    up to the keyframes are re-encoded too, as in smart_cut_parts().
+    """
+    windows = [ ]
+    for begin, end in covers:
+        begin, end = max(begin, start), min(end, stop)
+        if begin >= end:
+            continue
+        i = bisect.bisect_right(keyframes, begin) - 1
+        j = bisect.bisect_left(keyframes, end)
+        windows.append((keyframes[i] if i >= 0 and keyframes[i] > start else start,
+                        keyframes[j] if j < len(keyframes) and keyframes[j] < stop else stop))
+    if reencode_ends:
+        windows.extend((a, b) for a, b, reencode in smart_cut_parts(keyframes, start, stop) if reencode)
+    merged = [ ]
+    for a, b in sorted(windows):
+        if merged and a <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], b)
+        else:
+            merged.append([a, b])
+    parts = [ ]
+    pos = start
+    for a, b in merged:
+        if a > pos:
+            parts.append((pos, a, False))
+        parts.append((a, b, True))
+        pos = b
+    if pos < stop:
+        parts.append((pos, stop, False))
+    return parts
+def test_cover_parts():
+    keyframes = [0, 10, 20, 30, 40]
+    assert cover_parts(keyframes, 5, 45, [(12, 15)]) == [(5, 10, False), (10, 20, True), (20, 45, False)]
+    # Overlapping and adjacent covers are merged
+    assert cover_parts(keyframes, 5, 45, [(12, 15), (14, 22), (35, 36)]) == \
+        [(5, 10, False), (10, 40, True), (40, 45, False)]
+    assert cover_parts(keyframes, 5, 45, [(12, 15), (32, 36)]) == \
+        [(5, 10, False), (10, 20, True), (20, 30, False), (30, 40, True), (40, 45, False)]
+    # Covers at the edges, or outside of the segment
+    assert cover_parts(keyframes, 5, 45, [(0, 6), (50, 60)]) == [(5, 10, True), (10, 45, False)]
+    assert cover_parts(keyframes, 5, 45, [(41, 50)]) == [(5, 40, False), (40, 45, True)]
+    assert cover_parts([], 5, 45, [(12, 15)]) == [(5, 45, True)]
+    # --smart-cut: the ends too
+    assert cover_parts(keyframes, 5, 45, [(22, 25)], reencode_ends=True) == \
+        [(5, 10, True), (10, 20, False), (20, 30, True), (30, 40, False), (40, 45, True)]
+
+def chunk_bounds(keyframes, start, stop, chunk_seconds):
+    """Split start-stop into [(start, stop), ...] chunks of about chunk_seconds.
+
+    Boundaries are moved to a keyframe if there is one within a
+    quarter chunk, so that seeking to them doesn't need to decode
+    anything before.  The last chunk is at least half a chunk long.
+    """
+    bounds = [start]
+    target = start + chunk_seconds
+    while target < stop - chunk_seconds/2:
+        bound = target
+        i = bisect.bisect_left(keyframes, target)
+        near = [k for k in keyframes[max(i-1, 0):i+1]
+                if abs(k - target) <= chunk_seconds/4 and bounds[-1] < k < stop]
+        if near:
+            bound = min(near, key=lambda k: abs(k - target))
+        bounds.append(bound)
+        target = bound + chunk_seconds
+    bounds.append(stop)
+    return list(zip(bounds[:-1], bounds[1:]))
+def test_chunk_bounds():
+    assert chunk_bounds([], 0, 25, 10) == [(0, 10), (10, 25)]
+    assert chunk_bounds([], 5, 40, 10) == [(5, 15), (15, 25), (25, 40)]
+    assert chunk_bounds([0, 9, 21, 33], 0, 40, 10) == [(0, 9), (9, 21), (21, 33), (33, 40)]
+    assert chunk_bounds([0, 14], 0, 25, 10) == [(0, 10), (10, 25)]
+    assert chunk_bounds([], 0, 8, 10) == [(0, 8)]
+
+
+def chunk_segment(seg, keyframes, chunk_seconds, loglevel, video_encode):
+    """Chunks (SegmentPlans) to encode a re-encoded video segment in parallel.
+
+    Each video chunk seeks to its start (a keyframe, if possible) and
+    encodes only the video.  Covers are given in input time, so it is
+    restored for the filters, like in single_pass_command().  The
+    audio of the whole segment is copied separately, and the chunks
+    and audio are joined in finalize_output().
+    """
+    chunks = [ ]
+    for k, (start, stop) in enumerate(chunk_bounds(keyframes, seg.start, seg.stop, chunk_seconds)):
+        vfilters = [ ]
+        if seg.filters:
+            vfilters = ['-vf', ','.join([f'setpts=PTS-STARTPTS+{start}/TB',
+                                         *seg.filters,
+                                         'setpts=PTS-STARTPTS'])]
+        chunks.append(SegmentPlan(
+            number=seg.number, type='video-chunk', input=seg.input,
+            start=start, stop=stop,
+            output_start=seg.output_start + start - seg.start,
+            cmd=['ffmpeg', '-loglevel', str(loglevel),
+                 '-ss', str(start), '-i', seg.input, '-t', str(stop - start),
+                 '-map', '0:v:0', *vfilters, *video_encode],
+            filename=f'{os.path.splitext(seg.filename)[0]}-c{k:03d}.mkv',
+            ))
+    chunks.append(SegmentPlan(
+        number=seg.number, type='audio', input=seg.input,
+        start=seg.start, stop=seg.stop, output_start=seg.output_start,
+        cmd=['ffmpeg', '-loglevel', str(loglevel),
+             '-i', seg.input, '-ss', str(seg.start), '-to', str(seg.stop),
+             '-vn', *FFMPEG_AUDIO_COPY],
+        filename=f'{os.path.splitext(seg.filename)[0]}-audio.mka',
+        ))
+    return chunks
+
+
+def default_cache_dir():
+    """Per-user cache directory (XDG_CACHE_HOME/ffmpeg-editlist)."""
+    base = os.environ.get('XDG_CACHE_HOME') or Path.home()/'.cache'
+    return Path(base) / 'ffmpeg-editlist'
+
+class MediaProbe:
+    """ffprobe information about input files, cached on disk.
+
+    Each distinct input is probed at most once: results are kept in
+    memory and as JSON files in cache_dir, keyed by the file's path,
+    size, and mtime, so repeated runs (e.g. --check) don't run ffprobe
+    again unless the file changed.
+    """
+    def __init__(self, cache_dir=None):
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self._data = { }
+        self._lock = threading.Lock()
+    def _entry(self, filename):
+        """(in-memory dict, cache file) for this version of filename."""
+        st = os.stat(filename)
+        ident = repr((os.path.abspath(filename), st.st_size, st.st_mtime_ns))
+        key = hashlib.sha256(ident.encode()).hexdigest()
+        cache_file = self.cache_dir / (key + '.json') if self.cache_dir else None
+        with self._lock:
+            if key not in self._data:
+                data = { }
+                if cache_file and cache_file.exists():
+                    try:
+                        data = json.loads(cache_file.read_text())
+                    except ValueError:
+                        pass
+                self._data[key] = data
+            return self._data[key], cache_file
+    def _get(self, filename, name, func):
+        data, cache_file = self._entry(filename)
+        if name not in data:
+            data[name] = func(filename)
+            if cache_file:
+                os.makedirs(cache_file.parent, exist_ok=True)
+                with atomic_write(cache_file, 'w') as tmp:
+                    open(tmp, 'w').write(json.dumps(data))
+        return data[name]
+    def info(self, filename):
+        """ffprobe's -show_format -show_streams output."""
+        def probe(filename):
+            cmd = ['ffprobe', '-v', 'error', '-show_format', '-show_streams',
+                   '-of', 'json', str(filename)]
+            ret = subprocess.run(cmd, capture_output=True, check=True, text=True)
+            return json.loads(ret.stdout)
+        return self._get(filename, 'info', probe)
+    def duration(self, filename):
+        """Duration in seconds, or None if unknown."""
+        duration = self.info(filename).get('format', {}).get('duration')
+        return float(duration) if duration not in (None, 'N/A') else None
+    def keyframes(self, filename):
+        """See probe_keyframes()."""
+        return self._get(filename, 'keyframes', probe_keyframes)
 
 def ensure_filedir_exists(filename):
     """Ensure a a directory exists, that can hold the file given as argument"""
     dirname = os.path.dirname(filename)
     if dirname == '':
         return
-    if not os.path.isdir(dirname):
-        os.makedirs(dirname)
+    # Another process may be making it at the same time
+    os.makedirs(dirname, exist_ok=True)
 
 @contextlib.contextmanager
-def atomic_write(fname, mode='w+b'):
+def file_lock(path, blocking=True):
+    """Hold an exclusive lock on the file path while in the context.
+
+    The file is created, and contains our pid while locked.  The lock
+    is released by the OS if the process dies, so there are no stale
+    locks.  If not blocking and another process (or thread) has the
+    lock, BlockingIOError is raised.  Without fcntl (Windows), nothing
+    is locked.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    while True:
+        fd = os.open(path, os.O_RDWR|os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BaseException:
+            os.close(fd)
+            raise
+        # The previous holder may have removed the file meanwhile,
+        # then our lock is on a file nobody else will see.
+        try:
+            if os.stat(path).st_ino == os.fstat(fd).st_ino:
+                break
+        except FileNotFoundError:
+            pass
+        os.close(fd)
+    try:
+        os.ftruncate(fd, 0)
+        os.write(fd, f'{os.getpid()}\n'.encode())
+        yield
+    finally:
+        os.unlink(path)
+        os.close(fd)
+
+def temporary_filename(fname, keep_ext=False):
+    """A random temporary filename next to fname.
+
+    With keep_ext, it has the same extension as fname, so that tools
+    like ffmpeg still detect the right format from it.
+    """
+    import string
+    import random
+    randstr = ''.join(random.choice(string.ascii_lowercase) for i in range(20))
+    if keep_ext:
+        root, ext = os.path.splitext(fname)
+        return '.'.join((root, randstr, 'tmp')) + ext
+    return '.'.join((str(fname), randstr, 'tmp'))
+
+@contextlib.contextmanager
+def atomic_write(fname, mode='w+b', keep_ext=False):
     """Atomically write into the given fname.
 
     Returns a NamedTemporaryFile that will be moved (atomically,
@@ -179,11 +670,7 @@ def atomic_write(fname, mode='w+b'):
     """
     if os.access(fname, os.F_OK) and not os.access(fname, os.W_OK, follow_symlinks=False):
         raise PermissionError(fname)
-    root, ext = os.path.splitext(fname)
-    import string
-    import random
-    randstr = ''.join(random.choice(string.ascii_lowercase) for i in range(20))
-    tmp = '.'.join((str(fname), randstr, 'tmp'))
+    tmp = temporary_filename(fname, keep_ext=keep_ext)
     try:
         yield tmp
     except:
@@ -198,6 +685,24 @@ def atomic_write(fname, mode='w+b'):
         except FileNotFoundError:
             pass
 
+# ioctl to make a copy-on-write clone of a file (Linux: btrfs, XFS, ...)
+FICLONE = 0x40049409
+
+def clone_file(src, dst):
+    """Atomically copy src to dst, sharing data blocks when possible.
+
+    A reflink (copy-on-write clone) costs no data writes, if the
+    filesystem can't do it this is a normal copy.  A hardlink is not
+    used, since dst may be edited in place later (mkvpropedit).
+    """
+    with atomic_write(dst) as tmp:
+        try:
+            import fcntl
+            with open(src, 'rb') as src_f, open(tmp, 'wb') as tmp_f:
+                fcntl.ioctl(tmp_f.fileno(), FICLONE, src_f.fileno())
+        except (ImportError, OSError):
+            shutil.copy(src, tmp)
+
 def shell_join(x):
     return ' '.join(shlex.quote(str(_)) for _ in x)
 
@@ -232,11 +737,2062 @@ class SchedulePrinter:
         self._emit()
 
 
+class Profiler:
+    """Timing spans of the stages of a run (--profile, --trace).
 
-def main(argv=sys.argv[1:]):
+    Spans can nest (an encode span contains its ffmpeg command span),
+    and come from several threads with --jobs.  A stage may record the
+    bytes it wrote in the dict given by span().
+    """
+    def __init__(self):
+        self.spans = [ ]
+        self._lock = threading.Lock()
+        self._t0 = time.perf_counter()
+    @contextlib.contextmanager
+    def span(self, name, cat='stage', **info):
+        start = time.perf_counter()
+        try:
+            yield info
+        finally:
+            end = time.perf_counter()
+            with self._lock:
+                self.spans.append((name, cat, start - self._t0, end - start,
+                                   threading.get_ident(), info))
+    def report(self):
+        """Summary table: count, total and mean time, bytes per stage."""
+        stats = { }
+        for name, cat, start, duration, tid, info in self.spans:
+            stat = stats.setdefault((cat, name), [0, 0.0, 0])
+            stat[0] += 1
+            stat[1] += duration
+            stat[2] += info.get('bytes') or 0
+        lines = [f"{'category':<10} {'stage':<16} {'count':>6} {'total s':>10} {'mean s':>9} {'MB written':>11}"]
+        for (cat, name), (count, total, nbytes) in sorted(stats.items(), key=lambda x: -x[1][1]):
+            lines.append(f"{cat:<10} {name:<16} {count:>6} {total:>10.3f} {total/count:>9.3f} {nbytes/1e6:>11.1f}")
+        return '\n'.join(lines)
+    def chrome_trace(self):
+        """The spans in Chrome trace event format (chrome://tracing, Perfetto)."""
+        events = [ ]
+        for name, cat, start, duration, tid, info in self.spans:
+            events.append({'name': name, 'cat': cat, 'ph': 'X',
+                           'ts': round(start*1e6), 'dur': round(duration*1e6),
+                           'pid': os.getpid(), 'tid': tid,
+                           'args': {k: str(v) for k, v in info.items()}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+@contextlib.contextmanager
+def profiling(args):
+    """Profile the stages run in the context, with --profile or --trace.
+
+    At the end (also on errors), the --profile summary is printed to
+    stderr and the --trace file is written.
+    """
+    args.profiler = Profiler() if (args.profile or args.trace) else None
+    try:
+        yield
+    finally:
+        if args.profiler and args.profile:
+            print(args.profiler.report(), file=sys.stderr)
+        if args.profiler and args.trace:
+            with atomic_write(args.trace, 'w') as tmp:
+                open(tmp, 'w').write(json.dumps(args.profiler.chrome_trace()))
+
+def profile_span(args, name, cat='stage', **info):
+    """A Profiler span if profiling is enabled, otherwise a no-op."""
+    profiler = getattr(args, 'profiler', None)
+    if profiler is None:
+        return contextlib.nullcontext(info)
+    return profiler.span(name, cat, **info)
+
+def file_size(filename):
+    """Size of filename, or None if it doesn't exist."""
+    try:
+        return os.path.getsize(filename)
+    except OSError:
+        return None
+
+
+@dataclasses.dataclass
+class SegmentPlan:
+    """One segment of an output: a time range of one input file.
+
+    cmd is the ffmpeg command that makes the segment, except for the
+    output filename, which is filename inside the executor's temporary
+    directory.  start/stop are in seconds of the input, output_start is
+    where the segment begins in the output.  With --chunk-seconds,
+    chunks are SegmentPlans that are encoded instead of cmd (video
+    chunks and the audio), and joined into filename.  shared is set
+    (to its segment_key()) if the same segment is in the run more than
+    once, then it is encoded only once (see mark_shared_segments()).
+    """
+    number: int
+    type: str
+    input: str
+    start: float
+    stop: float
+    output_start: float
+    cmd: list
+    filename: str
+    subtitles: str = None
+    filters: list = dataclasses.field(default_factory=list)
+    chunks: list = None
+    shared: str = None
+
+
+@dataclasses.dataclass
+class OutputPlan:
+    """One output file: its segments and metadata.
+
+    segment_list is the time lookup table for TimeMap.  toc is a
+    list of (output_time, name), covers the output times of the covers,
+    and description the contents of the .info.txt file.  If cmd is
+    set (--single-pass), it makes the whole raw output in one go
+    instead of the separate segment commands.
+    """
+    name: str
+    output: Path
+    output_raw: Path
+    segments: list
+    segment_list: list
+    title: str = None
+    description: str = None
+    toc: list = dataclasses.field(default_factory=list)
+    covers: list = dataclasses.field(default_factory=list)
+    srt_output: Path = None
+    cmd: list = None
+
+
+@dataclasses.dataclass
+class EditPlan:
+    """Everything a run would do, computed without running ffmpeg.
+
+    Made by build_plan() from the editlist and run by execute_plan().
+    It can be saved to and loaded from JSON (see --plan-json).
+    """
+    outputs: list
+    inputs: list
+    errors: list = dataclasses.field(default_factory=list)
+
+    def to_json(self):
+        return json.dumps(dataclasses.asdict(self), default=str, indent=2)
+    @classmethod
+    def from_json(cls, data):
+        data = json.loads(data)
+        outputs = [ ]
+        for out in data['outputs']:
+            for seg in out['segments']:
+                if seg.get('chunks'):
+                    seg['chunks'] = [SegmentPlan(**chunk) for chunk in seg['chunks']]
+            out['segments'] = [SegmentPlan(**seg) for seg in out['segments']]
+            for key in ('output', 'output_raw', 'srt_output'):
+                if out[key] is not None:
+                    out[key] = Path(out[key])
+            outputs.append(OutputPlan(**out))
+        return cls(outputs=outputs, inputs=data['inputs'], errors=data.get('errors', []))
+
+
+def run_command(cmd, args, progress=None):
+    """Run an external command, raising CalledProcessError on failure.
+
+    With --jobs (or --no-stdin), several ffmpegs run at once (or in the
+    background) and must not fight over the terminal, so stdin is
+    detached.  If progress is given (a
+    callback from ProgressReporter.task()), ffmpeg reports its progress
+    on a pipe, which is parsed and passed to it.
+    """
+    stdin = subprocess.DEVNULL if args.jobs > 1 or args.no_stdin else None
+    with profile_span(args, os.path.basename(str(cmd[0])), 'command'):
+        if progress is None or cmd[0] != 'ffmpeg':
+            subprocess.check_call(cmd, stdin=stdin)
+            return
+        cmd = [cmd[0], '-progress', 'pipe:1', '-nostats', *cmd[1:]]
+        with subprocess.Popen(cmd, stdin=stdin, stdout=subprocess.PIPE, text=True) as proc:
+            for report in parse_progress(proc.stdout):
+                progress(**report)
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+
+def parse_progress(lines):
+    """Parse ffmpeg -progress output into dicts, one per report.
+
+    Yields dicts with out_time (seconds), fps, speed (None if not
+    known yet), and finished.
+    """
+    block = { }
+    for line in lines:
+        key, sep, value = line.strip().partition('=')
+        if not sep:
+            continue
+        block[key] = value
+        if key != 'progress':
+            continue
+        out_time = block.get('out_time_us', block.get('out_time_ms'))
+        fps = block.get('fps')
+        speed = block.get('speed', '').rstrip('x')
+        # Before the first frame, ffmpeg reports a large negative time
+        yield {
+            'out_time': int(out_time)/1e6 if out_time and out_time.isdigit() else None,
+            'fps': float(fps) if fps and fps != 'N/A' else None,
+            'speed': float(speed) if speed and speed != 'N/A' else None,
+            'finished': value == 'end',
+            }
+        block = { }
+def test_parse_progress():
+    lines = ['frame=10\n', 'fps=5.00\n', 'out_time_us=2500000\n', 'speed=1.5x\n', 'progress=continue\n',
+             'out_time_us=N/A\n', 'speed=N/A\n', 'progress=end\n']
+    assert list(parse_progress(lines)) == [
+        {'out_time': 2.5, 'fps': 5.0, 'speed': 1.5, 'finished': False},
+        {'out_time': None, 'fps': None, 'speed': None, 'finished': True},
+        ]
+    lines = ['fps=0.00\n', 'out_time_us=-9223372036854775807\n', 'progress=continue\n']
+    assert list(parse_progress(lines))[0]['out_time'] is None
+
+
+class ProgressReporter:
+    """Aggregate ffmpeg progress against the planned durations.
+
+    Each encode is registered with task() with its planned duration
+    (from the start/stop times), and the progress of all running
+    encodes is summed per output and overall.  It is shown as a
+    one-line bar on a terminal (tty) and/or written as JSON lines to
+    json_file.  The ETA assumes the average speed so far continues.
+    """
+    def __init__(self, tty=None, json_file=None):
+        self.tty = tty
+        self.json_file = json_file
+        self.tasks = { }
+        self.durations = { }
+        self.output_totals = { }
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+        self._last_draw = 0
+    def task(self, output, name, duration):
+        """Register an encode, returns the callback for run_command().
+
+        An encode registered again is only counted once.
+        """
+        key = (output, name)
+        with self._lock:
+            if key not in self.durations:
+                self.tasks[key] = 0
+                self.durations[key] = duration
+                self.output_totals[output] = self.output_totals.get(output, 0) + duration
+        def update(out_time=None, fps=None, speed=None, finished=False):
+            self.update(key, duration, out_time, fps, speed, finished)
+        return update
+    def update(self, key, duration, out_time=None, fps=None, speed=None, finished=False):
+        output, name = key
+        if finished:
+            out_time = duration
+        if out_time is None:
+            return
+        with self._lock:
+            self.tasks[key] = min(max(out_time, 0), duration)
+            done = sum(self.tasks.values())
+            total = sum(self.output_totals.values())
+            output_done = sum(v for (o, n), v in self.tasks.items() if o == output)
+            elapsed = time.monotonic() - self._start
+            eta = None
+            if done > 0:
+                eta = elapsed * (total - done) / done
+            if self.json_file:
+                self.json_file.write(json.dumps({
+                    'time': round(elapsed, 3),
+                    'output': output,
+                    'segment': name,
+                    'out_time': round(out_time, 3),
+                    'duration': duration,
+                    'fps': fps,
+                    'speed': speed,
+                    'output_fraction': round(output_done / self.output_totals[output], 4) if self.output_totals[output] else 1,
+                    'fraction': round(done / total, 4) if total else 1,
+                    'eta': round(eta, 1) if eta is not None else None,
+                    }) + '\n')
+                self.json_file.flush()
+            if self.tty and (finished or time.monotonic() - self._last_draw > 0.5):
+                self._last_draw = time.monotonic()
+                fraction = done / total if total else 1
+                bar = ('=' * int(fraction*30)).ljust(30)
+                line = f"[{bar}] {fraction:4.0%} {humantime(done)}/{humantime(total)}"
+                if speed is not None:
+                    line += f" {speed:.2f}x"
+                if fps is not None:
+                    line += f" {fps:.0f}fps"
+                if eta is not None:
+                    line += f" ETA {humantime(eta)}"
+                self.tty.write('\r' + line.ljust(79)[:79])
+                self.tty.flush()
+    def close(self):
+        if self.tty:
+            self.tty.write('\n')
+            self.tty.flush()
+        if self.json_file and self.json_file is not sys.stdout:
+            self.json_file.close()
+
+@contextlib.contextmanager
+def progress_reporter(args):
+    """The ProgressReporter for --progress/--progress-json, or None."""
+    if not (args.progress or args.progress_json):
+        yield None
+        return
+    json_file = None
+    if args.progress_json:
+        json_file = sys.stdout if str(args.progress_json) == '-' else open(args.progress_json, 'w')
+    progress = ProgressReporter(tty=sys.stderr if args.progress else None, json_file=json_file)
+    try:
+        yield progress
+    finally:
+        progress.close()
+
+
+def command_key(cmd):
+    """Hash identifying what an ffmpeg command (without its output) makes.
+
+    This is the command without the loglevel, plus the identity (path,
+    size, mtime) of its input files (not of lavfi sources).
+    """
+    cmd = [str(x) for x in cmd]
+    if cmd[1:2] == ['-loglevel']:
+        cmd = cmd[:1] + cmd[3:]
+    h = hashlib.sha256()
+    h.update(repr(cmd).encode())
+    for i, arg in enumerate(cmd[:-1]):
+        if arg == '-i' and cmd[i-2:i] != ['-f', 'lavfi']:
+            st = os.stat(cmd[i+1])
+            path = os.path.abspath(cmd[i+1])
+            h.update(repr((path, st.st_size, st.st_mtime_ns)).encode())
+    return h.hexdigest()
+
+
+def segment_key(cmd):
+    """Hash identifying a segment command (without its output) within a run.
+
+    Like command_key(), but the inputs aren't looked at, since they
+    don't change during one run (and may be missing with --dry-run).
+    Only their real paths are used, so the same file given by different
+    paths (a.mkv, ./a.mkv, a symlink) is the same segment.
+    """
+    cmd = [str(x) for x in cmd]
+    if cmd[1:2] == ['-loglevel']:
+        cmd = cmd[:1] + cmd[3:]
+    cmd = [os.path.realpath(arg) if cmd[i-1:i] == ['-i'] and cmd[i-3:i-1] != ['-f', 'lavfi'] else arg
+           for i, arg in enumerate(cmd)]
+    return hashlib.sha256(repr(cmd).encode()).hexdigest()[:16]
+def test_segment_key():
+    cmd = ['ffmpeg', '-loglevel', '31', '-i', 'a.mkv', '-ss', '1', '-to', '2']
+    assert segment_key(cmd) == segment_key(['ffmpeg', '-i', './sub/../a.mkv', *cmd[5:]])
+    assert segment_key(cmd) == segment_key([*cmd[:4], os.path.abspath('a.mkv'), *cmd[5:]])
+    assert segment_key(cmd) != segment_key([*cmd[:4], 'b.mkv', *cmd[5:]])
+    lavfi = ['ffmpeg', '-f', 'lavfi', '-i', 'anullsrc']
+    assert segment_key(lavfi) != segment_key(['ffmpeg', '-f', 'lavfi', '-i', './anullsrc'])
+
+
+class SegmentCache:
+    """Persistent cache of encoded segments (--cache-dir).
+
+    Each segment is stored under a hash of the ffmpeg command that
+    produced it (everything except the loglevel and the output
+    filename) plus the identity (path, size, mtime) of its input files.
+    So changing start/stop, covers, crop, or encoder options makes a
+    new entry, while editing titles or TOC entries re-uses the old
+    ones.  The cache is kept below max_size bytes by removing the least
+    recently used entries.
+    """
+    def __init__(self, path, max_size=None):
+        self.path = Path(path)
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+    def key(self, cmd):
+        return command_key(cmd[:-1])
+    def _entry(self, key):
+        return self.path / (key + '.mkv')
+    def fetch(self, key, dest):
+        """Put the cached segment at dest, return False if not cached.
+
+        dest is a clone, not a link, since it may be the output itself
+        (--single-pass), which is edited in place.
+        """
+        entry = self._entry(key)
+        with self._lock:
+            if not entry.exists():
+                return False
+            os.utime(entry)   # mark as recently used
+        clone_file(entry, dest)
+        return True
+    def store(self, key, src):
+        """Add a newly encoded segment to the cache."""
+        with atomic_write(self._entry(key)) as tmp:
+            shutil.copy(src, tmp)
+        self.evict()
+    def evict(self):
+        """Remove least recently used entries until below max_size."""
+        if self.max_size is None:
+            return
+        with self._lock:
+            entries = [ ]
+            for entry in self.path.glob('*.mkv'):
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry))
+            total = sum(x[1] for x in entries)
+            for mtime, size, entry in sorted(entries):
+                if total <= self.max_size:
+                    break
+                LOG.debug("Evicting cached segment %s", entry)
+                entry.unlink()
+                total -= size
+
+
+class BuildManifest:
+    """Record of what each output was built from, for incremental rebuilds.
+
+    For each output, this stores a fingerprint of its encoding (the
+    segment commands and their inputs' identities), of its metadata
+    (title, description, TOC, subtitles), and the identity of the
+    output file itself.  state() compares an output plan against it:
+
+    'current':  nothing changed, the output can be skipped.
+    'metadata': only the metadata changed, redo only the .info.txt,
+                chapters, mkvpropedit/mkvmerge.
+    'build':    the cuts or inputs changed (or anything is missing):
+                encode it again.
+    """
+    FILENAME = '.ffmpeg-editlist-manifest.json'
+    def __init__(self, path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        try:
+            self.entries = json.load(open(self.path))
+        except (FileNotFoundError, ValueError):
+            self.entries = { }
+    @staticmethod
+    def _file_id(filename):
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return None
+        return [st.st_size, st.st_mtime_ns]
+    def fingerprints(self, out, args):
+        """(encode, metadata) fingerprints of an output plan."""
+        h = hashlib.sha256()
+        for cmd in ([out.cmd] if out.cmd else [seg.cmd for seg in out.segments]):
+            h.update(command_key(cmd).encode())
+        return h.hexdigest(), self.metadata_fingerprint(out, args)
+    @staticmethod
+    def metadata_fingerprint(out, args):
+        metadata = [out.title, out.description, out.toc, args.mkv_props]
+        if args.srt:
+            metadata.append(cut_subtitles(out))
+        return hashlib.sha256(repr(metadata).encode()).hexdigest()
+    def state(self, out, args):
+        entry = self.entries.get(str(out.output))
+        if entry is None:
+            return 'build'
+        try:
+            encode, metadata = self.fingerprints(out, args)
+        except OSError:
+            return 'build'
+        if (encode != entry['encode']
+              or self._file_id(out.output) != entry['output']):
+            return 'build'
+        if args.srt and not out.output_raw.exists():
+            # The subtitles are embedded from it (e.g. --no-keep-raw)
+            LOG.warning("%s: the raw output %s is missing, rebuilding it to embed the subtitles",
+                        out.output, out.output_raw)
+            return 'build'
+        if metadata != entry['metadata']:
+            return 'metadata'
+        return 'current'
+    def metadata_current(self, out, args):
+        """True if the output file still has exactly this metadata.
+
+        Unlike state(), this doesn't look at the inputs at all.
+        """
+        entry = self.entries.get(str(out.output))
+        return (entry is not None
+                and self._file_id(out.output) == entry['output']
+                and self.metadata_fingerprint(out, args) == entry['metadata'])
+    def record(self, out, args, metadata_only=False):
+        """Record a successfully built output, and save the manifest.
+
+        With metadata_only, only its metadata was updated: the encode
+        fingerprint is kept as it was (if there was none, the next
+        normal run still rebuilds it).
+        """
+        lock = self.path.with_name(self.path.name + '.lock')
+        with self._lock, file_lock(lock):
+            if metadata_only:
+                encode = self.entries.get(str(out.output), {}).get('encode')
+                metadata = self.metadata_fingerprint(out, args)
+            else:
+                encode, metadata = self.fingerprints(out, args)
+            # Other processes may have recorded their outputs meanwhile
+            try:
+                self.entries.update(json.load(open(self.path)))
+            except (FileNotFoundError, ValueError):
+                pass
+            self.entries[str(out.output)] = {
+                'encode': encode,
+                'metadata': metadata,
+                'output': self._file_id(out.output),
+                }
+            with atomic_write(self.path, 'w') as tmp:
+                open(tmp, 'w').write(json.dumps(self.entries, indent=1))
+
+
+def reuse_segment(cmd, cache=None, checkpoint=False):
+    """Check if a segment needs encoding (the last element of cmd is the output).
+
+    Returns 'checkpoint' if a previous --resume run already encoded
+    it (it has a valid completion marker), 'cache' if it was taken
+    from the segment cache, or None if it must be encoded (then any
+    partial file left from an interrupted encode is removed).
+    """
+    if checkpoint:
+        marker = str(cmd[-1]) + '.done'
+        try:
+            done = json.loads(open(marker).read())
+        except (FileNotFoundError, ValueError):
+            done = { }
+        if done.get('key') == command_key(cmd[:-1]) and done.get('size') == file_size(cmd[-1]):
+            LOG.info("Resuming: %s is already encoded", cmd[-1])
+            return 'checkpoint'
+        remove_partial(marker)
+        remove_partial(cmd[-1])
+    if cache is not None:
+        key = cache.key(cmd)
+        if cache.fetch(key, cmd[-1]):
+            LOG.info("Using cached segment %s for %s", key[:16], cmd[-1])
+            return 'cache'
+    return None
+
+def segment_encoded(cmd, cache=None, checkpoint=False):
+    """Store a newly encoded segment in the cache, and mark it done."""
+    if cache is not None:
+        cache.store(cache.key(cmd), cmd[-1])
+    if checkpoint:
+        with atomic_write(str(cmd[-1]) + '.done', 'w') as tmp:
+            open(tmp, 'w').write(json.dumps({'key': command_key(cmd[:-1]),
+                                             'size': file_size(cmd[-1])}))
+
+def run_segment(cmd, args, cache=None, progress=None, checkpoint=False):
+    """Encode one segment (the last element of cmd is the output).
+
+    If a segment cache is given, re-use a previous identical encoding
+    when there is one, and store new encodings in it.  With
+    checkpoint (--resume), a completion marker is written next to the
+    segment, and a segment with a valid marker isn't encoded again.
+    """
+    with profile_span(args, 'encode', 'segment', file=os.path.basename(cmd[-1])) as span:
+        reused = reuse_segment(cmd, cache, checkpoint)
+        if reused:
+            span['reused'] = reused
+            if progress:
+                progress(finished=True)
+            return
+        run_command(cmd, args, progress=progress)
+        span['bytes'] = file_size(cmd[-1])
+        with profile_span(args, 'store', 'segment'):
+            segment_encoded(cmd, cache, checkpoint)
+
+
+def groupable(cmd):
+    """True if cmd is an ffmpeg reading only one input, with output-side seeking."""
+    return (cmd[0] == 'ffmpeg' and len(cmd) > 5 and cmd[3] == '-i'
+            and '-i' not in cmd[5:] and '-ss' not in cmd[1:3])
+
+def group_command(cmds):
+    """One ffmpeg command making the outputs of several groupable() commands.
+
+    They must have the same input.  ffmpeg reads it once, from the
+    start until the last output's -to, and each output takes its own
+    time range (with its own codecs and filters) of it.
+    """
+    head = cmds[0][:5]
+    assert all(cmd[:5] == head for cmd in cmds)
+    return [*head, *itertools.chain.from_iterable(cmd[5:] for cmd in cmds)]
+def test_group_command():
+    cmd1 = ['ffmpeg', '-loglevel', '31', '-i', 'a.mkv', '-ss', '1', '-to', '2', '-c', 'copy', 'x.mkv']
+    cmd2 = ['ffmpeg', '-loglevel', '31', '-i', 'a.mkv', '-ss', '3', '-to', '4', '-vf', 'crop', 'y.mkv']
+    assert groupable(cmd1) and groupable(cmd2)
+    assert group_command([cmd1, cmd2]) == cmd1 + cmd2[5:]
+    assert not groupable(['ffmpeg', '-loglevel', '31', '-loop', '1', '-i', 'a.png', '-t', '5', 'x.mkv'])
+    assert not groupable(['ffmpeg', '-loglevel', '31', '-i', 'a.mkv', '-i', 'b.mkv', 'x.mkv'])
+
+def segment_jobs(cmd_lists, decode_once=False, shared_keys=()):
+    """Group the segment commands of all outputs into jobs.
+
+    cmd_lists has the segment_commands() of each output.  Returns
+    [(commands, output indexes, duplicates), ...]: each job's commands
+    (as in segment_commands()) are run together by run_segments(), and
+    are needed by those outputs.  Normally each command is its own job.
+    With decode_once (--decode-once), all groupable() commands reading
+    the same input, of all outputs, are one job, so that the input is
+    read only once.  Commands whose segment_key() is in shared_keys
+    (see mark_shared_segments()) are only in the job of their first
+    occurrence, and duplicates maps that one's output file to the
+    others, which are linked to it once it is made.
+    """
+    jobs = [ ]
+    groups = { }
+    first = { }
+    for n, cmds in enumerate(cmd_lists):
+        for cmd in cmds:
+            key = segment_key(cmd[0][:-1]) if shared_keys else None
+            if key in shared_keys and key in first:
+                job, primary = first[key]
+                job[2].setdefault(primary, [ ]).append(cmd)
+                if n not in job[1]:
+                    job[1].append(n)
+                continue
+            if decode_once and groupable(cmd[0]):
+                if cmd[0][4] not in groups:
+                    groups[cmd[0][4]] = ([ ], [ ], { })
+                    jobs.append(groups[cmd[0][4]])
+                job = groups[cmd[0][4]]
+                job[0].append(cmd)
+                if n not in job[1]:
+                    job[1].append(n)
+            else:
+                job = ([cmd], [n], { })
+                jobs.append(job)
+            if key in shared_keys:
+                first[key] = (job, cmd[0][-1])
+    return jobs
+
+def test_segment_jobs():
+    def cmd(input, start, output):
+        return (['ffmpeg', '-loglevel', '31', '-i', input, '-ss', start, output], None, False)
+    cmd_lists = [[cmd('a', '1', 'x/1'), cmd('b', '1', 'x/2')],
+                 [cmd('a', '2', 'y/1'), cmd('b', '1', 'y/2')]]
+    key = segment_key(cmd_lists[0][1][0][:-1])
+    jobs = segment_jobs(cmd_lists)
+    assert [(len(c), n) for c, n, d in jobs] == [(1, [0]), (1, [0]), (1, [1]), (1, [1])]
+    jobs = segment_jobs(cmd_lists, shared_keys={key})
+    assert [(len(c), n) for c, n, d in jobs] == [(1, [0]), (1, [0, 1]), (1, [1])]
+    assert jobs[1][2] == {'x/2': [cmd_lists[1][1]]}
+    jobs = segment_jobs(cmd_lists, decode_once=True, shared_keys={key})
+    assert [(len(c), n) for c, n, d in jobs] == [(2, [0, 1]), (1, [0, 1])]
+
+def link_segment(src, dst):
+    """Put a copy of the segment src at dst (a hard link if possible)."""
+    remove_partial(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        clone_file(src, dst)
+
+def link_duplicates(duplicates):
+    """Link the duplicates of a job of segment_jobs() to their original."""
+    for src, cmds in duplicates.items():
+        for cmd, progress, checkpoint in cmds:
+            link_segment(src, cmd[-1])
+            if progress:
+                progress(finished=True)
+
+def run_segments(cmds, args, cache=None, duplicates=None):
+    """Run a job of segment_jobs().
+
+    A single command is run_segment().  Several (--decode-once) are
+    made by one group_command(), except those that can be re-used
+    (see reuse_segment()).  Their progress is only reported when all
+    are done.  Then the duplicates are linked.
+    """
+    _run_segments(cmds, args, cache)
+    if duplicates:
+        link_duplicates(duplicates)
+
+def _run_segments(cmds, args, cache):
+    if len(cmds) == 1:
+        cmd, progress, checkpoint = cmds[0]
+        run_segment(cmd, args, cache, progress, checkpoint)
+        return
+    with profile_span(args, 'encode-group', 'segment', input=os.path.basename(cmds[0][0][4]),
+                      segments=len(cmds)) as span:
+        todo = [ ]
+        for cmd, progress, checkpoint in cmds:
+            if reuse_segment(cmd, cache, checkpoint):
+                if progress:
+                    progress(finished=True)
+            else:
+                todo.append((cmd, progress, checkpoint))
+        if not todo:
+            return
+        cmd = group_command([cmd for cmd, _, _ in todo])
+        LOG.info(shell_join(cmd))
+        run_command(cmd, args)
+        span['bytes'] = sum(file_size(cmd[-1]) for cmd, _, _ in todo)
+        with profile_span(args, 'store', 'segment'):
+            for cmd, progress, checkpoint in todo:
+                segment_encoded(cmd, cache, checkpoint)
+                if progress:
+                    progress(finished=True)
+
+
+@contextlib.contextmanager
+def lock_outputs(outputs):
+    """Lock outputs against other ffmpeg-editlist processes.
+
+    Each output has a lock file .NAME.lock next to it.  Yields
+    (locked outputs, errors): outputs that another process is working
+    on are left out, with an error each.  The locks are held until the
+    end of the with block.
+    """
+    locked = [ ]
+    errors = [ ]
+    with contextlib.ExitStack() as stack:
+        for out in outputs:
+            lock = out.output.with_name('.' + out.output.name + '.lock')
+            ensure_filedir_exists(lock)
+            try:
+                stack.enter_context(file_lock(lock, blocking=False))
+            except BlockingIOError:
+                try:
+                    pid = open(lock).read().strip()
+                except OSError:
+                    pid = None
+                errors.append(f"{out.output}: is being made by another process"
+                              + (f" (pid {pid})" if pid else ""))
+                continue
+            locked.append(out)
+        yield locked, errors
+
+
+def select_outputs(outputs, args, manifest=None):
+    """(outputs to process, set of those needing only a metadata update).
+
+    Without a BuildManifest, that is all outputs, fully.
+    """
+    metadata_only = set()
+    selected = [ ]
+    for out in outputs:
+        state = manifest.state(out, args) if manifest else 'build'
+        if state == 'current':
+            LOG.info("Up to date: %s", out.output)
+            continue
+        if state == 'metadata':
+            LOG.info("Only metadata changed: %s", out.output)
+            metadata_only.add(out.output)
+        selected.append(out)
+    return selected, metadata_only
+
+
+def segment_commands(out, tmpdir, raw, args, metadata_only=False, progress=None):
+    """[(cmd, progress callback, checkpoint), ...] of the encodes of an output."""
+    if args.check or metadata_only:
+        return [ ]
+    def task(name, duration):
+        return progress.task(out.name, name, duration) if progress else None
+    if out.cmd:
+        duration = sum(seg.stop - seg.start for seg in out.segments)
+        return [([*out.cmd, raw], task('single-pass', duration), False)]
+    return [([*seg.cmd, str(Path(tmpdir)/seg.filename)],
+             task(seg.filename, seg.stop - seg.start if seg.type != 'audio' else 0),
+             args.resume)
+            for seg in itertools.chain.from_iterable(seg.chunks or [seg] for seg in out.segments)]
+
+
+def finish_output(out, tmpdir, raw, args, metadata_only=False, manifest=None):
+    """finalize_output(), then record it in the manifest and clean up.
+
+    An output that wasn't completely updated isn't recorded, so it is
+    done again next time.
+    """
+    complete = finalize_output(out, tmpdir, raw, args, metadata_only=metadata_only)
+    if manifest and complete:
+        manifest.record(out, args)
+    if args.resume:
+        shutil.rmtree(tmpdir)
+
+
+def execute_plan(plan, args, cache=None, progress=None, manifest=None, segment_pool=None):
+    """Encode the segments of all planned outputs, then finalize each.
+
+    Serially (the default), each output is encoded and finalized in
+    turn.  With --jobs N, up to N segment encodes run at once across
+    all outputs, and each output is finalized as soon as its own
+    segments are done.  A failing output doesn't stop the others: each
+    has its own temporary directory, and the failures are reported at
+    the end.  With --check, nothing is encoded, only the metadata is
+    updated.  progress is an optional ProgressReporter.  If a
+    BuildManifest is given, up to date outputs are skipped and outputs
+    whose metadata only changed aren't re-encoded.  segment_pool is an
+    executor to run the segment encodes in, instead of one of --jobs
+    workers (see FairPool).  Outputs are locked while they are made
+    (see lock_outputs()).
+    """
+    with lock_outputs(plan.outputs) as (outputs, errors):
+        try:
+            _execute_plan(outputs, args, cache, progress, manifest, segment_pool)
+        except EditlistError as exc:
+            raise EditlistError(errors + exc.errors) from None
+    if errors:
+        raise EditlistError(errors)
+
+def _execute_plan(outputs, args, cache, progress, manifest, segment_pool):
+    outputs, metadata_only = select_outputs(outputs, args, manifest)
+
+    def segment_cmds(out, tmpdir, raw):
+        return segment_commands(out, tmpdir, raw, args, out.output in metadata_only, progress)
+
+    def finalize(out, tmpdir, raw):
+        finish_output(out, tmpdir, raw, args, out.output in metadata_only, manifest)
+
+    # A given pool (--serve) bounds the finalizing commands too.
+    finalize_pool = segment_pool
+
+    shared_keys = {seg.shared for out in outputs for seg in out.segments if seg.shared}
+
+    if args.jobs <= 1 and segment_pool is None and not args.decode_once:
+        # Register all encodes first, so the progress total covers
+        # all outputs, not only those started so far.
+        if progress:
+            for out in outputs:
+                segment_cmds(out, '', '')
+        with tempfile.TemporaryDirectory() as shared_dir:
+            for out in outputs:
+                with work_directory(out, args) as tmpdir:
+                    raw = raw_target(out, args)
+                    try:
+                        for cmd, task, checkpoint in segment_cmds(out, tmpdir, raw):
+                            # Shared segments are kept for the later outputs
+                            key = segment_key(cmd[:-1]) if shared_keys else None
+                            kept = Path(shared_dir)/f'{key}.mkv'
+                            if key in shared_keys and kept.exists():
+                                link_duplicates({kept: [(cmd, task, checkpoint)]})
+                                continue
+                            run_segment(cmd, args, cache, task, checkpoint)
+                            if key in shared_keys:
+                                link_segment(cmd[-1], kept)
+                        finalize(out, tmpdir, raw)
+                    finally:
+                        remove_partial(raw)
+                    if args.wait:
+                        input('press return to continue> ')
+        return
+
+    def finish(out, tmpdir, raw, futures):
+        try:
+            for future in futures:
+                future.result()
+        except BaseException:
+            # Segments other outputs need too still run
+            for future in futures:
+                if future not in shared_futures:
+                    future.cancel()
+            raise
+        if finalize_pool is not None:
+            finalize_pool.submit(finalize, out, tmpdir, raw).result()
+        else:
+            finalize(out, tmpdir, raw)
+
+    failed = [ ]
+    with contextlib.ExitStack() as stack:
+        tmpdirs = [stack.enter_context(work_directory(out, args))
+                   for out in outputs]
+        raws = [raw_target(out, args) for out in outputs]
+        if segment_pool is None:
+            segment_pool = stack.enter_context(
+                concurrent.futures.ThreadPoolExecutor(args.jobs))
+        output_pool = stack.enter_context(
+            concurrent.futures.ThreadPoolExecutor(len(outputs) or 1))
+        # Segments are queued in editlist order, so outputs tend to
+        # complete in order too.
+        jobs = segment_jobs([segment_cmds(out, tmpdir, raw)
+                             for out, tmpdir, raw in zip(outputs, tmpdirs, raws)],
+                            decode_once=args.decode_once, shared_keys=shared_keys)
+        segment_futures = [[ ] for out in outputs]
+        shared_futures = set()
+        for cmds, needed_by, duplicates in jobs:
+            future = segment_pool.submit(run_segments, cmds, args, cache, duplicates)
+            for n in needed_by:
+                segment_futures[n].append(future)
+            if len(needed_by) > 1:
+                shared_futures.add(future)
+        output_futures = [output_pool.submit(finish, out, tmpdir, raw, futures)
+                          for out, tmpdir, raw, futures
+                          in zip(outputs, tmpdirs, raws, segment_futures)]
+        for out, future in zip(outputs, output_futures):
+            try:
+                future.result()
+            except Exception as exc:
+                LOG.error("Output %s failed: %s", out.output, exc)
+                failed.append(out.output)
+        for raw in raws:
+            remove_partial(raw)
+    if failed:
+        raise EditlistError(f"{len(failed)} of {len(outputs)} outputs failed: "
+                            + ', '.join(str(x) for x in failed))
+
+
+def update_metadata(plan, args, manifest=None):
+    """--metadata-only: update the metadata of the existing outputs in place.
+
+    The title, chapters, and description are set with mkvpropedit,
+    which edits the mkv headers without copying or remuxing the video,
+    and the .info.txt (and .srt, with --srt) files are rewritten.
+    Outputs are compared to the BuildManifest (if given) and the
+    metadata actually in the file, and only those that differ are
+    edited.  Up to --jobs outputs are done at once.  Returns the list
+    of outputs that changed.
+    """
+    def update(out):
+        if not out.output.exists():
+            raise EditlistError(f"{out.output}: doesn't exist, it needs to be built first")
+        changed = False
+        files = {description_file(out): out.description}
+        if args.srt:
+            files[out.srt_output] = cut_subtitles(out)
+        for filename, text in files.items():
+            if text is None:
+                continue
+            try:
+                old = open(filename).read()
+            except FileNotFoundError:
+                old = None
+            if text != old:
+                with atomic_write(filename, 'w') as tmp:
+                    open(tmp, 'w').write(text)
+                changed = True
+        if args.mkv_props and not (manifest and manifest.metadata_current(out, args) and not changed):
+            current = probe_metadata(out.output)
+            title, chapters, attachments = current
+            toc = [(floor(new_time), name) for new_time, name in out.toc]
+            if (changed or title != out.title or chapters != toc
+                  or ('description' in attachments) != bool(out.description)):
+                with tempfile.TemporaryDirectory() as tmpdir:
+                    chapter_file = Path(tmpdir) / 'chapters.txt'
+                    write_chapters(out, chapter_file)
+                    cmd = propedit_command(out, out.output, chapter_file, description_file(out), current)
+                    if cmd:
+                        LOG.info(shell_join(cmd))
+                        with profile_span(args, 'mkvpropedit', output=out.name):
+                            run_command(cmd, args)
+                changed = True
+        if manifest:
+            manifest.record(out, args, metadata_only=True)
+        return changed
+
+    changed = [ ]
+    with lock_outputs(plan.outputs) as (outputs, errors), \
+         concurrent.futures.ThreadPoolExecutor(max(args.jobs, 1)) as pool:
+        futures = [pool.submit(update, out) for out in outputs]
+        for out, future in zip(outputs, futures):
+            try:
+                if future.result():
+                    if not args.quiet:
+                        print(f"Changed: {out.output}")
+                    changed.append(out)
+                else:
+                    LOG.info("Unchanged: %s", out.output)
+            except EditlistError as exc:
+                errors.extend(exc.errors)
+            except (OSError, subprocess.CalledProcessError) as exc:
+                errors.append(f"{out.output}: {exc}")
+    if not args.quiet:
+        print(f"{len(changed)} of {len(plan.outputs)} outputs changed")
+    if errors:
+        raise EditlistError(errors)
+    return changed
+
+
+class SubtitleIndex:
+    """The subtitles of one file, sorted for slicing by time.
+
+    Start times and the running maximum of the end times are kept in
+    arrays, so finding the cues that overlap a time range is two
+    bisections plus the cues found, even if cues overlap.
+    """
+    def __init__(self, subtitles):
+        self.subtitles = sorted(subtitles, key=lambda sub: sub.start)
+        self.starts = array.array('d', (sub.start.total_seconds() for sub in self.subtitles))
+        self.max_ends = array.array('d', itertools.accumulate(
+            (sub.end.total_seconds() for sub in self.subtitles), max))
+    def slice(self, start, stop):
+        """Subtitles that overlap start-stop (seconds)."""
+        lo = bisect.bisect_left(self.max_ends, start)
+        hi = bisect.bisect_right(self.starts, stop)
+        return [sub for sub in self.subtitles[lo:hi]
+                if sub.end.total_seconds() >= start]
+def test_subtitle_index():
+    from types import SimpleNamespace
+    def sub(start, end):
+        return SimpleNamespace(start=timedelta(seconds=start), end=timedelta(seconds=end))
+    index = SubtitleIndex([sub(5, 6), sub(0, 1), sub(2, 10), sub(3, 4)])
+    assert [x.start.seconds for x in index.slice(4.5, 5.5)] == [2, 5]
+    assert [x.start.seconds for x in index.slice(1, 3)] == [0, 2, 3]
+    assert index.slice(11, 12) == [ ]
+    assert index.slice(-2, -1) == [ ]
+
+@functools.lru_cache(maxsize=32)
+def _load_subtitles(filename, mtime_ns, size):
+    import srt
+    return SubtitleIndex(srt.parse(open(filename).read()))
+
+def load_subtitles(filename):
+    """Parse an .srt file into a SubtitleIndex, once per file version.
+
+    Many outputs (and segments) usually share one input, so the result
+    is cached, keyed by the file's mtime and size too.
+    """
+    st = os.stat(filename)
+    return _load_subtitles(os.path.abspath(filename), st.st_mtime_ns, st.st_size)
+
+
+def cut_subtitles(out):
+    """Cut and re-time the subtitles of each segment of an output."""
+    import srt
+    subtitles = [ ]
+    for seg in out.segments:
+        if seg.subtitles is None:
+            continue
+        start_dt = timedelta(seconds=seg.start)
+        end_dt   = timedelta(seconds=seg.stop)
+        start_cumulative_dt = timedelta(seconds=seg.output_start)
+        duration_segment_dt = end_dt-start_dt
+        for sub in load_subtitles(seg.subtitles).slice(seg.start, seg.stop):
+            sub = copy.copy(sub)
+            sub.start = sub.start - start_dt + start_cumulative_dt
+            sub.end   = sub.end   - start_dt + start_cumulative_dt
+            sub.start = max(sub.start, start_cumulative_dt)
+            sub.end   = min(sub.end,   start_cumulative_dt + duration_segment_dt)
+            subtitles.append(sub)
+    return srt.compose(subtitles)
+
+
+@contextlib.contextmanager
+def work_directory(out, args):
+    """Directory for the intermediate files (segments) of an output.
+
+    Normally this is a temporary directory.  With --resume, it is a
+    stable directory next to the raw output (tmp/NAME.work/), which
+    is only removed once the output is finished, so that a later
+    --resume run can continue where a failed or interrupted one was.
+    """
+    if not args.resume:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            yield tmpdir
+        return
+    workdir = out.output_raw.parent / (out.output_raw.name + '.work')
+    os.makedirs(workdir, exist_ok=True)
+    yield str(workdir)
+
+
+def raw_target(out, args):
+    """Temporary name where the joined raw output is written.
+
+    It is next to its final place (output_raw in tmp/, or the output
+    itself with --no-keep-raw) and has the same extension, so that
+    ffmpeg picks the right format and it can then be renamed into
+    place: the video data is written only once.
+    """
+    final = out.output_raw if args.keep_raw else out.output
+    ensure_filedir_exists(final)
+    return temporary_filename(final, keep_ext=True)
+
+
+def remove_partial(raw):
+    """Remove the partial raw output, if it is left over after a failure."""
+    try:
+        os.unlink(raw)
+    except FileNotFoundError:
+        pass
+
+
+def finalize_output(out, tmpdir, raw, args, metadata_only=False):
+    """Concatenate the encoded segments of one output and finalize it.
+
+    This makes the raw output (in tmp/, unless --no-keep-raw), the
+    .info.txt description, and the final output with subtitles, title,
+    and chapters.  raw is where the raw output is written (see
+    raw_target()).  With metadata_only (or --check), the existing
+    output (or raw output, with --srt) is only updated.  Returns False
+    if the output couldn't be completely updated (with --srt, the raw
+    output is needed to embed the subtitles).
+    """
+    with profile_span(args, 'finalize', 'output', output=out.name):
+        return _finalize_output(out, tmpdir, raw, args, metadata_only)
+
+def _finalize_output(out, tmpdir, raw, args, metadata_only):
+    complete = True
+    output = out.output
+    output_raw = out.output_raw
+    encode = not (args.check or metadata_only)
+
+    # Subtitles
+    if args.srt:
+        srt_output = out.srt_output
+        with profile_span(args, 'subtitles', output=out.name):
+            open(srt_output, 'w').write(cut_subtitles(out))
+
+    ensure_filedir_exists(output)
+    # Join the chunks of chunked segments
+    for seg in out.segments:
+        if seg.chunks and encode:
+            chunk_list = Path(tmpdir) / (seg.filename + '.chunks.txt')
+            with open(chunk_list, 'w') as chunk_list_f:
+                for chunk in seg.chunks:
+                    if chunk.type != 'audio':
+                        chunk_list_f.write('file '+str(Path(tmpdir)/chunk.filename)+'\n')
+            audio = Path(tmpdir) / seg.chunks[-1].filename
+            cmd = ['ffmpeg', '-loglevel', str(ffmpeg_loglevel(args)),
+                   '-safe', '0', '-f', 'concat', '-i', chunk_list,
+                   '-i', audio,
+                   '-map', '0:v', '-map', '1:a', '-c', 'copy',
+                   '-y', Path(tmpdir)/seg.filename]
+            LOG.info(shell_join(cmd))
+            with profile_span(args, 'join-chunks', output=out.name) as span:
+                run_command(cmd, args)
+                span['bytes'] = file_size(Path(tmpdir)/seg.filename)
+
+    # Join the segments, unless --single-pass made the whole output
+    if not out.cmd:
+        # Create the playlist of inputs
+        playlist = Path(tmpdir) / 'playlist.txt'
+        with open(playlist, 'w') as playlist_f:
+            for seg in out.segments:
+                playlist_f.write('file '+str(Path(tmpdir)/seg.filename)+'\n')
+        LOG.debug("Playlist:")
+        LOG.debug(open(playlist).read())
+        cmd = ['ffmpeg', '-loglevel', str(ffmpeg_loglevel(args)),
+               #*itertools.chain.from_iterable(('-i', x) for x in tmp_outputs),
+               #'-i', 'concat:'+'|'.join(tmp_outputs),
+               '-safe', '0', '-f', 'concat', '-i', playlist,
+               '-fflags', '+igndts',
+               '-c', 'copy',
+               *(['-y'] if args.force else []),
+               raw,
+               ]
+        LOG.info(shell_join(cmd))
+        if encode:
+            with profile_span(args, 'concat', output=out.name) as span:
+                run_command(cmd, args)
+                span['bytes'] = file_size(raw)
+
+    # This is raw encoding without subtitles or anithing.  It was
+    # written next to output_raw, so moving it is only a rename.
+    if args.keep_raw and encode:
+        with profile_span(args, 'move-raw', output=out.name):
+            os.replace(raw, output_raw)
+    if args.keep_raw or not encode:
+        raw = output_raw
+    have_raw = encode or output_raw.exists()
+
+
+    # Create the video properties/chapters/etc (needs to be done before
+    # making the final mkv because it gets encoded into the mkv file).
+
+    # Print table of contents
+    import pprint
+    LOG.debug(pprint.pformat(out.segment_list))
+    LOG.debug(pprint.pformat(out.toc))
+
+    # Making chapters
+    if not args.quiet:
+        for new_time, name in out.toc:
+            print(humantime(new_time), name)
+    chapter_file = Path(tmpdir) / 'chapters.txt'
+    write_chapters(out, chapter_file)
+
+    video_description_file = description_file(out)
+    if out.description:
+        with atomic_write(video_description_file, 'w') as toc_file:
+            open(toc_file, 'w').write(out.description)
+
+    # Finalize the video
+
+    # Embed subtitles in mkv if they are there.  mkvmerge writes a new
+    # file anyway, so it sets the title/chapters/description too.
+    if args.srt and args.mkv_props:
+        cmd_merge = ['mkvmerge', '-o', output,
+                     *(['--title', out.title,] if out.title else []),
+                     *(['--chapters', str(chapter_file),] if out.toc else []),
+                     *(['--attachment-name', 'description', '--attach-file', video_description_file] if out.description else []),
+                     raw, srt_output,
+               ]
+        LOG.info(shell_join(cmd_merge))
+        if have_raw:
+            with profile_span(args, 'mkvmerge', output=out.name) as span:
+                run_command(cmd_merge, args)
+                span['bytes'] = file_size(output)
+        else:
+            LOG.warning("%s: the raw output %s is missing, so the subtitles aren't embedded",
+                        out.name, output_raw)
+            complete = False
+        if not args.keep_raw and encode:
+            os.unlink(raw)
+    else:
+        if args.keep_raw and encode:
+            with profile_span(args, 'copy-final', output=out.name) as span:
+                clone_file(output_raw, output)
+                span['bytes'] = file_size(output)
+        elif encode:
+            with profile_span(args, 'move-final', output=out.name):
+                os.replace(raw, output)
+
+    # mkv chapters
+    if args.mkv_props and not args.srt:
+        # An existing output may already have metadata to replace
+        current = None
+        if metadata_only:
+            try:
+                current = probe_metadata(output)
+            except (OSError, subprocess.CalledProcessError) as exc:
+                LOG.warning("Could not probe %s: %s", output, exc)
+        cmd_propedit = propedit_command(out, output, chapter_file, video_description_file, current)
+        if cmd_propedit:
+            LOG.info(shell_join(cmd_propedit))
+        if cmd_propedit and (have_raw or metadata_only):
+            with profile_span(args, 'mkvpropedit', output=out.name):
+                run_command(cmd_propedit, args)
+
+    # Print out covered segments (for verification purposes)
+    for new_time in out.covers:
+        LOG.info("Check cover at %s", humantime(new_time))
+    return complete
+
+
+def description_file(out):
+    """The .info.txt file next to an output."""
+    return os.path.splitext(str(out.output))[0]+'.info.txt'
+
+
+def write_chapters(out, filename):
+    """Write the TOC of an output as a (simple format) chapter file."""
+    with open(filename, 'w') as chapter_file_f:
+        for i, (new_time, name) in enumerate(out.toc):
+            chapter_file_f.write(f'CHAPTER{i+1:02d}={humantime(new_time, show_hour=True)}.000\n')
+            chapter_file_f.write(f'CHAPTER{i+1:02d}NAME={name}\n')
+
+
+def propedit_command(out, output, chapter_file, description_file, current=None):
+    """mkvpropedit command to set the title, chapters, and description.
+
+    current is the probe_metadata() of output, if it may already have
+    metadata: then the description attachment is replaced instead of
+    added again, and metadata no longer in the editlist is removed.
+    Returns None if there is nothing to do.
+    """
+    title, chapters, attachments = current or (None, [ ], [ ])
+    cmd = [ ]
+    if out.title:
+        cmd += ['--set', f'title={out.title}']
+    elif title:
+        cmd += ['--delete', 'title']
+    if out.toc:
+        cmd += ['--chapters', str(chapter_file)]
+    elif chapters:
+        cmd += ['--chapters', '']
+    if out.description and 'description' in attachments:
+        cmd += ['--attachment-name', 'description',
+                '--replace-attachment', f'name:description:{description_file}']
+    elif out.description:
+        cmd += ['--attachment-name', 'description', '--add-attachment', description_file]
+    elif 'description' in attachments:
+        cmd += ['--delete-attachment', 'name:description']
+    if not cmd:
+        return None
+    return ['mkvpropedit', output, *cmd]
+def test_propedit_command():
+    out = OutputPlan(name='a', output=Path('a.mkv'), output_raw=None, segments=[], segment_list=[],
+                     title='Title', description='Text', toc=[(0, 'Intro')], covers=[])
+    cmd = propedit_command(out, 'a.mkv', 'ch.txt', 'a.info.txt')
+    assert cmd == ['mkvpropedit', 'a.mkv', '--set', 'title=Title', '--chapters', 'ch.txt',
+                   '--attachment-name', 'description', '--add-attachment', 'a.info.txt']
+    cmd = propedit_command(out, 'a.mkv', 'ch.txt', 'a.info.txt', ('Old', [], ['description']))
+    assert '--replace-attachment' in cmd and '--add-attachment' not in cmd
+    out = dataclasses.replace(out, title=None, description=None, toc=[])
+    assert propedit_command(out, 'a.mkv', 'ch.txt', 'a.info.txt') is None
+    cmd = propedit_command(out, 'a.mkv', 'ch.txt', 'a.info.txt', ('Old', [(0, 'Intro')], ['description']))
+    assert cmd == ['mkvpropedit', 'a.mkv', '--delete', 'title', '--chapters', '',
+                   '--delete-attachment', 'name:description']
+
+
+def ffmpeg_loglevel(args):
+    """ffmpeg -loglevel to use: quiet unless --verbose."""
+    if args.verbose:
+        return 40
+    return 31
+
+
+def single_pass_command(segments, loglevel, video_encode, probe=None, frame_size=None):
+    """ffmpeg command that cuts, filters, and joins segments in one go.
+
+    Each segment is its own (seeked) input, and a filter_complex
+    applies the covers/crop and concatenates them, so there are no
+    intermediate files.  Video and audio are re-encoded.  The output
+    filename is left off, like for segment commands.  With a probe
+    (MediaProbe), images are scaled to the frame size of the (first)
+    video input before the crop, like the videos, and inputs without
+    audio get silence.  frame_size (w, h) is the size to scale images
+    to instead, for filters that images don't get (layout).
+    """
+    size = frame_size
+    has_audio = { }
+    for seg in segments:
+        if probe is None or seg.type == 'image' or seg.input in has_audio or not os.path.exists(seg.input):
+            continue
+        try:
+            video, audio = stream_params(probe.info(seg.input))
+        except (OSError, subprocess.CalledProcessError, ValueError) as exc:
+            LOG.warning("Could not probe %s: %s", seg.input, exc)
+            continue
+        has_audio[seg.input] = audio is not None
+        if size is None and video:
+            size = video['width'], video['height']
+    inputs = [ ]
+    graph = [ ]
+    for k, seg in enumerate(segments):
+        duration = seg.stop - seg.start
+        if seg.type == 'image':
+            inputs.extend(['-loop', '1', '-t', str(duration), '-i', seg.input])
+            vfilters = [f'fps={FFMPEG_FRAMERATE}', 'format=yuv420p']
+            if size:
+                w, h = size
+                vfilters.extend([f'scale={w}:{h}:force_original_aspect_ratio=decrease',
+                                 f'pad={w}:{h}:(ow-iw)/2:(oh-ih)/2', 'setsar=1'])
+            vfilters.extend([*seg.filters, 'setpts=PTS-STARTPTS'])
+            graph.append(f'[{k}:v]{",".join(vfilters)}[v{k}]')
+            graph.append(f'anullsrc,atrim=duration={duration}[a{k}]')
+        else:
+            inputs.extend(['-ss', str(seg.start), '-t', str(duration), '-i', seg.input])
+            # Covers are given in input time, so restore it for them.
+            vfilters = [f'setpts=PTS-STARTPTS+{seg.start}/TB',
+                        *seg.filters,
+                        'setpts=PTS-STARTPTS']
+            graph.append(f'[{k}:v]{",".join(vfilters)}[v{k}]')
+            if has_audio.get(seg.input, True):
+                graph.append(f'[{k}:a]asetpts=PTS-STARTPTS[a{k}]')
+            else:
+                graph.append(f'anullsrc,atrim=duration={duration}[a{k}]')
+    graph.append(''.join(f'[v{k}][a{k}]' for k in range(len(segments)))
+                 + f'concat=n={len(segments)}:v=1:a=1[v][a]')
+    return ['ffmpeg', '-loglevel', str(loglevel),
+            *inputs,
+            '-filter_complex', ';'.join(graph),
+            '-map', '[v]', '-map', '[a]',
+            *video_encode,
+            *FFMPEG_AUDIO_ENCODE,
+            ]
+
+
+def video_encode_options(encoder='x264', preset=None, crf=20, threads=None):
+    """ffmpeg video encoding options for an --encoder/--preset/--crf."""
+    enc = ENCODERS[encoder]
+    return ['-c:v', enc['codec'],
+            *(['-threads', str(threads)] if threads else []),
+            '-preset', str(preset or enc['preset']),
+            '-crf', str(min(crf + enc['crf_offset'], enc['crf_max'])),
+            *enc.get('options', []),
+            ]
+def test_video_encode_options():
+    assert video_encode_options() == ['-c:v', 'libx264', '-preset', 'veryslow', '-crf', '20']
+    assert video_encode_options('svtav1', '8', 25, threads=4) == \
+        ['-c:v', 'libsvtav1', '-threads', '4', '-preset', '8', '-crf', '37']
+    assert video_encode_options('x265', crf=51)[-3] == '51'
+
+
+def available_encoders():
+    """Names of the ENCODERS that the local ffmpeg has."""
+    ret = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'],
+                         capture_output=True, check=True, text=True)
+    codecs = {line.split()[1] for line in ret.stdout.splitlines()
+              if len(line.split()) > 1 and line.startswith(' V')}
+    return [name for name, enc in ENCODERS.items() if enc['codec'] in codecs]
+
+
+def parse_quality(stderr):
+    """(SSIM, PSNR) from the log of ffmpeg's ssim and psnr filters."""
+    ssim = re.search(r'SSIM .* All:([\d.]+)', stderr)
+    psnr = re.search(r'PSNR .* average:([\d.]+|inf)', stderr)
+    return (float(ssim.group(1)) if ssim else None,
+            float(psnr.group(1)) if psnr else None)
+def test_parse_quality():
+    log = ('[Parsed_ssim_4 @ 0x1] SSIM Y:0.990 (20.0) U:0.995 (23.0) V:0.994 (22.2) All:0.9921 (21.0)\n'
+           '[Parsed_psnr_5 @ 0x2] PSNR y:45.1 u:48.0 v:47.9 average:46.02 min:44.0 max:48.8\n')
+    assert parse_quality(log) == (0.9921, 46.02)
+    assert parse_quality('') == (None, None)
+
+
+def calibrate(filename, start, length, args, profiles=CALIBRATION_PROFILES, probe=None):
+    """Encode a sample of filename with each encoder profile and measure it.
+
+    The sample is length seconds from start.  Returns a list of dicts
+    with encoder, preset, speed (times realtime), fps, MB per minute of
+    video, and the SSIM and PSNR compared to the original.  Profiles
+    whose encoder the local ffmpeg doesn't have are left out.
+    """
+    if probe is None:
+        probe = MediaProbe()
+    framerate = None
+    for stream in probe.info(filename).get('streams', []):
+        if stream.get('codec_type') == 'video':
+            num, _, den = stream.get('avg_frame_rate', '0/0').partition('/')
+            if float(den or 1):
+                framerate = float(num) / float(den or 1)
+            break
+    encoders = available_encoders()
+    sample = ['-ss', str(start), '-t', str(length), '-i', str(filename)]
+    results = [ ]
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for encoder, preset in profiles:
+            if encoder not in encoders:
+                continue
+            encoded = Path(tmpdir) / f'{encoder}-{preset}.mkv'
+            cmd = ['ffmpeg', '-loglevel', str(ffmpeg_loglevel(args)), *sample,
+                   '-map', '0:v:0',
+                   *video_encode_options(encoder, preset, args.crf, args.threads),
+                   '-y', encoded]
+            LOG.info(shell_join(cmd))
+            t0 = time.perf_counter()
+            subprocess.run(cmd, check=True, stdin=subprocess.DEVNULL)
+            elapsed = time.perf_counter() - t0
+            cmd = ['ffmpeg', '-hide_banner', '-nostats', *sample, '-i', encoded,
+                   '-lavfi', '[0:v]setpts=PTS-STARTPTS,split[r1][r2];'
+                             '[1:v]setpts=PTS-STARTPTS,split[d1][d2];'
+                             '[d1][r1]ssim;[d2][r2]psnr',
+                   '-f', 'null', '-']
+            ret = subprocess.run(cmd, capture_output=True, check=True, text=True,
+                                 stdin=subprocess.DEVNULL)
+            ssim, psnr = parse_quality(ret.stderr)
+            results.append({
+                'encoder': encoder,
+                'preset': preset,
+                'speed': length / elapsed,
+                'fps': length * framerate / elapsed if framerate else None,
+                'mb_per_min': os.path.getsize(encoded) / 1e6 / (length / 60),
+                'ssim': ssim,
+                'psnr': psnr,
+                })
+    return results
+
+
+def choose_profile(results, realtime):
+    """The best quality calibration result that encodes within realtime× the video duration.
+
+    (realtime=2 means one hour of video may take two hours.)  Returns
+    None if none is fast enough.
+    """
+    fast_enough = [r for r in results if 1 / r['speed'] <= realtime]
+    if not fast_enough:
+        return None
+    return max(fast_enough, key=lambda r: (r['ssim'] or 0, -r['mb_per_min']))
+def test_choose_profile():
+    results = [{'encoder': 'x264', 'preset': 'fast', 'speed': 4, 'ssim': 0.95, 'mb_per_min': 10},
+               {'encoder': 'x264', 'preset': 'slow', 'speed': 1, 'ssim': 0.98, 'mb_per_min': 8},
+               {'encoder': 'x265', 'preset': 'slow', 'speed': 0.25, 'ssim': 0.98, 'mb_per_min': 5}]
+    assert choose_profile(results, 0.5)['preset'] == 'fast'
+    assert choose_profile(results, 1)['preset'] == 'slow'
+    assert choose_profile(results, 4)['encoder'] == 'x265'
+    assert choose_profile(results, 0.1) is None
+
+
+def build_plan(data, args, probe=None, base_dir=None):
+    """Walk the parsed editlist and compile it into an EditPlan.
+
+    This validates the editlist, maps the TOC and cover times to the
+    output, and makes the ffmpeg commands, but doesn't run anything.
+    With --dry-run, missing input files are only warned about.  TOC
+    entries and covers outside of their segments don't stop the
+    planning, they are all collected in EditPlan.errors.  probe (a
+    MediaProbe) is used for --smart-cut.  Relative input paths in the
+    editlist are looked for in base_dir (default the current
+    directory), then in args.input.
+    """
+    if probe is None:
+        probe = MediaProbe()
+    schedule = SchedulePrinter(args.show_schedule)
+
+    LOGLEVEL = ffmpeg_loglevel(args)
+    video_encode = video_encode_options(args.encoder, args.preset, args.crf, args.threads)
+    workshop_title = None
+    workshop_description = None
+    options_ffmpeg_global = [ ]
+    all_inputs = set()
+    errors = [ ]
+
+    #
+    # For each output file
+    #
+    outputs = [ ]
+    input0 = args.input
+    for segment in data:
+        #print(segment)
+
+        segments = [ ]
+        TOC = [ ]
+        segment_list = [ ]
+        cumulative_time = 0
+        filters = [ ]
+        covers = [ ]
+        options_ffmpeg_output = [ ]
+        output_filters = [ ]
+        layout = None
+
+        # Find input
+        if 'input' in segment:
+            input0 = segment['input']
+        if 'workshop_description' in segment:
+            workshop_description = segment['workshop_description'].strip()
+        if 'workshop_title' in segment:
+            workshop_title = segment['workshop_title']
+        if 'crop' in segment:
+            # -filter:v "crop=w:h:x:y"    - x:y is top-left corner
+            options_ffmpeg_output.extend(generate_crop(**segment['crop']))
+            output_filters.append(options_ffmpeg_output[-1])
+        if 'layout' in segment:
+            # Screen share and camera crops and overlay, done in the
+            # segment's own filtergraph (after covers)
+            if 'crop' in segment:
+                raise EditlistError(f"{segment.get('output')}: can't use both crop and layout")
+            layout = segment['layout']
+        if 'schedule-sync' in segment:
+            schedule.sync(*segment['schedule-sync'].split('='))
+
+
+
+        if 'output' not in segment:
+            continue
+        allow_reencode = segment.get('reencode', True)
+        # Exclude non-matching files if '--limit' specified.
+        if args.limit and not any(limit_match in segment['output'] for limit_match in args.limit):
+            continue
+        if args.list:
+            print(segment['output'])
+            continue
+        input1 = input0
+        editlist = segment.get('editlist', segment.get('time'))
+        if editlist is None:
+            continue
+
+        #
+        # For each segment in the output
+        #
+        options_ffmpeg_segment = [ ]
+        cover_windows = [ ]
+        segment_type = 'video'
+        segment_number = 0
+        for i, command in enumerate(editlist):
+            # Backwards compatibility with old 'begin' and 'end' commands
+            if 'begin' in command:
+                command['start'] = command['begin']
+                del command['begin']
+            for stop_alias in ['end', 'break', 'lunch', 'exercise']:
+                if stop_alias in command:
+                    command['stop'] = command[stop_alias]
+                    del command[stop_alias]
+                    break
+            else:
+                stop_alias = 'stop'
+            #
+
+            # Is this a command to cover a part of the video?
+            if isinstance(command, dict) and 'cover' in command:
+                cover = command['cover']
+                covers.append((segment_number, seconds(cover['begin']), seconds(cover['end'])))
+                cover_windows.append((seconds(cover['begin']), seconds(cover['end'])))
+                filters.append(generate_cover(**cover))
+                continue
+            # Input command: change input files
+            elif isinstance(command, dict) and 'input' in command:
+                input1 = command['input']
+                # Handle png images
+                if 'duration' in command:
+                    start = 0
+                    stop = seconds(command['duration'])
+                    segment_type = 'image'
+                    segment_number += 1
+                else:
+                    continue
+            # Start command: start a segment
+            elif isinstance(command, dict) and 'start' in command:
+                start = command['start']
+                schedule(start, f"START" + (f" **{segment['title']}**" if segment_number == 0 and 'title' in segment else ""))
+                segment_number += 1
+                continue
+            # End command: process this segment and all queued commands
+            elif isinstance(command, dict) and 'stop' in command:
+                stop = command['stop']
+                schedule(stop, stop_alias.upper())
+                # Continue below to process this segment
+            # Is this a TOC entry?
+            # If it's a dict, it is a table of contents entry that will be
+            # mapped to the correct time in the procesed video.
+            # This is a TOC entry
+            elif isinstance(command, dict):
+                ( (time, title), ) = list(command.items())
+                if time == '-':
+                    time = start
+                if title in {'stop', 'start', 'begin', 'end', 'cover', 'input'}:
+                    raise EditlistError(f"Suspicious TOC entry name, aborting encoding: {title}")
+                #print(start, title)
+                #print('TOC', start, title, segment)
+                TOC.append((segment_number, seconds(time), title))
+
+                if '§' in title:
+                    schedule(time, f'. **{title}**')
+                else:
+                    schedule(time, f'. . {title}')
+                continue
+
+
+            # The end of our time segment (from 'start' to 'stop').  Do the
+            # actual processing of this segment now.
+            else:
+                # time can be string with comma or list
+                time = command
+                if isinstance(time, str):
+                    time = time.split(',')
+                if len(time) == 2:
+                    start, stop = time
+                elif len(time) == 3:
+                    input1, start, stop = time
+            start = str(start).strip()
+            stop = str(stop).strip()
+
+            # Print status
+            LOG.info("\n\nBeginning %s (line %d)", segment.get('title') if 'title' in segment else '[no title]', i)
+
+            # Find input file
+            local_input = os.path.join(base_dir or '', os.path.expanduser(input1))
+            if os.path.exists(local_input):
+                input1 = local_input
+            else:
+                input1 = args.input / input1
+                input1 = os.path.expanduser(input1)
+            all_inputs.add(input1)
+            if not os.path.exists(input1):
+                if args.dry_run or args.metadata_only:
+                    LOG.warning("Input not found: %s", input1)
+                else:
+                    raise EditlistError(f"input not found: {input1}")
+
+
+            segment_list.append([segment_number, seconds(start), cumulative_time])
+            segment_list.append([segment_number, seconds(stop), None])
+            start_cumulative = cumulative_time
+            cumulative_time += seconds(stop) - seconds(start)
+            # filters
+            if layout and segment_type == 'video':
+                filters.append(generate_layout(**layout, label=segment_number))
+            segment_filters = filters + output_filters
+            if filters:
+                filters = ['-vf', ','.join(filters)]
+            # Encode for video, image, etc?
+            reencode = (args.reencode or args.smart_cut or args.single_pass) and allow_reencode
+            parts = None
+            splice_encode = [ ]
+            if segment_type == 'video':
+                encoding_args = ['-i', input1,
+                                 '-ss', start, '-to', stop,
+                                 *(video_encode if reencode or filters else FFMPEG_VIDEO_COPY),
+                                 *FFMPEG_AUDIO_COPY,
+                                 ]
+                if seconds(start) > seconds(stop):
+                    raise RuntimeError(f"start is greater than stop time ({start} > {stop} time in {segment.get('title')}")
+                # Covers only need the GOPs around them re-encoded,
+                # unless everything is re-encoded anyway (or cropped).
+                if (cover_windows and (args.smart_cut or not reencode) and not options_ffmpeg_output
+                    and not layout and not args.single_pass and os.path.exists(input1)):
+                    try:
+                        splice_encode = splice_options(probe.info(input1), video_encode)
+                        parts = cover_parts(probe.keyframes(input1), seconds(start), seconds(stop),
+                                            cover_windows, reencode_ends=args.smart_cut and reencode)
+                    except (OSError, subprocess.CalledProcessError, ValueError) as exc:
+                        LOG.warning("%s: can't copy around the covers of %s, re-encoding all of %s-%s: %s",
+                                    segment['output'], input1, start, stop, exc)
+                # Smart cut: only re-encode up to the first and from the
+                # last keyframe.  Not possible with crop.
+                # The re-encoded parts must match the copied ones, or
+                # the whole segment is re-encoded.
+                elif (args.smart_cut and reencode and not filters and not options_ffmpeg_output
+                    and not args.single_pass and os.path.exists(input1)):
+                    try:
+                        splice_encode = splice_options(probe.info(input1), video_encode)
+                        parts = smart_cut_parts(probe.keyframes(input1), seconds(start), seconds(stop))
+                    except (OSError, subprocess.CalledProcessError, ValueError) as exc:
+                        LOG.warning("%s: can't smart cut %s, re-encoding all of %s-%s: %s",
+                                    segment['output'], input1, start, stop, exc)
+            elif segment_type == 'image':
+                # https://trac.ffmpeg.org/wiki/Slideshow
+                encoding_args = ['-loop', '1',
+                                 '-i', input1,
+                                 '-t', str(command['duration']),
+                                 '-vf', f'fps={FFMPEG_FRAMERATE},format=yuv420p',
+                                 '-c:v', 'libx264', ]#'-r', str(FFMPEG_FRAMERATE)]
+            else:
+                raise RuntimeError(f"unknown segment_type: {segment_type}")
+
+            # Subtitles?
+            sub_file = None
+            if args.srt:
+                sub_file = os.path.splitext(input1)[0] + '.srt'
+                if not os.path.exists(sub_file):
+                    if args.dry_run:
+                        LOG.warning("Subtitle file not found: %s", sub_file)
+                    else:
+                        raise EditlistError(f"subtitle file not found: {sub_file}")
+
+            if not parts:
+                parts = [(seconds(start), seconds(stop), None)]
+            for j, (part_start, part_stop, part_reencode) in enumerate(parts):
+                # Encoding command (the output is added by the executor)
+                if part_reencode is None:
+                    tmp_out = 'tmpout-%02d.mkv'%i
+                    cmd = ['ffmpeg', '-loglevel', str(LOGLEVEL),
+                           *encoding_args,
+                           *options_ffmpeg_output,
+                           *options_ffmpeg_segment,
+                           *filters,
+                           ]
+                else:
+                    # Smart cut or cover part.  The cover filters use
+                    # input times, so they work in any part.
+                    tmp_out = 'tmpout-%02d-%d.mkv'%(i, j)
+                    cmd = ['ffmpeg', '-loglevel', str(LOGLEVEL),
+                           '-i', input1,
+                           '-ss', str(part_start), '-to', str(part_stop),
+                           *(video_encode + splice_encode if part_reencode else FFMPEG_VIDEO_COPY),
+                           *FFMPEG_AUDIO_COPY,
+                           *(filters if part_reencode else [ ]),
+                           ]
+                LOG.info(shell_join(cmd + [tmp_out]))
+
+                seg = SegmentPlan(
+                    number=segment_number,
+                    type=segment_type,
+                    input=str(input1),
+                    start=part_start,
+                    stop=part_stop,
+                    output_start=start_cumulative + part_start - seconds(start),
+                    cmd=cmd,
+                    filename=tmp_out,
+                    subtitles=sub_file,
+                    filters=segment_filters if part_reencode is not False else [ ],
+                    )
+                # Long re-encoded segments are encoded in chunks
+                if (args.chunk_seconds and segment_type == 'video' and part_reencode is None
+                    and (reencode or filters) and not args.single_pass
+                    and part_stop - part_start > args.chunk_seconds
+                    and os.path.exists(input1)):
+                    seg.chunks = chunk_segment(seg, probe.keyframes(input1), args.chunk_seconds,
+                                               LOGLEVEL, video_encode)
+                    for chunk in seg.chunks:
+                        LOG.info(shell_join(chunk.cmd + [chunk.filename]))
+                segments.append(seg)
+
+            # Reset for the next round
+            filters = [ ]
+            options_ffmpeg_segment = [ ]
+            cover_windows = [ ]
+            segment_type = 'video'
+
+        output_raw = args.output / segment['output']
+        output_raw = output_raw.parent / 'tmp' / output_raw.name
+        output = args.output / segment['output']
+
+        # Create the video properties/chapters/etc.
+        video_description = [ ]
+        title = None
+        if segment.get('title'):
+            title = segment['title']
+            if workshop_title is not None:
+                title = title + ' - ' + workshop_title
+
+            video_description.extend([title.strip()])
+        if segment.get('description'):
+            video_description.extend([segment['description'].strip().replace('\n', '\n\n')])
+        # Map the table of contents and covers to output times
+        time_map = TimeMap(segment_list)
+        toc = [ ]
+        for seg_n, time, name in TOC:
+            LOG.debug("TOC entry %s %s", time, name)
+            try:
+                toc.append((time_map.to_output(seg_n, time, what=f'TOC entry {name!r}'), name))
+            except TimeMappingError as exc:
+                errors.append(f"{segment['output']}: {exc}")
+        output_covers = [ ]
+        for seg_n, time, end in covers:
+            try:
+                output_covers.append(time_map.to_output(seg_n, time, what='cover'))
+                # It would be cut short at the end of the segment
+                time_map.to_output(seg_n, end, what='cover end', end=True)
+            except TimeMappingError as exc:
+                errors.append(f"{segment['output']}: {exc}")
+        if toc:
+            video_description.append('\n'.join(f"{humantime(new_time)} {name}" for new_time, name in toc))
+
+        if workshop_description:
+            video_description.append('-----')
+            video_description.append(workshop_description.replace('\n', '\n\n').strip())
+
+        single_pass_cmd = None
+        if args.single_pass and allow_reencode:
+            # Images aren't laid out, they are already the screen's size
+            frame_size = (layout['screen']['w'], layout['screen']['h']) if layout else None
+            single_pass_cmd = single_pass_command(segments, LOGLEVEL, video_encode, probe, frame_size)
+            LOG.info(shell_join(single_pass_cmd))
+
+        outputs.append(OutputPlan(
+            name=segment['output'],
+            output=output,
+            output_raw=output_raw,
+            segments=segments,
+            segment_list=segment_list,
+            title=title,
+            description='\n\n'.join(video_description) if video_description else None,
+            toc=toc,
+            covers=output_covers,
+            srt_output=Path(os.path.splitext(output)[0] + '.srt') if args.srt else None,
+            cmd=single_pass_cmd,
+            ))
+        if args.normalize and probe is not None:
+            normalize_output(outputs[-1], probe, LOGLEVEL, video_encode, reencode=allow_reencode)
+
+    mark_shared_segments(outputs)
+    errors.extend(check_paths(outputs))
+    return EditPlan(outputs=outputs, inputs=sorted(str(x) for x in all_inputs), errors=errors)
+
+
+def mark_shared_segments(outputs):
+    """Find segments that are the same in several places in a run.
+
+    Bumpers, title cards, and intros are often in many outputs: those
+    with the same command (input, start/stop or duration, filters,
+    encoder options) get SegmentPlan.shared set, and the executors
+    encode them once and link the result to the others.  Chunked
+    segments are left alone (they are joined in place).
+    """
+    places = collections.defaultdict(list)
+    for out in outputs:
+        for seg in out.segments:
+            if not seg.chunks and not out.cmd:
+                places[segment_key(seg.cmd)].append(seg)
+    for key, segs in places.items():
+        if len(segs) > 1:
+            LOG.info("Segment of %s %s-%s is used %d times, encoding it once",
+                     segs[0].input, humantime(segs[0].start), humantime(segs[0].stop), len(segs))
+            for seg in segs:
+                seg.shared = key
+
+
+def stream_params(info):
+    """The parameters of a file that must match for concat -c copy.
+
+    info is ffprobe output (MediaProbe.info()).  Returns (video, audio),
+    dicts of the first stream of each type (None if there is none).
+    """
+    video = audio = None
+    for stream in info.get('streams', [ ]):
+        if stream.get('codec_type') == 'video' and video is None \
+              and stream.get('disposition', {}).get('attached_pic') != 1:
+            video = {key: stream.get(key) for key in
+                     ('codec_name', 'profile', 'width', 'height', 'pix_fmt', 'r_frame_rate')}
+        elif stream.get('codec_type') == 'audio' and audio is None:
+            audio = {key: stream.get(key) for key in
+                     ('codec_name', 'sample_rate', 'channels', 'channel_layout')}
+    return video, audio
+def test_stream_params():
+    info = {'streams': [
+        {'codec_type': 'video', 'codec_name': 'h264', 'profile': 'Main', 'width': 840, 'height': 1080,
+         'pix_fmt': 'yuv420p', 'r_frame_rate': '30/1'},
+        {'codec_type': 'audio', 'codec_name': 'aac', 'sample_rate': '48000', 'channels': 1,
+         'channel_layout': 'mono'}]}
+    video, audio = stream_params(info)
+    assert video['width'] == 840 and video['r_frame_rate'] == '30/1'
+    assert audio == {'codec_name': 'aac', 'sample_rate': '48000', 'channels': 1, 'channel_layout': 'mono'}
+    assert stream_params({'streams': []}) == (None, None)
+
+
+def normalize_output(out, probe, loglevel, video_encode, reencode=True):
+    """Make the segments of an output concatenable without re-encoding.
+
+    The concat at the end (-c copy) needs all segments to have the same
+    stream parameters.  The target is the input that most of the
+    output's video comes from.  Segments that won't match it (images,
+    other inputs with a different size, frame rate, pixel format,
+    codec, or audio) get a new command that re-encodes them to it:
+    scaled and padded to its frame size, at its frame rate and pixel
+    format (and H.264 profile), with its audio codec, sample rate and
+    channels (silence for images).  The rest stays as it is.  Outputs
+    with crop or layout, --single-pass, or chunked segments are left
+    alone, and so are those that may not be re-encoded (reencode:
+    false), with a warning if they don't match.
+    """
+    if out.cmd or any(seg.chunks or any('crop=' in f for f in seg.filters)
+                      for seg in out.segments):
+        return
+    params = { }
+    duration = collections.Counter()
+    for seg in out.segments:
+        if seg.type == 'image' or seg.input in params or not os.path.exists(seg.input):
+            continue
+        try:
+            params[seg.input] = stream_params(probe.info(seg.input))
+        except (OSError, subprocess.CalledProcessError, ValueError) as exc:
+            LOG.warning("Could not probe %s: %s", seg.input, exc)
+            return
+    for seg in out.segments:
+        if seg.input in params and params[seg.input][0]:
+            duration[seg.input] += seg.stop - seg.start
+    if not duration:
+        return
+    target_input = duration.most_common(1)[0][0]
+    video, audio = params[target_input]
+    video_size = {key: video[key] for key in ('width', 'height', 'pix_fmt', 'r_frame_rate')}
+
+    encoder_codec = {enc['codec']: enc['codec_name'] for enc in ENCODERS.values()}.get(
+        video_encode[video_encode.index('-c:v')+1])
+    if encoder_codec != video['codec_name']:
+        LOG.warning("%s: %s is %s, which --encoder doesn't make: segments that need re-encoding "
+                    "won't join seamlessly", out.name, target_input, video['codec_name'])
+    profile = [ ]
+    if encoder_codec == 'h264' and video['codec_name'] == 'h264' and video['profile'] in X264_PROFILES:
+        profile = ['-profile:v', X264_PROFILES[video['profile']]]
+    w, h = video['width'], video['height']
+    vfilters = [f'scale={w}:{h}:force_original_aspect_ratio=decrease', f'pad={w}:{h}:(ow-iw)/2:(oh-ih)/2',
+                'setsar=1', f"fps={video['r_frame_rate']}", f"format={video['pix_fmt']}"]
+    audio_encode = [ ]
+    if audio:
+        audio_encode = ['-c:a', AUDIO_ENCODERS.get(audio['codec_name'], 'aac'),
+                        '-ar', str(audio['sample_rate']), '-ac', str(audio['channels'])]
+
+    mismatched = [ ]
+    for seg in out.segments:
+        if seg.type == 'image':
+            layout = audio and (audio['channel_layout'] or f"{audio['channels']}c")
+            cmd = ['ffmpeg', '-loglevel', str(loglevel),
+                   '-loop', '1', '-i', seg.input,
+                   *(['-f', 'lavfi', '-i', f"anullsrc=r={audio['sample_rate']}:cl={layout}",
+                      '-map', '0:v', '-map', '1:a'] if audio else [ ]),
+                   '-t', str(seg.stop - seg.start),
+                   *video_encode, *profile, '-vf', ','.join(vfilters),
+                   *audio_encode]
+        elif seg.input in params:
+            seg_video, seg_audio = params[seg.input]
+            if seg_video is None:
+                continue
+            # Copied video must match exactly, re-encoded only in size.
+            copied = FFMPEG_VIDEO_COPY[0] in seg.cmd
+            video_ok = ({key: seg_video[key] for key in video_size} == video_size
+                        and (not copied or seg_video == video))
+            audio_ok = seg_audio == audio
+            if video_ok and audio_ok:
+                continue
+            cmd = ['ffmpeg', '-loglevel', str(loglevel),
+                   '-i', seg.input,
+                   '-ss', str(seg.start), '-to', str(seg.stop),
+                   *video_encode, *profile, '-vf', ','.join([*seg.filters, *vfilters]),
+                   *(FFMPEG_AUDIO_COPY if audio_ok else audio_encode)]
+        else:
+            continue
+        if not reencode:
+            mismatched.append(seg)
+            continue
+        seg.cmd = cmd
+        LOG.info("%s: re-encoding %s %s-%s to match %s", out.name, seg.input,
+                 humantime(seg.start), humantime(seg.stop), target_input)
+        LOG.info(shell_join(seg.cmd + [seg.filename]))
+    if mismatched:
+        LOG.warning("%s: %d segments don't match %s, but are joined as they are because of "
+                    "reencode: false", out.name, len(mismatched), target_input)
+
+
+def check_paths(outputs):
+    """Check that no two outputs write the same file, and none writes an input.
+
+    The files of an output are the output, its raw copy in tmp/, and
+    the .info.txt and .srt next to it.  Paths are compared after
+    resolving symlinks and .., and existing files by inode, so aliases
+    (and hard links) are found too.  Returns a list of errors.
+    """
+    def resolve(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return os.path.normcase(os.path.realpath(path))
+        return (st.st_dev, st.st_ino)
+    inputs = { }
+    for out in outputs:
+        for seg in out.segments:
+            for path in (seg.input, seg.subtitles):
+                if path:
+                    inputs.setdefault(resolve(path), path)
+    errors = [ ]
+    writers = { }
+    for out in outputs:
+        files = [out.output, out.output_raw]
+        if out.description:
+            files.append(description_file(out))
+        if out.srt_output:
+            files.append(out.srt_output)
+        for path in files:
+            key = resolve(path)
+            if key in inputs:
+                errors.append(f"{out.name}: {path} is also an input ({inputs[key]})")
+            elif writers.get(key, out) is not out:
+                errors.append(f"{out.name}: {path} is also written by {writers[key].name}")
+            writers.setdefault(key, out)
+    return errors
+def test_check_paths(tmp_path):
+    def out(name, input):
+        seg = SegmentPlan(number=1, type='video', input=str(input), start=0, stop=1, output_start=0,
+                          cmd=[], filename='tmpout-00.mkv')
+        output = tmp_path/name
+        return OutputPlan(name=name, output=output, output_raw=output.parent/'tmp'/output.name,
+                          segments=[seg], segment_list=[], description='text')
+    (tmp_path/'in.mkv').write_text('')
+    (tmp_path/'link').symlink_to(tmp_path)
+    assert check_paths([out('a.mkv', tmp_path/'in.mkv'), out('b.mkv', tmp_path/'in.mkv')]) == [ ]
+    # The same output twice, also through a symlink
+    assert len(check_paths([out('a.mkv', tmp_path/'in.mkv'), out('link/a.mkv', tmp_path/'in.mkv')])) == 3
+    # .info.txt of different outputs
+    assert len(check_paths([out('a.mkv', tmp_path/'in.mkv'), out('a.mp4', tmp_path/'in.mkv')])) == 1
+    # Output is the input
+    assert len(check_paths([out('link/in.mkv', tmp_path/'in.mkv')])) == 1
+
+
+def check_times(plan, probe, strict=False):
+    """Check segment times against the real input durations.
+
+    Returns a list of error messages.  A start time past the end of
+    the input is always an error.  A stop time past the end is only an
+    error if strict (--check), otherwise it is a warning, since ffmpeg
+    just stops at the end of the file (but the table of contents and
+    subtitles of later segments will be shifted).  Covers and TOC
+    entries must be inside their segments, which build_plan() already
+    checks (see EditPlan.errors).
+    """
+    errors = [ ]
+    for out in plan.outputs:
+        for seg in out.segments:
+            if seg.type != 'video' or not os.path.exists(seg.input):
+                continue
+            try:
+                duration = probe.duration(seg.input)
+            except (OSError, subprocess.CalledProcessError) as exc:
+                LOG.warning("Could not probe %s: %s", seg.input, exc)
+                continue
+            if duration is None:
+                continue
+            where = f"{out.name}: segment {humantime(seg.start)}-{humantime(seg.stop)} of {seg.input}"
+            if seg.start >= duration:
+                errors.append(f"{where} starts after the end of the input ({humantime(duration)})")
+            elif seg.stop > duration + 0.01:
+                msg = f"{where} stops after the end of the input ({humantime(duration)})"
+                if strict:
+                    errors.append(msg)
+                else:
+                    LOG.warning("%s", msg)
+    return errors
+
+
+def make_parser():
+    """The command line argument parser."""
     parser = argparse.ArgumentParser()
-    parser.add_argument('editlist')
-    parser.add_argument('input', type=Path,
+    parser.add_argument('editlist', nargs='?')
+    parser.add_argument('input', type=Path, nargs='?',
                         help="Input file or directory of files.")
     parser.add_argument('--output', '-o', default='.', type=Path,
                         help='Output directory')
@@ -246,48 +2802,144 @@ def main(argv=sys.argv[1:]):
     parser.add_argument('--limit', '-l', action='append',
                         help='Limit to only outputs matching this pattern.  There is no wildcarding.  This option can be given multiple times.')
     parser.add_argument('--check', '-c', action='store_true',
-                        help="Don't encode or generate output files, just check consistency of the YAML file.  This *will* override the .info.txt output file.  If the temporary encoded intermediate file exists, DO update the final .mkv file with subtitles/descriptions/etc.")
+                        help="Don't encode or generate output files, just check consistency of the YAML file, including that all segments are within their input files (using ffprobe, cached).  This *will* override the .info.txt output file.  If the temporary encoded intermediate file exists, DO update the final .mkv file with subtitles/descriptions/etc.")
     parser.add_argument('--force', '-f', action='store_true',
                         help='Overwrite existing output files without prompting')
+    parser.add_argument('--metadata-only', action='store_true',
+                        help="Only update the title, chapters, and description of the existing outputs in place "
+                             "(with mkvpropedit, no video is copied or remuxed), and the .info.txt files, and "
+                             "print which outputs changed.  The inputs don't need to be present.  With --srt, the "
+                             ".srt files are updated, but not subtitles embedded in the mkv.")
     parser.add_argument('--dry-run', action='store_true',
-                        help="Dry run, don't make any new files or changes (command not fully developed yet)")
+                        help="Dry run: plan everything (see --plan-json), but don't run ffmpeg or make any new files or changes.  Missing inputs are only warned about.")
     parser.add_argument('--verbose', '-v', action='store_true',
                         help='Verbose (put ffmpeg in normal mode, otherwise ffmpeg is quiet.)')
     parser.add_argument('--quiet', '-q', action='store_true',
                         help="Don't output as much")
+    parser.add_argument('--progress', '-p', action='store_true',
+                        help='Show a progress bar with speed and ETA of the encoding (on stderr).')
+    parser.add_argument('--progress-json', type=Path,
+                        help="Write encoding progress as JSON lines to this file ('-' for stdout): "
+                             "time, output, segment, out_time, duration, fps, speed, fractions done, ETA.")
 
     parser.add_argument('--reencode', action='store_true',
                         help='Re-encode all segments of the video.  See --preset and --crf to adjust parameters.'
                              'This is needed when you start a snipet in the middle of a video, since the video decoding '
                              'can only begin at a key frame.  '
                              'Default false.')
+    parser.add_argument('--smart-cut', action='store_true',
+                        help='Like --reencode, but only re-encode from each segment start to the next keyframe '
+                             'and from the last keyframe to the segment stop, and stream-copy everything in between.  '
+                             'Much faster for long segments.  Covers only re-encode the GOPs around them, segments '
+                             'with crop are still fully re-encoded.  '
+                             'The input should be H.264 for the parts to join seamlessly.  Needs ffprobe.')
+    parser.add_argument('--single-pass', action='store_true',
+                        help='Like --reencode, but cut, cover/crop and join each output in one ffmpeg run with a '
+                             'filtergraph, without intermediate segment files.  All segments must have the same '
+                             'frame size.  Outputs with "reencode: false" are handled as usual.')
+    parser.add_argument('--chunk-seconds', type=float,
+                        help='Encode re-encoded video segments longer than this many seconds in chunks of about '
+                             'this length (split at keyframes if possible), which run in parallel with --jobs.  '
+                             'Use this with --jobs and a lower --threads when single ffmpegs don\'t use all '
+                             'cores.  Covers and crop are applied to each chunk.  Needs ffprobe.')
+    parser.add_argument('--decode-once', action='store_true',
+                        help='Cut all segments of all outputs that come from the same input with one ffmpeg, '
+                             'which reads the input only once (from the start to the last segment\'s stop), '
+                             'instead of one ffmpeg per segment.  Useful when many outputs are cut from one long '
+                             'recording on slow storage.  --chunk-seconds chunks and --single-pass outputs (which '
+                             'seek in the input) and images are still done separately.')
+    parser.add_argument('--no-normalize', action='store_false', default=True, dest='normalize',
+                        help="Don't re-encode images and segments from other inputs to match the main input "
+                             "of each output (frame size, frame rate, pixel format, codec, audio), which "
+                             "is needed to join them without re-encoding everything.")
     parser.add_argument('--crf', default=20, type=int,
                         help='x264 crf (preceived quality) to use for re-encoding, lower is higher quality.  '
                              'Reasonable options are 20 (extremely good) to 30 (lower quality) (the absolute range 1 - 51); '
                              'higher numbers take less time to encode.'
                              'Default is 20, which should be good enough for any purpose.')
-    parser.add_argument('--preset', default='veryslow',
+    parser.add_argument('--preset',
                         help='x264 preset to use for re-encoding, basically the encoding speed.  '
                              'Changing this affects how much time it will take to compress to get the --crf quality target '
                              'you request; slower=better compression by using more expensive codec features.  '
                              'Example options you might use include veryslow, slow, medium, fast, and ultrafast.  '
-                             'Default is veryslow, use ultrafast for fast testing.')
+                             'Default is veryslow, use ultrafast for fast testing.  '
+                             '(For svtav1, presets are numbers 0-13, default 6.)')
+    parser.add_argument('--encoder', default='x264', choices=list(ENCODERS),
+                        help='Video encoder for re-encoding.  --crf is adjusted to give similar quality.  Default x264.')
+    parser.add_argument('--calibrate', action='store_true',
+                        help='Instead of processing, encode a sample of the first video segment with several '
+                             'encoders/presets available in the local ffmpeg, and print the speed, size, and '
+                             'quality (SSIM, PSNR) of each.  The results are saved for --realtime.')
+    parser.add_argument('--calibrate-seconds', type=float, default=20,
+                        help='Length of the --calibrate sample, default 20 seconds.')
+    parser.add_argument('--realtime', type=float,
+                        help='Use the best quality --encoder/--preset from the last --calibrate that encodes within '
+                             'this many times the video duration (e.g. 1 = one hour per hour of video).')
     parser.add_argument('--threads', type=int,
                         help='Number of encoding threads.  Default: unset, autodetect')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='Number of ffmpeg segment encodes to run in parallel, across all outputs.  '
+                             'Each output is finalized once its own segments are done.  '
+                             'Consider lowering --threads when using this.  Default 1 (serial).')
+    parser.add_argument('--cache-dir', type=Path,
+                        help='Keep encoded segments in this directory and re-use them in later runs if the input '
+                             'file, start/stop times, covers/crop, and encoding options are unchanged.  '
+                             'Useful when only titles or TOC entries changed.  Default: no cache.')
+    parser.add_argument('--cache-size', type=float, default=50,
+                        help='Maximum size of --cache-dir in GiB, least recently used segments are removed first.  '
+                             'Default 50.')
+    parser.add_argument('--resume', action='store_true',
+                        help='Keep the encoded segments of each output in tmp/NAME.work/ next to the outputs until '
+                             'the output is finished, so that after an interrupted or failed run, running again '
+                             'with --resume only encodes the missing segments.')
+    parser.add_argument('--no-stdin', action='store_true',
+                        help="Don't let ffmpeg read from the terminal (for running in the background).  "
+                             "Always the case with --jobs and for --serve jobs.")
     parser.add_argument('--wait', action='store_true',
                         help='Wait after each encoding (don\'t clean up the temporary directory right away')
+    parser.add_argument('--no-keep-raw', action='store_false', default=True, dest='keep_raw',
+                        help="Don't keep the raw joined video (without subtitles/title/chapters) in a tmp/ "
+                             "directory next to the outputs.  Saves a copy of each video, but --check can then not "
+                             "update the final files.")
     parser.add_argument('--no-mkv-props', action='store_false', default=True, dest='mkv_props',
                         help="Don't try to encode extra properties into the mkv file.  This requires mkvtoolnix to be installed")
     parser.add_argument('--list', action='store_true',
                         help="Don't do anything, just list all outputs that would be processed (and nothing else)")
+    parser.add_argument('--plan-json', type=Path,
+                        help="Write the compiled plan (outputs, segments, ffmpeg commands, TOC, covers) as JSON "
+                             "to this file ('-' for stdout).  Combine with --dry-run to only plan.")
     parser.add_argument('--show-schedule', action='store_true',
                         help="Translate timestamps to real schedule time.  Have a '- schedule-sync: 00:15:25=9:00:00' at the top level of the editlist file after each input.")
+    parser.add_argument('--rebuild', action='store_true',
+                        help=f'Rebuild all outputs.  By default, outputs whose cuts, inputs, and metadata are '
+                             f'unchanged since the last run (recorded in {BuildManifest.FILENAME} in the '
+                             f'output directory) are skipped, and if only the metadata changed, only it is updated.')
+    parser.add_argument('--profile', action='store_true',
+                        help='At the end, print how much time (and bytes written) each stage took: parsing, '
+                             'planning, segment encodes, concat, copies, mkvmerge/mkvpropedit, ...')
+    parser.add_argument('--trace', type=Path,
+                        help='Write the timing of all stages as a Chrome trace JSON file '
+                             '(view in chrome://tracing or https://ui.perfetto.dev).')
+    parser.add_argument('--serve', type=Path, metavar='SPOOL',
+                        help='Run as a service: run the jobs submitted to the SPOOL directory (see --submit), '
+                             'sharing --jobs segment encoders fairly between them.  Jobs that were running when '
+                             'the service stopped are resumed (finished outputs are skipped).')
+    parser.add_argument('--submit', type=Path, metavar='SPOOL',
+                        help='Instead of processing, submit this command line as a job to a --serve service.')
+    parser.add_argument('--status', type=Path, metavar='SPOOL',
+                        help='Print the state of the jobs in a --serve SPOOL directory.')
     parser.add_argument('--template-single', action='store_true',
                         help="Print out template for a single video, don't do anything else.")
     parser.add_argument('--template-workshop', action='store_true',
                         help="Print out template for a workshop, don't do anything else.")
     parser.add_argument('--literal-editlist', action='store_true',
                         help="Instead of the editlist argument being a file, it is literal YAML to be parsed.")
+    return parser
+
+
+def main(argv=sys.argv[1:]):
+    logging.basicConfig(level=logging.DEBUG)
+    parser = make_parser()
     args = parser.parse_args(argv)
 
     # Printing out templates
@@ -298,389 +2950,562 @@ def main(argv=sys.argv[1:]):
         print(template_workshop)
         sys.exit(0)
 
-    if args.threads:
-        FFMPEG_VIDEO_ENCODE.extend(['-threads', str(args.threads)])
-    FFMPEG_VIDEO_ENCODE.extend(['-preset', args.preset])
-    FFMPEG_VIDEO_ENCODE.extend(['-crf', str(args.crf)])
-
-    if args.show_schedule:
-        args.dry_run = True
-        args.quiet = True
-        args.check = True
+    # Service mode
+    if args.serve:
+        serve(args.serve, workers=args.jobs)
+        return
+    if args.status:
+        print_spool_status(args.status)
+        return
+    if args.editlist is None or args.input is None:
+        parser.error('the following arguments are required: editlist, input')
+    if args.submit:
+        print(Spool(args.submit).submit(argv, os.getcwd()))
+        return
 
-    if args.srt:
-        import srt
+    if args.quiet or args.show_schedule:
+        LOG.setLevel(40)
+    try:
+        run(args)
+    except EditlistError as exc:
+        for error in exc.errors:
+            LOG.error("%s", error)
+        sys.exit(1)
 
-    all_inputs = set()
 
-    # Open the input file.  Parse out of markdown if it is markdown:
-    if args.literal_editlist:
-        data = args.editlist
+def run_calibration(plan, args, probe):
+    """--calibrate: benchmark encoders on a sample of the first video segment."""
+    for out in plan.outputs:
+        segs = [seg for seg in out.segments if seg.type == 'video']
+        if segs:
+            seg = segs[0]
+            break
     else:
-        data = open(args.editlist).read()
+        raise EditlistError("--calibrate: no video segments")
+    length = min(args.calibrate_seconds, seg.stop - seg.start)
+    start = seg.start + (seg.stop - seg.start - length) / 2
+    print(f"Calibrating on {length:.0f}s of {seg.input} from {humantime(start)}, --crf={args.crf}:")
+    results = calibrate(seg.input, start, length, args, probe=probe)
+    print(f"{'encoder':<8} {'preset':<10} {'speed':>7} {'fps':>7} {'MB/min':>7} {'SSIM':>7} {'PSNR':>6}")
+    for r in results:
+        print(f"{r['encoder']:<8} {r['preset']:<10} {r['speed']:>6.2f}x {r['fps'] or 0:>7.1f} "
+              f"{r['mb_per_min']:>7.1f} {r['ssim'] or 0:>7.4f} {r['psnr'] or 0:>6.2f}")
+    calibration_file = default_cache_dir()/'calibration.json'
+    os.makedirs(calibration_file.parent, exist_ok=True)
+    with atomic_write(calibration_file, 'w') as tmp:
+        open(tmp, 'w').write(json.dumps(results, indent=1))
+    if args.realtime:
+        profile = choose_profile(results, args.realtime)
+        if profile is None:
+            print(f"Nothing encodes within {args.realtime}x realtime.")
+        else:
+            print(f"Best within {args.realtime}x realtime: --encoder={profile['encoder']} --preset={profile['preset']}")
+
+
+def parse_editlist(data):
+    """Parse editlist YAML.  Parse out of markdown if it is markdown."""
     if '```' in data:
         matches = re.findall(r'`{3,}[^\n]*\n(.*?)\n`{3,}', data, re.MULTILINE|re.DOTALL)
         #print(matches)
         data = '\n'.join([m for m in matches])
         #print(data)
-    data = yaml.safe_load(data)
+    return yaml.safe_load(data)
 
-    schedule = SchedulePrinter(args.show_schedule)
 
-    PWD = Path(os.getcwd())
-    LOGLEVEL = 31
-    if args.verbose:
-        LOGLEVEL = 40
-    if args.quiet:
-        LOG.setLevel(40)
-    workshop_title = None
-    workshop_description = None
-    options_ffmpeg_global = [ ]
+def make_plan(args, base_dir=None):
+    """Parse the editlist and plan it.
 
-    #
-    # For each output file
-    #
-    input0 = args.input
-    for segment in data:
-        #print(segment)
+    Returns (plan, probe).  base_dir is passed on to build_plan().  Raises EditlistError if the plan has
+    errors.  args.editlist can also be the already parsed editlist.
+    """
+    if args.realtime and not args.calibrate:
+        calibration_file = default_cache_dir()/'calibration.json'
+        if not calibration_file.exists():
+            raise EditlistError("--realtime needs a previous --calibrate run")
+        profile = choose_profile(json.loads(calibration_file.read_text()), args.realtime)
+        if profile is None:
+            raise EditlistError(f"No calibrated encoder is fast enough for --realtime={args.realtime}")
+        LOG.info("Using --encoder=%s --preset=%s", profile['encoder'], profile['preset'])
+        args.encoder, args.preset = profile['encoder'], profile['preset']
 
-        tmp_outputs = [ ]
-        TOC = [ ]
-        segment_list = [ ]
-        cumulative_time = 0
-        filters = [ ]
-        covers = [ ]
-        options_ffmpeg_output = [ ]
-        subtitles = [ ]
+    if args.show_schedule:
+        args.dry_run = True
+        args.quiet = True
+        args.check = True
 
-        with tempfile.TemporaryDirectory() as tmpdir:
-            # Find input
-            if 'input' in segment:
-                input0 = segment['input']
-            if 'workshop_description' in segment:
-                workshop_description = segment['workshop_description'].strip()
-            if 'workshop_title' in segment:
-                workshop_title = segment['workshop_title']
-            if 'crop' in segment:
-                # -filter:v "crop=w:h:x:y"    - x:y is top-left corner
-                options_ffmpeg_output.extend(generate_crop(**segment['crop']))
-            if 'schedule-sync' in segment:
-                schedule.sync(*segment['schedule-sync'].split('='))
+    # Open the input file.
+    with profile_span(args, 'parse'):
+        if isinstance(args.editlist, list):
+            # build_plan() edits it, and it is the caller's
+            data = copy.deepcopy(args.editlist)
+        elif args.literal_editlist:
+            data = parse_editlist(args.editlist)
+        else:
+            data = parse_editlist(open(args.editlist).read())
+
+    # A dry run leaves no cache behind, but --check uses it.
+    probe = MediaProbe(None if args.dry_run and not args.check else
+                       args.cache_dir/'probe' if args.cache_dir else default_cache_dir()/'probe')
+    with profile_span(args, 'plan'):
+        plan = build_plan(data, args, probe=probe, base_dir=base_dir)
+    with profile_span(args, 'check-times'):
+        errors = plan.errors + check_times(plan, probe, strict=args.check)
+    if errors:
+        raise EditlistError(errors)
+    return plan, probe
+
+
+def write_plan_json(plan, args):
+    """--plan-json"""
+    if args.plan_json:
+        if str(args.plan_json) == '-':
+            print(plan.to_json())
+        else:
+            with atomic_write(args.plan_json, 'w') as tmp:
+                open(tmp, 'w').write(plan.to_json())
 
 
+def run(args, segment_pool=None, base_dir=None):
+    """Run everything for the parsed command line arguments.
 
-            if 'output' not in segment:
-                continue
-            allow_reencode = segment.get('reencode', True)
-            # Exclude non-matching files if '--limit' specified.
-            if args.limit and not any(limit_match in segment['output'] for limit_match in args.limit):
-                continue
-            if args.list:
-                print(segment['output'])
-                continue
-            input1 = input0
-            editlist = segment.get('editlist', segment.get('time'))
-            if editlist is None:
-                continue
+    Returns the EditPlan.  segment_pool is passed on to execute_plan(),
+    base_dir to build_plan().
+    """
+    with profiling(args):
+        return _run(args, segment_pool, base_dir)
+
+def _run(args, segment_pool, base_dir):
+    plan, probe = make_plan(args, base_dir=base_dir)
+    if args.calibrate:
+        run_calibration(plan, args, probe)
+        return plan
+
+    write_plan_json(plan, args)
+    if args.list or args.dry_run:
+        return plan
+    if args.metadata_only:
+        update_metadata(plan, args, manifest=None if args.rebuild else
+                        BuildManifest(args.output/BuildManifest.FILENAME))
+        return plan
+
+    cache = None
+    if args.cache_dir:
+        cache = SegmentCache(args.cache_dir, max_size=args.cache_size*2**30)
+    manifest = None
+    if not (args.rebuild or args.check):
+        manifest = BuildManifest(args.output/BuildManifest.FILENAME)
+    with progress_reporter(args) as progress:
+        execute_plan(plan, args, cache=cache, progress=progress, manifest=manifest,
+                     segment_pool=segment_pool)
+    return plan
+
+
+#
+# Library API
+#
+
+def make_args(editlist, input, output='.', **options):
+    """Arguments like the command line's, for process().
+
+    editlist is a filename, or the already parsed editlist (a list).
+    options are the long command line options with _ instead of -,
+    e.g. reencode=True, jobs=4, crf=25.  Unknown options are a
+    TypeError.  Unlike on the command line, quiet defaults to True, so
+    nothing is printed.
+    """
+    args = make_parser().parse_args([])
+    args.editlist = editlist if isinstance(editlist, list) else str(editlist)
+    args.input = Path(input)
+    args.output = Path(output)
+    args.quiet = True
+    for name, value in options.items():
+        if not hasattr(args, name) or name in ('editlist', 'input', 'output'):
+            raise TypeError(f"unknown option: {name}")
+        setattr(args, name, value)
+    for name in ('cache_dir', 'plan_json', 'progress_json', 'trace'):
+        if getattr(args, name) is not None:
+            setattr(args, name, Path(getattr(args, name)))
+    return args
+
+
+def process(editlist, input, output='.', **options):
+    """Process an editlist, like the command line does.
+
+    See make_args() for the arguments.  Returns the EditPlan.  Raises
+    EditlistError (instead of exiting) if something is wrong with the
+    editlist or an output fails.  This doesn't change any global
+    state, so several can run at once in different threads.
+    """
+    return run(make_args(editlist, input, output, **options))
 
-            #
-            # For each segment in the output
-            #
-            options_ffmpeg_segment = [ ]
-            segment_type = 'video'
-            segment_number = 0
-            for i, command in enumerate(editlist):
-                # Backwards compatibility with old 'begin' and 'end' commands
-                if 'begin' in command:
-                    command['start'] = command['begin']
-                    del command['begin']
-                for stop_alias in ['end', 'break', 'lunch', 'exercise']:
-                    if stop_alias in command:
-                        command['stop'] = command[stop_alias]
-                        del command[stop_alias]
-                        break
-                else:
-                    stop_alias = 'stop'
-                #
-
-                # Is this a command to cover a part of the video?
-                if isinstance(command, dict) and 'cover' in command:
-                    cover = command['cover']
-                    covers.append((segment_number, seconds(cover['begin'])))
-                    filters.append(generate_cover(**cover))
-                    continue
-                # Input command: change input files
-                elif isinstance(command, dict) and 'input' in command:
-                    input1 = command['input']
-                    # Handle png images
-                    if 'duration' in command:
-                        start = 0
-                        stop = seconds(command['duration'])
-                        segment_type = 'image'
-                        segment_number += 1
-                    else:
-                        continue
-                # Start command: start a segment
-                elif isinstance(command, dict) and 'start' in command:
-                    start = command['start']
-                    schedule(start, f"START" + (f" **{segment['title']}**" if segment_number == 0 and 'title' in segment else ""))
-                    segment_number += 1
-                    continue
-                # End command: process this segment and all queued commands
-                elif isinstance(command, dict) and 'stop' in command:
-                    stop = command['stop']
-                    schedule(stop, stop_alias.upper())
-                    # Continue below to process this segment
-                # Is this a TOC entry?
-                # If it's a dict, it is a table of contents entry that will be
-                # mapped to the correct time in the procesed video.
-                # This is a TOC entry
-                elif isinstance(command, dict):
-                    ( (time, title), ) = list(command.items())
-                    if time == '-':
-                        time = start
-                    if title in {'stop', 'start', 'begin', 'end', 'cover', 'input'}:
-                        LOG.error("ERROR: Suspicious TOC entry name, aborting encoding: %s", title)
-                        sys.exit(1)
-                    #print(start, title)
-                    #print('TOC', start, title, segment)
-                    TOC.append((segment_number, seconds(time), title))
-
-                    if '§' in title:
-                        schedule(time, f'. **{title}**')
-                    else:
-                        schedule(time, f'. . {title}')
-                    continue
 
+async def run_command_async(cmd, progress=None):
+    """Like run_command(), with asyncio.  Cancelling kills the process."""
+    if progress is not None and cmd[0] == 'ffmpeg':
+        cmd = [cmd[0], '-progress', 'pipe:1', '-nostats', *cmd[1:]]
+    else:
+        progress = None
+    proc = await asyncio.create_subprocess_exec(*(str(x) for x in cmd),
+                                                stdin=asyncio.subprocess.DEVNULL,
+                                                stdout=asyncio.subprocess.PIPE if progress else None)
+    try:
+        if progress:
+            # One report at a time, each ends with its progress= line
+            block = [ ]
+            async for line in proc.stdout:
+                block.append(line.decode())
+                if block[-1].startswith('progress='):
+                    for report in parse_progress(block):
+                        progress(**report)
+                    block = [ ]
+        returncode = await proc.wait()
+    except asyncio.CancelledError:
+        proc.kill()
+        await proc.wait()
+        raise
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, cmd)
 
-                # The end of our time segment (from 'start' to 'stop').  Do the
-                # actual processing of this segment now.
-                else:
-                    # time can be string with comma or list
-                    time = command
-                    if isinstance(time, str):
-                        time = time.split(',')
-                    if len(time) == 2:
-                        start, stop = time
-                    elif len(time) == 3:
-                        input1, start, stop = time
-                start = str(start).strip()
-                stop = str(stop).strip()
-
-                # Print status
-                LOG.info("\n\nBeginning %s (line %d)", segment.get('title') if 'title' in segment else '[no title]', i)
-
-                # TODO: should continue further down to actually test other code.
-                if args.dry_run:
-                    continue
 
-                # Find input file
-                if not os.path.exists(input1):
-                    input1 = args.input / input1
-                    input1 = os.path.expanduser(input1)
-                all_inputs.add(input1)
-                if not os.path.exists(input1):
-                    print(f"ERROR: input not found: {input1}", file=sys.stderr)
-                    sys.exit(1)
-
-
-                segment_list.append([segment_number, seconds(start), cumulative_time])
-                segment_list.append([segment_number, seconds(stop), None])
-                start_cumulative = cumulative_time
-                cumulative_time += seconds(stop) - seconds(start)
-                # filters
-                if filters:
-                    filters = ['-vf', ','.join(filters)]
-                # Encode for video, image, etc?
-                if segment_type == 'video':
-                    encoding_args = ['-i', input1,
-                                     '-ss', start, '-to', stop,
-                                     *(FFMPEG_VIDEO_ENCODE if (args.reencode and allow_reencode) or filters else FFMPEG_VIDEO_COPY),
-                                     *FFMPEG_AUDIO_COPY,
-                                     ]
-                    if seconds(start) > seconds(stop):
-                        raise RuntimeError(f"start is greater than stop time ({start} > {stop} time in {segment.get('title')}")
-                elif segment_type == 'image':
-                    # https://trac.ffmpeg.org/wiki/Slideshow
-                    encoding_args = ['-loop', '1',
-                                     '-i', input1,
-                                     '-t', str(command['duration']),
-                                     '-vf', f'fps={FFMPEG_FRAMERATE},format=yuv420p',
-                                     '-c:v', 'libx264', ]#'-r', str(FFMPEG_FRAMERATE)]
-                else:
-                    raise RuntimeError(f"unknown segment_type: {segment_type}")
-
-                # Do encoding
-                tmp_out = str(Path(tmpdir)/('tmpout-%02d.mkv'%i))
-                tmp_outputs.append(tmp_out)
-                cmd = ['ffmpeg', '-loglevel', str(LOGLEVEL),
-                       *encoding_args,
-                       *options_ffmpeg_output,
-                       *options_ffmpeg_segment,
-                       *filters,
-                       tmp_out,
-                       ]
-                LOG.info(shell_join(cmd))
-                if not (args.check or args.dry_run):
-                    subprocess.check_call(cmd)
-
-                # Subtitles?
-                if args.srt:
-                    sub_file = os.path.splitext(input1)[0] + '.srt'
-                    if not os.path.exists(sub_file):
-                        print(f'ERROR: subtitle file not found: {sub_file}', file=sys.stderr)
-                        sys.exit(1)
-                    start_dt = timedelta(seconds=seconds(start))
-                    end_dt   = timedelta(seconds=seconds(stop))
-                    start_cumulative_dt = timedelta(seconds=start_cumulative)
-                    duration_segment_dt = end_dt-start_dt
-                    for sub in srt.parse(open(sub_file).read()):
-                        if sub.end < start_dt: continue
-                        if sub.start > end_dt: continue
-                        sub = copy.copy(sub)
-                        sub.start = sub.start - start_dt + start_cumulative_dt
-                        sub.end   = sub.end   - start_dt + start_cumulative_dt
-                        sub.start = max(sub.start, start_cumulative_dt)
-                        sub.end   = min(sub.end,   start_cumulative_dt + duration_segment_dt)
-                        subtitles.append(sub)
-
-                # Reset for the next round
-                filters = [ ]
-                options_ffmpeg_segment = [ ]
-                segment_type = 'video'
-
-            output_raw = args.output / segment['output']
-            output_raw = output_raw.parent / 'tmp' / output_raw.name
-            output = args.output / segment['output']
-
-            # TODO: should continue further down to actually test other code.
-            if args.dry_run:
-                continue
+async def _in_thread(func, *args):
+    """Run func in a thread.  If cancelled, let it finish first."""
+    future = asyncio.ensure_future(asyncio.to_thread(func, *args))
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        await future
+        raise
 
-            # Subtitles
-            if args.srt:
-                srt_output = os.path.splitext(output)[0] + '.srt'
-                open(srt_output, 'w').write(srt.compose(subtitles))
-
-            # Create the playlist of inputs
-            playlist = Path(tmpdir) / 'playlist.txt'
-            with open(playlist, 'w') as playlist_f:
-                for file_ in tmp_outputs:
-                    playlist_f.write('file '+str(file_)+'\n')
-            LOG.debug("Playlist:")
-            LOG.debug(open(playlist).read())
-            # Re-encode
-            ensure_filedir_exists(output)
-            if output in all_inputs:
-                raise RuntimeError("Output is the same as an input file, aborting.")
-            tmpdir_out = str(Path(tmpdir)/('final-'+segment['output'].replace('/', '%2F')))
-            cmd = ['ffmpeg', '-loglevel', str(LOGLEVEL),
-                   #*itertools.chain.from_iterable(('-i', x) for x in tmp_outputs),
-                   #'-i', 'concat:'+'|'.join(tmp_outputs),
-                   '-safe', '0', '-f', 'concat', '-i', playlist,
-                   '-fflags', '+igndts',
-                   '-c', 'copy',
-                   *(['-y'] if args.force else []),
-                   tmpdir_out,
-                   ]
-            LOG.info(shell_join(cmd))
-            if not args.check:
-                subprocess.check_call(cmd)
-
-            # This is raw encoding without subtitles or anithing
-            # We need another copy, since ffmpeg detects output based on
-            # filename.  Yet for atomicness, we need a temporary filename for
-            # the temp part
-            if not args.check:
-                ensure_filedir_exists(output_raw)
-                with atomic_write(output_raw) as tmp_output:
-                    shutil.move(tmpdir_out, tmp_output)
-
-
-            # Create the video properties/chapters/etc (needs to be done before
-            # making the final mkv because it gets encoded into the mkv file).
-
-            # Print table of contents
-            import pprint
-            LOG.debug(pprint.pformat(segment_list))
-            LOG.debug(pprint.pformat(TOC))
-
-            video_description = [ ]
-            title = None
-            if segment.get('title'):
-                title = segment['title']
-                if workshop_title is not None:
-                    title = title + ' - ' + workshop_title
-
-                video_description.extend([title.strip()])
-            if segment.get('description'):
-                video_description.extend([segment['description'].strip().replace('\n', '\n\n')])
-            # Print out the table of contents
-            #video_description.append('\n')
-            # Making chapters
-            toc = [ ]
-            chapter_file = Path(tmpdir) / 'chapters.txt'
-            chapter_file_f = open(chapter_file, 'w')
-            for i, (seg_n, time, name) in enumerate(TOC):
-                LOG.debug("TOC entry %s %s", time, name)
-                new_time = map_time(seg_n, segment_list, time)
-                if not args.quiet:
-                    print(humantime(new_time), name)
-                toc.append(f"{humantime(new_time)} {name}")
-                chapter_file_f.write(f'CHAPTER{i+1:02d}={humantime(new_time, show_hour=True)}.000\n')
-                chapter_file_f.write(f'CHAPTER{i+1:02d}NAME={name}\n')
-            chapter_file_f.close()
-            if toc:
-                video_description.append('\n'.join(toc))
-
-            if workshop_description:
-                video_description.append('-----')
-                video_description.append(workshop_description.replace('\n', '\n\n').strip())
-
-            if video_description:
-                video_description_file = os.path.splitext(str(output))[0]+'.info.txt'
-                with atomic_write(video_description_file, 'w') as toc_file:
-                    open(toc_file, 'w').write('\n\n'.join(video_description))
-
-            # Finalize the video
-
-            # Embed subtitles in mkv if they are there
-            if args.srt and args.mkv_props:
-                cmd_merge = ['mkvmerge', output_raw, srt_output,
-                       '-o', output,
-                       ]
-                LOG.info(shell_join(cmd_merge))
-                if (not args.check) or output_raw.exists():
-                    subprocess.check_call(cmd_merge)
-                    #shutil.move(tmpdir_out, output)
-            else:
-                if not args.check:
-                    shutil.copy(output_raw, output)
 
+async def execute_plan_async(plan, args, cache=None, manifest=None, progress=None):
+    """Like execute_plan(), with asyncio.
 
-            # mkv chapters
-            if title or toc or video_description:
-                cmd_propedit = [
-                    'mkvpropedit', output,
-                    *(['--set', f'title={title}',] if title else []),
-                    *(['--chapters', str(chapter_file),] if toc else []),
-                    *(['--attachment-name', 'description', '--add-attachment', video_description_file] if video_description else []),
-                    ]
-                LOG.info(shell_join(cmd_propedit))
-                if (not args.check) or output_raw.exists():
-                    subprocess.check_call(cmd_propedit)
+    Up to --jobs segment encodes of all outputs run at once as asyncio
+    subprocesses.  Finalizing (short stream copies) runs in a thread.
+    Cancelling kills the running encodes and removes partial files.
+    """
+    with lock_outputs(plan.outputs) as (outputs, errors):
+        try:
+            await _execute_plan_async(outputs, args, cache, manifest, progress)
+        except EditlistError as exc:
+            raise EditlistError(errors + exc.errors) from None
+    if errors:
+        raise EditlistError(errors)
+
+async def _execute_plan_async(outputs, args, cache, manifest, progress):
+    outputs, metadata_only = select_outputs(outputs, args, manifest)
+    slots = asyncio.Semaphore(max(args.jobs, 1))
+
+    async def encode(cmds, duplicates):
+        async with slots:
+            todo = [ ]
+            for cmd, task, checkpoint in cmds:
+                if not await _in_thread(reuse_segment, cmd, cache, checkpoint):
+                    todo.append((cmd, task, checkpoint))
+                elif task:
+                    task(finished=True)
+            if todo:
+                # Like run_segments(), a group reports when it is done
+                with profile_span(args, 'ffmpeg', 'command'):
+                    if len(todo) > 1:
+                        await run_command_async(group_command([cmd for cmd, _, _ in todo]))
+                    else:
+                        await run_command_async(todo[0][0], progress=todo[0][1])
+            for cmd, task, checkpoint in todo:
+                await _in_thread(segment_encoded, cmd, cache, checkpoint)
+                if task:
+                    task(finished=True)
+            if duplicates:
+                await _in_thread(link_duplicates, duplicates)
+
+    async def do_output(out, tmpdir, raw, tasks):
+        try:
+            try:
+                await asyncio.gather(*tasks)
+            except BaseException:
+                # Segments other outputs need too still run, unless
+                # we are cancelled (then gather cancels them all)
+                for task in tasks:
+                    if task not in shared_tasks:
+                        task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+            await _in_thread(finish_output, out, tmpdir, raw, args,
+                             out.output in metadata_only, manifest)
+        finally:
+            remove_partial(raw)
+
+    with contextlib.ExitStack() as stack:
+        tmpdirs = [stack.enter_context(work_directory(out, args)) for out in outputs]
+        raws = [raw_target(out, args) for out in outputs]
+        shared_keys = {seg.shared for out in outputs for seg in out.segments if seg.shared}
+        jobs = segment_jobs([segment_commands(out, tmpdir, raw, args, out.output in metadata_only, progress)
+                             for out, tmpdir, raw in zip(outputs, tmpdirs, raws)],
+                            decode_once=args.decode_once, shared_keys=shared_keys)
+        output_tasks = [[ ] for out in outputs]
+        shared_tasks = set()
+        for cmds, needed_by, duplicates in jobs:
+            task = asyncio.ensure_future(encode(cmds, duplicates))
+            for n in needed_by:
+                output_tasks[n].append(task)
+            if len(needed_by) > 1:
+                shared_tasks.add(task)
+        results = await asyncio.gather(*(do_output(*x) for x in zip(outputs, tmpdirs, raws, output_tasks)),
+                                       return_exceptions=True)
+    failed = [ ]
+    for out, result in zip(outputs, results):
+        if isinstance(result, asyncio.CancelledError):
+            raise result
+        if isinstance(result, BaseException):
+            LOG.error("Output %s failed: %s", out.output, result)
+            failed.append(out.output)
+    if failed:
+        raise EditlistError(f"{len(failed)} of {len(outputs)} outputs failed: "
+                            + ', '.join(str(x) for x in failed))
+
+
+async def process_async(editlist, input, output='.', **options):
+    """Like process(), with asyncio, see execute_plan_async().
+
+    Many editlists can be processed concurrently in one event loop,
+    and cancelled.  Planning (which runs ffprobe) is done in a thread.
+    """
+    args = make_args(editlist, input, output, **options)
+    with profiling(args):
+        return await _process_async(args)
+
+async def _process_async(args):
+    plan, probe = await asyncio.to_thread(make_plan, args)
+    if args.calibrate:
+        await asyncio.to_thread(run_calibration, plan, args, probe)
+        return plan
+    write_plan_json(plan, args)
+    if args.list or args.dry_run:
+        return plan
+    if args.metadata_only:
+        await asyncio.to_thread(update_metadata, plan, args, None if args.rebuild else
+                                BuildManifest(args.output/BuildManifest.FILENAME))
+        return plan
+    cache = None
+    if args.cache_dir:
+        cache = SegmentCache(args.cache_dir, max_size=args.cache_size*2**30)
+    manifest = None
+    if not (args.rebuild or args.check):
+        manifest = BuildManifest(args.output/BuildManifest.FILENAME)
+    with progress_reporter(args) as progress:
+        await execute_plan_async(plan, args, cache=cache, manifest=manifest, progress=progress)
+    return plan
+
+
+class FairPool:
+    """A bounded pool of worker threads shared fairly between jobs (--serve).
+
+    Each job submits its tasks through job(name), which has the
+    submit() of an executor.  Idle workers take tasks from the jobs in
+    turn, so a job with 200 segments doesn't hold back one with two.
+    """
+    def __init__(self, workers):
+        self._queues = collections.OrderedDict()
+        self._cond = threading.Condition()
+        self._shutdown = False
+        self._threads = [threading.Thread(target=self._worker, daemon=True)
+                         for _ in range(max(workers, 1))]
+        for thread in self._threads:
+            thread.start()
+    def job(self, name):
+        """An executor-like object submitting into this pool as job name."""
+        pool = self
+        class JobExecutor:
+            def submit(self, fn, *args, **kwargs):
+                return pool.submit(name, fn, *args, **kwargs)
+        return JobExecutor()
+    def submit(self, name, fn, *args, **kwargs):
+        future = concurrent.futures.Future()
+        with self._cond:
+            self._queues.setdefault(name, collections.deque()).append((future, fn, args, kwargs))
+            self._cond.notify()
+        return future
+    def _next(self):
+        """Next task, from the job that least recently got a turn."""
+        with self._cond:
+            while not self._queues and not self._shutdown:
+                self._cond.wait()
+            if self._shutdown:
+                return None
+            name, queue = next(iter(self._queues.items()))
+            task = queue.popleft()
+            del self._queues[name]
+            if queue:
+                self._queues[name] = queue   # to the end of the line
+            return task
+    def _worker(self):
+        while True:
+            task = self._next()
+            if task is None:
+                return
+            future, fn, args, kwargs = task
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as exc:
+                future.set_exception(exc)
+            else:
+                future.set_result(result)
+    def shutdown(self):
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+def test_fair_pool():
+    pool = FairPool(1)
+    order = [ ]
+    started, gate = threading.Event(), threading.Event()
+    blocker = pool.submit('a', lambda: started.set() or gate.wait())
+    started.wait()
+    futures = [pool.submit('a', order.append, f'a{i}') for i in range(3)]
+    futures += [pool.submit('b', order.append, f'b{i}') for i in range(2)]
+    gate.set()
+    blocker.result()
+    for future in futures:
+        future.result()
+    pool.shutdown()
+    assert order == ['a0', 'b0', 'a1', 'b1', 'a2']
+
+
+class Spool:
+    """Directory of editlist jobs for --serve.
+
+    New jobs (see --submit) are SPOOL/incoming/ID.json files with the
+    ffmpeg-editlist command line arguments and the directory they are
+    relative to.  accept() moves them to SPOOL/jobs/ID/job.json, and
+    the job's state (queued, running, done, failed; with times and any
+    error) is kept in SPOOL/jobs/ID/state.json, so it survives a
+    restart of the service.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        os.makedirs(self.path/'incoming', exist_ok=True)
+        os.makedirs(self.path/'jobs', exist_ok=True)
+    def submit(self, argv, cwd):
+        """Add a new job, return its ID."""
+        job_id = time.strftime('%Y%m%d-%H%M%S-') + uuid.uuid4().hex[:8]
+        with atomic_write(self.path/'incoming'/(job_id+'.json'), 'w') as tmp:
+            open(tmp, 'w').write(json.dumps({'argv': list(argv), 'cwd': str(cwd)}))
+        return job_id
+    def accept(self):
+        """Move new jobs to jobs/ as queued, return their IDs."""
+        job_ids = [ ]
+        for incoming in sorted(self.path.glob('incoming/*.json')):
+            job_id = incoming.stem
+            os.makedirs(self.path/'jobs'/job_id, exist_ok=True)
+            os.replace(incoming, self.path/'jobs'/job_id/'job.json')
+            self.set_state(job_id, state='queued', submitted=time.time())
+            job_ids.append(job_id)
+        return job_ids
+    def job_ids(self):
+        return sorted(x.name for x in (self.path/'jobs').iterdir()
+                      if (x/'job.json').exists())
+    def job(self, job_id):
+        return json.loads((self.path/'jobs'/job_id/'job.json').read_text())
+    def state(self, job_id):
+        try:
+            return json.loads((self.path/'jobs'/job_id/'state.json').read_text())
+        except FileNotFoundError:
+            return {'state': 'queued'}
+    def set_state(self, job_id, **changes):
+        state = self.state(job_id)
+        state.update(changes)
+        with atomic_write(self.path/'jobs'/job_id/'state.json', 'w') as tmp:
+            open(tmp, 'w').write(json.dumps(state))
 
 
+def job_args(job):
+    """Parsed arguments of a spooled job, with paths made absolute.
 
+    Paths inside the editlist are relative to the job's cwd too, which
+    run_job() passes to run() (jobs run in threads, so no chdir).
+    """
+    args = make_parser().parse_args(job['argv'])
+    args.submit = None
+    cwd = Path(job['cwd'])
+    for name in ('input', 'output', 'cache_dir', 'plan_json', 'progress_json', 'trace'):
+        value = getattr(args, name)
+        if value is not None and str(value) != '-':
+            setattr(args, name, cwd / value)
+    if not args.literal_editlist:
+        args.editlist = str(cwd / args.editlist)
+    # Jobs run in the background: ffmpeg must not read the terminal.
+    args.no_stdin = True
+    # and a job that was interrupted continues where it was.
+    args.resume = True
+    return args
+
+
+def run_job(spool, job_id, pool):
+    """Run one spooled job, recording its state."""
+    spool.set_state(job_id, state='running', started=time.time(), error=None)
+    LOG.info("Starting job %s", job_id)
+    try:
+        job = spool.job(job_id)
+        run(job_args(job), segment_pool=pool.job(job_id), base_dir=job['cwd'])
+    except (Exception, SystemExit) as exc:
+        error = f'exited with status {exc.code}' if isinstance(exc, SystemExit) else str(exc)
+        LOG.error("Job %s failed: %s", job_id, error)
+        spool.set_state(job_id, state='failed', finished=time.time(), error=error)
+    else:
+        LOG.info("Job %s done", job_id)
+        spool.set_state(job_id, state='done', finished=time.time())
 
-            # Print out covered segments (for verification purposes)
-            for seg_n, time in covers:
-                new_time = map_time(seg_n, segment_list, time)
-                LOG.info("Check cover at %s", humantime(new_time))
 
-            if args.wait:
-                input('press return to continue> ')
+def serve(spool_dir, workers=1, poll=1.0, until_idle=False):
+    """Run the jobs of a Spool, forever (or until_idle: until there are none left).
 
+    Each job runs in its own thread (planning and finalizing), but all
+    segment encodes go to one FairPool of workers.  Jobs that were
+    queued or running when the service was stopped are run again: the
+    build manifest skips the outputs they finished, and the segments
+    already encoded of the others are re-used (jobs run with --resume).
+    """
+    spool = Spool(spool_dir)
+    pool = FairPool(workers)
+    threads = { }
+    def start(job_id):
+        threads[job_id] = threading.Thread(target=run_job, args=(spool, job_id, pool))
+        threads[job_id].start()
+    for job_id in spool.job_ids():
+        if spool.state(job_id)['state'] in ('queued', 'running'):
+            start(job_id)
+    LOG.info("Serving %s with %d workers", spool_dir, workers)
+    try:
+        while True:
+            for job_id in spool.accept():
+                start(job_id)
+            for job_id, thread in list(threads.items()):
+                if not thread.is_alive():
+                    del threads[job_id]
+            if until_idle and not threads and not any(spool.path.glob('incoming/*.json')):
+                break
+            time.sleep(poll)
+    finally:
+        for thread in threads.values():
+            thread.join()
+        pool.shutdown()
+
+
+def print_spool_status(spool_dir):
+    """--status: print the jobs of a Spool."""
+    spool = Spool(spool_dir)
+    now = time.time()
+    for job_id in spool.job_ids():
+        state = spool.state(job_id)
+        editlist = next(iter(spool.job(job_id)['argv']), '')
+        elapsed = ''
+        if state.get('started'):
+            elapsed = humantime((state.get('finished') or now) - state['started'])
+        print(f"{job_id}  {state['state']:<8} {elapsed:>8}  {editlist}"
+              + (f"  ({state['error']})" if state.get('error') else ''))
 
 
 if __name__ == '__main__':
@@ -4,6 +4,7 @@ import io
 import json
 import pathlib
 import subprocess
+import sys
 import tempfile
 
 import pytest
@@ -54,6 +55,30 @@ def runner(tmpdir):
     yield runner_
 
 
+class Commands(list):
+    """Commands run through ffmpeg_editlist.run_command().
+
+    Set run = False to only record them, or interrupt to a name to
+    raise KeyboardInterrupt at the command writing it.
+    """
+    run = True
+    interrupt = None
+
+@pytest.fixture
+def commands(monkeypatch):
+    """Record (and still run) the commands ffmpeg-editlist runs."""
+    commands_ = Commands()
+    run_command = ffmpeg_editlist.run_command
+    def recording_run_command(cmd, args, progress=None):
+        if commands_.interrupt and commands_.interrupt in str(cmd[-1]):
+            raise KeyboardInterrupt
+        commands_.append(cmd)
+        if commands_.run:
+            run_command(cmd, args, progress)
+    monkeypatch.setattr(ffmpeg_editlist, 'run_command', recording_run_command)
+    return commands_
+
+
 def test_5s(runner):
     yaml = """
 - input: video-10s.mkv
@@ -81,6 +106,14 @@ def test_concatenate(runner):
     ffmpeg_editlist.main([runner.input, 'sample/', '-o', runner.output, '--reencode', *TEST_OPTS])
     runner.check_duration('10s.mkv', 10)
 
+def luma(filename, t, crop=None):
+    """Average brightness of the frame at t (or of its crop "w:h:x:y")."""
+    cmd = ['ffmpeg', '-ss', str(t), '-i', filename, '-frames:v', '1',
+           '-vf', (f'crop={crop},' if crop else '') + 'signalstats,metadata=print:key=lavfi.signalstats.YAVG:file=-',
+           '-f', 'null', '-']
+    out = subprocess.run(cmd, capture_output=True, text=True).stdout
+    return float(out.split('YAVG=')[1].split()[0])
+
 def test_cover(runner):
     yaml = """
 - input: video-10s.mkv
@@ -99,6 +132,32 @@ def test_cover(runner):
     runner.check_duration('covered.mkv', 5)
 
 
+def test_cover_copy_fallback(runner, monkeypatch):
+    # An HEVC input can't have x264 parts spliced in
+    hevc = runner.tmpdir/'hevc.mkv'
+    subprocess.run(['ffmpeg', '-loglevel', 'error', '-i', 'sample/video-10s.mkv', '-t', '4',
+                    '-c:v', 'libx265', '-preset', 'ultrafast', '-x265-params', 'log-level=error:keyint=30:min-keyint=30',
+                    '-c:a', 'copy', hevc], check=True)
+    runner.input = f"""
+- input: {hevc}
+  output: covered.mkv
+  editlist:
+    - start: 00:00
+    - cover: {{begin: "00:01", end: "00:02"}}
+    - stop: 00:04
+"""
+    plan_file = runner.tmpdir/'plan.json'
+    ffmpeg_editlist.main([runner.input, 'sample/', '-o', runner.output, f'--plan-json={plan_file}', *TEST_OPTS])
+    seg, = json.load(open(plan_file))['outputs'][0]['segments']
+    assert 'libx264' in seg['cmd'] and 'drawbox' in ' '.join(seg['cmd'])
+    runner.check_duration('covered.mkv', 4)
+    assert {s['codec_name'] for s in video_info(runner.get_output('covered.mkv'))['streams']
+            if s['codec_type'] == 'video'} == {'h264'}
+    # Planning doesn't need ffprobe
+    monkeypatch.setenv('PATH', str(runner.tmpdir/'nothing'))
+    monkeypatch.setenv('XDG_CACHE_HOME', str(runner.tmpdir/'cache'))
+    ffmpeg_editlist.main([runner.input, 'sample/', '-o', runner.output, '--dry-run', '--rebuild'])
+
 def test_png(runner):
     yaml="""
 - output: png-to-video.mkv
@@ -139,3 +198,785 @@ def test_srt(runner):
     assert '3,600' in srt_data
     assert '4,000\nfive' in srt_data
     assert '6,000\neight' in srt_data
+
+def test_srt_no_keep_raw_metadata(runner, commands, caplog):
+    # The subtitles are embedded from the raw output, which isn't kept
+    yaml = """
+- input: count10.mkv
+- output: count10-meta.mkv
+  title: {title}
+  editlist:
+    - start: 00:01
+    - end:   00:03
+"""
+    runner.input = yaml.format(title='One')
+    args = [runner.input, 'sample/', '-o', runner.output, '--srt', '--no-keep-raw', '--reencode', *TEST_OPTS]
+    ffmpeg_editlist.main(args)
+    # Only the title changed, but it is rebuilt to embed the subtitles again
+    commands.clear()
+    runner.input = yaml.format(title='Two')
+    ffmpeg_editlist.main(args)
+    assert 'raw output' in caplog.text
+    assert any('tmpout' in str(cmd[-1]) for cmd in commands)
+    assert [cmd[0] for cmd in commands][-1] == 'mkvmerge'
+    runner.check_duration('count10-meta.mkv', 2)
+
+def test_jobs(runner):
+    yaml = """
+- input: video-10s.mkv
+- output: a.mkv
+  editlist:
+    - start: 00:00
+    - stop: 00:03
+    - start: 00:05
+    - stop: 00:07
+- output: b.mkv
+  editlist:
+    - start: 00:02
+    - stop: 00:06
+"""
+    runner.input = yaml
+    ffmpeg_editlist.main([runner.input, 'sample/', '-o', runner.output, '--reencode', '--jobs=3', *TEST_OPTS])
+    runner.check_duration('a.mkv', 5)
+    runner.check_duration('b.mkv', 4)
+
+def test_cache(runner, commands):
+    yaml = """
+- input: video-10s.mkv
+  output: cached.mkv
+  editlist:
+    - start: 00:00
+    - stop: 00:03
+    - start: 00:05
+    - stop: 00:07
+"""
+    runner.input = yaml
+    cache_dir = runner.tmpdir/'cache'
+    args = [runner.input, 'sample/', '-o', runner.output, '--reencode', f'--cache-dir={cache_dir}', *TEST_OPTS]
+    ffmpeg_editlist.main(args)
+    assert len(list(cache_dir.glob('*.mkv'))) == 2
+    # Second run: nothing is re-encoded
+    commands.clear()
+    ffmpeg_editlist.main(args + ['--force', '--rebuild'])
+    assert not any('tmpout' in str(cmd[-1]) for cmd in commands)
+    runner.check_duration('cached.mkv', 5)
+    # A cached single-pass output is a copy: editing it in place
+    # doesn't change the cache.
+    args += ['--single-pass', '--no-keep-raw']
+    ffmpeg_editlist.main(args)
+    ffmpeg_editlist.main(args + ['--force', '--rebuild'])
+    assert pathlib.Path(runner.get_output('cached.mkv')).stat().st_nlink == 1
+    assert all(entry.stat().st_nlink == 1 for entry in cache_dir.glob('*.mkv'))
+
+def test_plan_json(runner):
+    yaml = """
+- input: video-10s.mkv
+  output: planned.mkv
+  title: Planned
+  editlist:
+    - start: 00:01
+    - 00:02: First
+    - stop: 00:04
+    - start: 00:06
+    - cover: {begin: "00:07", end: "00:08"}
+    - 00:07: Second
+    - stop: 00:09
+"""
+    runner.input = yaml
+    plan_file = runner.tmpdir/'plan.json'
+    ffmpeg_editlist.main([runner.input, 'sample/', '-o', runner.output, '--dry-run', f'--plan-json={plan_file}'])
+    assert not pathlib.Path(runner.get_output('planned.mkv')).exists()
+    plan = ffmpeg_editlist.EditPlan.from_json(open(plan_file).read())
+    out, = plan.outputs
+    assert out.name == 'planned.mkv'
+    # Only the GOP with the cover (up to the keyframe at 8.333 s) is re-encoded
+    assert [(seg.start, seg.stop, seg.output_start) for seg in out.segments] == \
+        [(1, 4, 0), (6, 8.333, 3), (8.333, 9, 5.333)]
+    assert [tuple(x) for x in out.toc] == [(1, 'First'), (4, 'Second')]
+    assert out.covers == [4]
+    assert 'drawbox' in ' '.join(out.segments[1].cmd)
+    assert 'drawbox' not in ' '.join(out.segments[2].cmd)
+    assert '00:01 First' in out.description
+
+def test_smart_cut(runner):
+    # The sample has keyframes at 0 and 8.333 s
+    yaml = """
+- input: video-10s.mkv
+  output: smart.mkv
+  editlist:
+    - start: 00:00
+    - stop: 00:09
+    - start: 00:02
+    - stop: 00:04
+"""
+    runner.input = yaml
+    plan_file = runner.tmpdir/'plan.json'
+    ffmpeg_editlist.main([runner.input, 'sample/', '-o', runner.output, '--smart-cut', f'--plan-json={plan_file}', *TEST_OPTS])
+    plan = ffmpeg_editlist.EditPlan.from_json(open(plan_file).read())
+    segments = plan.outputs[0].segments
+    assert [(seg.start, seg.stop) for seg in segments] == [(0, 8.333), (8.333, 9), (2, 4)]
+    assert 'copy' in segments[0].cmd
+    assert 'libx264' in segments[1].cmd
+    runner.check_duration('smart.mkv', 11)
+
+def test_smart_cut_fallback(runner, caplog):
+    # x265 parts can't be joined to the copied H.264 middle
+    runner.input = """
+- input: video-10s.mkv
+  output: smart.mkv
+  editlist:
+    - start: 00:00
+    - stop: 00:09
+"""
+    plan_file = runner.tmpdir/'plan.json'
+    ffmpeg_editlist.main([runner.input, 'sample/', '-o', runner.output, '--smart-cut', '--encoder=x265',
+                          f'--plan-json={plan_file}', *TEST_OPTS])
+    seg, = json.load(open(plan_file))['outputs'][0]['segments']
+    assert (seg['start'], seg['stop']) == (0, 9)
+    assert 'libx265' in seg['cmd'] and 'copy' not in seg['cmd'][:seg['cmd'].index('-acodec')]
+    assert "can't smart cut" in caplog.text
+    runner.check_duration('smart.mkv', 9)
+    assert video_info(runner.get_output('smart.mkv'))['streams'][0]['codec_name'] == 'hevc'
+
+def test_cover_copy(runner):
+    # The sample has keyframes at 0 and 8.333 s
+    yaml = """
+- input: video-10s.mkv
+  output: cover-copy.mkv
+  editlist:
+    - start: 00:00
+    - cover: {begin: "00:09", end: "00:09.5"}
+    - stop: 00:10
+"""
+    runner.input = yaml
+    plan_file = runner.tmpdir/'plan.json'
+    ffmpeg_editlist.main([runner.input, 'sample/', '-o', runner.output, f'--plan-json={plan_file}', *TEST_OPTS])
+    out, = ffmpeg_editlist.EditPlan.from_json(open(plan_file).read()).outputs
+    assert [(seg.start, seg.stop) for seg in out.segments] == [(0, 8.333), (8.333, 10)]
+    assert 'copy' in out.segments[0].cmd and 'drawbox' in ' '.join(out.segments[1].cmd)
+    assert out.covers == [9]
+    runner.check_duration('cover-copy.mkv', 10)
+    output = runner.get_output('cover-copy.mkv')
+    assert luma(output, 9.2) < 20
+    assert luma(output, 5) > 100 and luma(output, 9.7) > 100
+
+def test_single_pass(runner):
+    yaml = """
+- output: single.mkv
+  editlist:
+    - input: sample/logo-840x1080.png
+      duration: 2
+    - input: sample/video-10s.mkv
+    - start: 00:01
+    - cover: {begin: "00:02", end: "00:03"}
+    - stop: 00:04
+    - start: 00:06
+    - stop: 00:08
+"""
+    runner.input = yaml
+    ffmpeg_editlist.main([runner.input, 'sample/', '-o', runner.output, '--single-pass', *TEST_OPTS])
+    runner.check_duration('single.mkv', 7)
+
+def test_single_pass_crop_image(runner):
+    # The image is scaled and cropped like the video
+    runner.input = """
+- output: single-crop.mkv
+  crop: {w: 400, h: 300, x: 10, y: 20}
+  editlist:
+    - input: sample/logo-840x1080.png
+      duration: 1
+    - input: sample/video-10s.mkv
+    - start: 00:01
+    - stop: 00:03
+"""
+    ffmpeg_editlist.main([runner.input, 'sample/', '-o', runner.output, '--single-pass', *TEST_OPTS])
+    runner.check_duration('single-crop.mkv', 3)
+    video = video_info(runner.get_output('single-crop.mkv'))['streams'][0]
+    assert (video['width'], video['height']) == (400, 300)
+
+def test_single_pass_silent_input(runner):
+    silent = runner.tmpdir/'silent.mkv'
+    subprocess.run(['ffmpeg', '-loglevel', 'error', '-i', 'sample/video-10s.mkv', '-t', '3', '-an',
+                    '-c:v', 'copy', silent], check=True)
+    runner.input = f"""
+- output: single-silent.mkv
+  editlist:
+    - input: sample/video-10s.mkv
+    - start: 00:01
+    - stop: 00:03
+    - input: {silent}
+    - start: 00:00
+    - stop: 00:02
+"""
+    ffmpeg_editlist.main([runner.input, 'sample/', '-o', runner.output, '--single-pass', *TEST_OPTS])
+    runner.check_duration('single-silent.mkv', 4)
+
+def test_no_keep_raw(runner):
+    yaml = """
+- input: video-10s.mkv
+  output: noraw.mkv
+  editlist:
+    - start: 00:00
+    - stop: 00:03
+"""
+    runner.input = yaml
+    ffmpeg_editlist.main([runner.input, 'sample/', '-o', runner.output, '--no-keep-raw', '--reencode', *TEST_OPTS])
+    runner.check_duration('noraw.mkv', 3)
+    assert not (runner.tmpdir/'tmp'/'noraw.mkv').exists()
+    assert not list(runner.tmpdir.rglob('*.tmp.mkv'))
+
+def test_check_times(runner, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(runner.tmpdir/'cache'))
+    yaml = """
+- input: video-10s.mkv
+  output: toolong.mkv
+  editlist:
+    - start: 00:05
+    - stop: 00:30
+"""
+    runner.input = yaml
+    # Only a warning when not checking
+    ffmpeg_editlist.main([runner.input, 'sample/', '-o', runner.output, '--dry-run'])
+    # A dry run keeps the probe in memory, --check caches it on disk
+    assert not (runner.tmpdir/'cache').exists()
+    with pytest.raises(SystemExit):
+        ffmpeg_editlist.main([runner.input, 'sample/', '-o', runner.output, '--check'])
+    assert list((runner.tmpdir/'cache'/'ffmpeg-editlist'/'probe').glob('*.json'))
+    # so checking again doesn't run ffprobe
+    calls = [ ]
+    real_run = subprocess.run
+    def run(cmd, *args, **kwargs):
+        calls.append(cmd[0])
+        return real_run(cmd, *args, **kwargs)
+    monkeypatch.setattr(subprocess, 'run', run)
+    with pytest.raises(SystemExit):
+        ffmpeg_editlist.main([runner.input, 'sample/', '-o', runner.output, '--check'])
+    assert 'ffprobe' not in calls
+
+def test_progress_json(runner):
+    yaml = """
+- input: video-10s.mkv
+  output: progress.mkv
+  editlist:
+    - start: 00:00
+    - stop: 00:02
+    - start: 00:04
+    - stop: 00:07
+- input: video-10s.mkv
+  output: progress2.mkv
+  editlist:
+    - start: 00:00
+    - stop: 00:04
+"""
+    runner.input = yaml
+    progress_file = runner.tmpdir/'progress.jsonl'
+    ffmpeg_editlist.main([runner.input, 'sample/', '-o', runner.output, '--reencode', f'--progress-json={progress_file}', *TEST_OPTS])
+    reports = [json.loads(line) for line in open(progress_file)]
+    assert {r['segment'] for r in reports} == {'tmpout-01.mkv', 'tmpout-03.mkv'}
+    assert all(0 <= r['out_time'] <= r['duration'] for r in reports)
+    # The total covers both outputs from the start
+    fractions = [r['fraction'] for r in reports]
+    assert fractions == sorted(fractions)
+    assert fractions[-1] == 1
+    assert max(r['fraction'] for r in reports if r['output'] == 'progress.mkv') <= 0.6
+
+
+def test_trace(runner, capsys):
+    yaml = """
+- input: video-10s.mkv
+  output: trace.mkv
+  editlist:
+    - start: 00:00
+    - stop: 00:02
+    - start: 00:04
+    - stop: 00:07
+"""
+    runner.input = yaml
+    trace_file = runner.tmpdir/'trace.json'
+    ffmpeg_editlist.main([runner.input, 'sample/', '-o', runner.output, '--reencode', '--profile', f'--trace={trace_file}', *TEST_OPTS])
+    events = json.load(open(trace_file))['traceEvents']
+    names = [e['name'] for e in events]
+    assert names.count('encode') == 2
+    assert {'parse', 'plan', 'concat', 'finalize', 'ffmpeg'} <= set(names)
+    encodes = [e for e in events if e['name'] == 'encode']
+    assert all(int(e['args']['bytes']) > 0 for e in encodes)
+    assert 'encode' in capsys.readouterr().err
+
+def test_incremental(runner, commands):
+    yaml = """
+- input: video-10s.mkv
+  output: incremental.mkv
+  title: {title}
+  editlist:
+    - start: 00:00
+    - stop: {stop}
+"""
+    def run(title, stop):
+        commands.clear()
+        runner.input = yaml.format(title=title, stop=stop)
+        ffmpeg_editlist.main([runner.input, 'sample/', '-o', runner.output, '--reencode', '--force', *TEST_OPTS])
+        return [cmd[0] for cmd in commands]
+    assert 'ffmpeg' in run('One', '00:03')
+    runner.check_duration('incremental.mkv', 3)
+    # Unchanged: skipped
+    assert run('One', '00:03') == [ ]
+    # Only the title changed: only the metadata is updated
+    assert run('Two', '00:03') == ['mkvpropedit']
+    # Cut changed: encoded again
+    assert 'ffmpeg' in run('Two', '00:05')
+    runner.check_duration('incremental.mkv', 5)
+    assert (pathlib.Path(runner.output)/ffmpeg_editlist.BuildManifest.FILENAME).exists()
+
+def test_metadata_only(runner, commands, capsys):
+    yaml = """
+- input: video-10s.mkv
+- output: meta1.mkv
+  title: {title}
+  description: {title} description
+  editlist:
+    - start: 00:00
+    - 00:01: Chapter
+    - stop: 00:03
+- output: meta2.mkv
+  title: Unchanged
+  editlist:
+    - start: 00:03
+    - stop: 00:05
+"""
+    runner.input = yaml.format(title='One')
+    ffmpeg_editlist.main([runner.input, 'sample/', '-o', runner.output, '--reencode', *TEST_OPTS])
+    capsys.readouterr()
+    commands.clear()
+    commands.run = False
+    # The inputs aren't needed, and only the changed output is edited
+    runner.input = yaml.format(title='Two')
+    ffmpeg_editlist.main([runner.input, 'nonexistent/', '-o', runner.output, '--metadata-only'])
+    assert 'Changed: ' in capsys.readouterr().out
+    assert [cmd[:2] for cmd in commands] == [['mkvpropedit', pathlib.Path(runner.output)/'meta1.mkv']]
+    assert 'Two description' in (pathlib.Path(runner.output)/'meta1.info.txt').read_text()
+    # Nothing changed since
+    commands.clear()
+    ffmpeg_editlist.main([runner.input, 'nonexistent/', '-o', runner.output, '--metadata-only'])
+    assert '0 of 2 outputs changed' in capsys.readouterr().out
+    assert commands == [ ]
+    # The library is quiet
+    runner.input = yaml.format(title='Three')
+    ffmpeg_editlist.process(runner.input, 'nonexistent/', runner.output, metadata_only=True)
+    assert len(commands) == 1
+    assert capsys.readouterr().out == ''
+
+def test_collisions(runner, caplog):
+    # Two outputs writing the same file, one of them through ..
+    runner.input = """
+- input: video-10s.mkv
+- output: same.mkv
+  editlist: [{start: '00:00'}, {stop: '00:01'}]
+- output: sub/../same.mkv
+  editlist: [{start: '00:02'}, {stop: '00:03'}]
+"""
+    with pytest.raises(SystemExit):
+        ffmpeg_editlist.main([runner.input, 'sample/', '-o', runner.output, *TEST_OPTS])
+    assert 'also written by same.mkv' in caplog.text
+    assert not (pathlib.Path(runner.output)/'same.mkv').exists()
+    # Writing over the input
+    runner.input = """
+- input: video-10s.mkv
+  output: video-10s.mkv
+  editlist: [{start: '00:00'}, {stop: '00:01'}]
+"""
+    with pytest.raises(SystemExit):
+        ffmpeg_editlist.main([runner.input, 'sample/', '-o', 'sample/', *TEST_OPTS])
+    assert 'is also an input' in caplog.text
+
+def test_output_lock(runner, caplog):
+    runner.input = """
+- input: video-10s.mkv
+- output: locked.mkv
+  editlist: [{start: '00:00'}, {stop: '00:01'}]
+- output: unlocked.mkv
+  editlist: [{start: '00:02'}, {stop: '00:03'}]
+"""
+    lock = pathlib.Path(runner.output)/'.locked.mkv.lock'
+    with ffmpeg_editlist.file_lock(lock):
+        with pytest.raises(SystemExit):
+            ffmpeg_editlist.main([runner.input, 'sample/', '-o', runner.output, '--reencode', *TEST_OPTS])
+    assert 'locked.mkv: is being made by another process' in caplog.text
+    # The other output was made, and no lock files are left
+    runner.check_duration('unlocked.mkv', 1)
+    assert not (pathlib.Path(runner.output)/'locked.mkv').exists()
+    assert not list(pathlib.Path(runner.output).glob('.*.lock'))
+    ffmpeg_editlist.main([runner.input, 'sample/', '-o', runner.output, '--reencode', *TEST_OPTS])
+    runner.check_duration('locked.mkv', 1)
+
+@pytest.mark.parametrize('jobs', [1, 3])
+def test_decode_once(runner, commands, jobs):
+    runner.input = """
+- input: video-10s.mkv
+- output: once1.mkv
+  editlist:
+    - start: 00:00
+    - stop: 00:02
+    - start: 00:05
+    - stop: 00:06
+- output: once2.mkv
+  editlist:
+    - start: 00:03
+    - cover: {begin: '00:03', end: '00:04'}
+    - stop: 00:05
+- output: once3.mkv
+  editlist:
+    - input: sample/logo-840x1080.png
+      duration: 1
+"""
+    ffmpeg_editlist.main([runner.input, 'sample/', '-o', runner.output, '--reencode', '--decode-once',
+                          f'--jobs={jobs}', *TEST_OPTS])
+    segment_cmds = [cmd for cmd in commands if cmd[0] == 'ffmpeg' and 'concat' not in cmd]
+    # One run for the three video segments, one for the image
+    assert len(segment_cmds) == 2
+    assert segment_cmds[0].count('-i') == 1 and segment_cmds[0].count('-ss') == 3
+    runner.check_duration('once1.mkv', 3)
+    runner.check_duration('once2.mkv', 2)
+    runner.check_duration('once3.mkv', 1)
+
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_shared_segments(runner, commands, jobs):
+    runner.input = """
+- input: video-10s.mkv
+- output: shared1.mkv
+  editlist:
+    - input: sample/logo-840x1080.png
+      duration: 1
+    - input: video-10s.mkv
+    - start: 00:00
+    - stop: 00:02
+- output: shared2.mkv
+  editlist:
+    - input: sample/logo-840x1080.png
+      duration: 1
+    - input: video-10s.mkv
+    - start: 00:03
+    - stop: 00:04
+    - input: ./sample/../sample/logo-840x1080.png
+      duration: 1
+"""
+    ffmpeg_editlist.main([runner.input, 'sample/', '-o', runner.output, '--reencode', f'--jobs={jobs}', *TEST_OPTS])
+    segment_cmds = [cmd for cmd in commands if cmd[0] == 'ffmpeg' and 'concat' not in cmd]
+    # The logo is encoded once for all three places, whatever its path
+    assert len(segment_cmds) == 3
+    runner.check_duration('shared1.mkv', 3)
+    runner.check_duration('shared2.mkv', 3)
+
+def test_normalize(runner, caplog):
+    editlist = """
+- output: mixed.mkv
+  {reencode}
+  editlist:
+    - input: video-10s.mkv
+    - start: 00:00
+    - stop: 00:08
+    - input: count10.mkv
+    - start: 00:00
+    - stop: 00:02
+    - input: sample/logo-840x1080.png
+      duration: 1
+"""
+    runner.input = editlist.format(reencode='')
+    plan_file = runner.tmpdir/'plan.json'
+    ffmpeg_editlist.main([runner.input, 'sample/', '-o', runner.output, f'--plan-json={plan_file}', *TEST_OPTS])
+    video, count, logo = [seg['cmd'] for seg in json.load(open(plan_file))['outputs'][0]['segments']]
+    # The main input is copied, the others are made to match it
+    assert '-vcodec' in video
+    assert count[count.index('-profile:v')+1] == 'main'
+    assert count[count.index('-ar')+1] == '48000'
+    assert 'anullsrc=r=48000:cl=mono' in logo
+    runner.check_duration('mixed.mkv', 11)
+    audio = [s for s in video_info(runner.get_output('mixed.mkv'))['streams'] if s['codec_type'] == 'audio']
+    assert audio[0]['sample_rate'] == '48000'
+    # reencode: false is respected, with a warning
+    runner.input = editlist.format(reencode='reencode: false')
+    ffmpeg_editlist.main([runner.input, 'sample/', '-o', runner.output, '--dry-run',
+                          f'--plan-json={plan_file}', *TEST_OPTS])
+    video, count, logo = [seg['cmd'] for seg in json.load(open(plan_file))['outputs'][0]['segments']]
+    assert '-profile:v' not in count and 'anullsrc' not in ' '.join(logo)
+    assert "2 segments don't match" in caplog.text
+
+@pytest.mark.parametrize('mode', ['--reencode', '--single-pass'])
+def test_layout(runner, mode):
+    yaml = """
+- input: video-10s.mkv
+- output: layout.mkv
+  layout:
+    screen: {w: 840, h: 600, x: 0, y: 0}
+    camera: {w: 200, h: 150, x: 0, y: 900}
+    position: "320:450"
+  editlist:
+    - start: 00:01
+    - cover: {begin: "00:01", end: "00:02", w: 100, h: 100}
+    - stop: 00:03
+    - start: 00:05
+    - stop: 00:07
+"""
+    if mode == '--single-pass':
+        # Images are scaled to the screen's size
+        yaml += """\
+    - input: sample/logo-840x1080.png
+      duration: 1
+"""
+    runner.input = yaml
+    ffmpeg_editlist.main([runner.input, 'sample/', '-o', runner.output, mode, *TEST_OPTS])
+    runner.check_duration('layout.mkv', 5 if mode == '--single-pass' else 4)
+    video = video_info(runner.get_output('layout.mkv'))['streams'][0]
+    assert (video['width'], video['height']) == (840, 600)
+    # The cover is drawn before the screen is cropped out
+    assert luma(runner.get_output('layout.mkv'), 0.5, crop='100:100:0:0') < 50
+    assert luma(runner.get_output('layout.mkv'), 2.5, crop='100:100:0:0') > 200
+    # and the (blank) camera covers the text at its position
+    assert luma('sample/video-10s.mkv', 5.5, crop='200:150:320:450') < 225
+    assert luma(runner.get_output('layout.mkv'), 2.5, crop='200:150:320:450') > 230
+
+def test_calibrate(runner, monkeypatch, capsys):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(runner.tmpdir/'cache'))
+    yaml = """
+- input: video-10s.mkv
+  output: calibrated.mkv
+  editlist:
+    - start: 00:02
+    - stop: 00:06
+"""
+    runner.input = yaml
+    ffmpeg_editlist.main([runner.input, 'sample/', '-o', runner.output, '--calibrate', '--calibrate-seconds=1', '--realtime=1000', *TEST_OPTS])
+    assert '--encoder=' in capsys.readouterr().out
+    results = json.load(open(runner.tmpdir/'cache'/'ffmpeg-editlist'/'calibration.json'))
+    assert {'x264', 'ultrafast'} <= {x for r in results for x in (r['encoder'], r['preset'])}
+    assert all(0 < r['ssim'] <= 1 for r in results)
+    # --realtime picks a profile from the calibration
+    plan_file = runner.tmpdir/'plan.json'
+    ffmpeg_editlist.main([runner.input, 'sample/', '-o', runner.output, '--reencode', '--realtime=1000',
+                          f'--plan-json={plan_file}', *TEST_OPTS])
+    best = ffmpeg_editlist.choose_profile(results, 1000)
+    cmd = json.load(open(plan_file))['outputs'][0]['segments'][0]['cmd']
+    assert cmd[cmd.index('-c:v')+1] == ffmpeg_editlist.ENCODERS[best['encoder']]['codec']
+    runner.check_duration('calibrated.mkv', 4)
+
+def test_benchmark(tmpdir):
+    import benchmark_ffmpeg_editlist
+    results_file = tmpdir/'results.json'
+    benchmark_ffmpeg_editlist.main(['--scale=tiny', f'--workdir={tmpdir}', f'--output={results_file}',
+                                    '--', '--no-mkv-props', *TEST_OPTS])
+    results = json.load(open(results_file))
+    assert set(results['results']) == {'plan', 'copy', 'reencode'}
+    assert results['results']['reencode']['stages']['segment:encode'] > 0
+    assert len(list(pathlib.Path(tmpdir/'out-copy').glob('*.mkv'))) == 2
+    assert len(list(pathlib.Path(tmpdir/'out-copy').glob('*.srt'))) == 2
+
+def test_time_errors(runner, caplog):
+    yaml = """
+- input: video-10s.mkv
+  output: badtimes.mkv
+  editlist:
+    - start: 00:01
+    - 00:02: Good
+    - 00:05: Too late
+    - stop: 00:04
+    - start: 00:06
+    - 00:05: Too early
+    - cover: {begin: "00:09", end: "00:10"}
+    - cover: {begin: "00:07", end: "00:09"}
+    - stop: 00:08
+"""
+    runner.input = yaml
+    with pytest.raises(SystemExit):
+        ffmpeg_editlist.main([runner.input, 'sample/', '-o', runner.output, '--check'])
+    # All of the bad times are reported, not only the first
+    errors = [r.getMessage() for r in caplog.records if r.levelname == 'ERROR']
+    assert len(errors) == 4
+    assert "'Too late' at 00:05" in errors[0]
+    assert "'Too early' at 00:05" in errors[1]
+    assert 'cover at 00:09' in errors[2]
+    assert 'cover end at 00:09' in errors[3]
+
+def test_serve(runner, capsys, commands):
+    spool = runner.tmpdir/'spool'
+    for name, stop in [('job1.mkv', '00:03'), ('job2.mkv', '00:02')]:
+        editlist = runner.tmpdir/(name+'.yaml')
+        editlist.write_text(f"""
+- input: video-10s.mkv
+  output: {name}
+  editlist:
+    - start: 00:00
+    - stop: {stop}
+""")
+        ffmpeg_editlist.main([str(editlist), 'sample/', '-o', runner.output, '--reencode', f'--submit={spool}', *TEST_OPTS])
+    ffmpeg_editlist.main([str(runner.tmpdir/'missing.yaml'), 'sample/', '-o', runner.output, f'--submit={spool}'])
+    job_ids = capsys.readouterr().out.split()
+    assert len(job_ids) == 3
+    ffmpeg_editlist.serve(spool, workers=2, poll=0.1, until_idle=True)
+    spool_ = ffmpeg_editlist.Spool(spool)
+    assert [spool_.state(job_id)['state'] for job_id in job_ids] == ['done', 'done', 'failed']
+    runner.check_duration('job1.mkv', 3)
+    runner.check_duration('job2.mkv', 2)
+    ffmpeg_editlist.main(['--status', str(spool)])
+    status = capsys.readouterr().out
+    assert status.count('done') == 2 and 'failed' in status
+    # A job that was running when the service stopped is run again
+    spool_.set_state(job_ids[0], state='running')
+    ffmpeg_editlist.serve(spool, workers=2, poll=0.1, until_idle=True)
+    assert spool_.state(job_ids[0])['state'] == 'done'
+    # and continues an output it was in the middle of
+    editlist = runner.tmpdir/'job3.yaml'
+    editlist.write_text("""
+- input: video-10s.mkv
+  output: job3.mkv
+  editlist:
+    - start: 00:00
+    - stop: 00:02
+    - start: 00:04
+    - stop: 00:07
+""")
+    ffmpeg_editlist.main([str(editlist), 'sample/', '-o', runner.output, '--reencode', f'--submit={spool}', *TEST_OPTS])
+    job_id = capsys.readouterr().out.strip()
+    spool_.accept()
+    spool_.set_state(job_id, state='running')
+    job = spool_.job(job_id)
+    commands.interrupt = 'tmpout-03.mkv'
+    with pytest.raises(KeyboardInterrupt):
+        ffmpeg_editlist.run(ffmpeg_editlist.job_args(job), base_dir=job['cwd'])
+    commands.interrupt = None
+    commands.clear()
+    ffmpeg_editlist.serve(spool, workers=2, poll=0.1, until_idle=True)
+    assert spool_.state(job_id)['state'] == 'done'
+    assert [pathlib.Path(cmd[-1]).name for cmd in commands if 'tmpout' in str(cmd[-1])] == ['tmpout-03.mkv']
+    runner.check_duration('job3.mkv', 5)
+
+def test_serve_relative_paths(runner, monkeypatch, capsys):
+    # Paths in the editlist are relative to where the job was submitted
+    submitter = runner.tmpdir/'submitter'
+    (submitter/'clips').mkdir(parents=True)
+    (submitter/'clips'/'clip.mkv').symlink_to(pathlib.Path('sample/video-10s.mkv').resolve())
+    (submitter/'job.yaml').write_text("""
+- output: relative.mkv
+  editlist:
+    - input: clips/clip.mkv
+    - start: 00:00
+    - stop: 00:02
+""")
+    spool = runner.tmpdir/'spool'
+    sample = pathlib.Path('sample').resolve()
+    with monkeypatch.context() as m:
+        m.chdir(submitter)
+        ffmpeg_editlist.main(['job.yaml', str(sample), '-o', 'out', '--jobs=3', f'--submit={spool}'])
+    job_id = capsys.readouterr().out.strip()
+    ffmpeg_editlist.serve(spool, workers=1, poll=0.1, until_idle=True)
+    assert ffmpeg_editlist.Spool(spool).state(job_id)['state'] == 'done'
+    args = ffmpeg_editlist.job_args(ffmpeg_editlist.Spool(spool).job(job_id))
+    assert args.jobs == 3 and args.no_stdin
+    assert (submitter/'out'/'relative.mkv').exists()
+
+def test_resume(runner, commands):
+    yaml = """
+- input: video-10s.mkv
+  output: resumed.mkv
+  editlist:
+    - start: 00:00
+    - stop: 00:02
+    - start: 00:04
+    - stop: 00:07
+"""
+    runner.input = yaml
+    args = [runner.input, 'sample/', '-o', runner.output, '--reencode', '--resume', *TEST_OPTS]
+    commands.interrupt = 'tmpout-03.mkv'
+    with pytest.raises(KeyboardInterrupt):
+        ffmpeg_editlist.main(args)
+    workdir = pathlib.Path(runner.output)/'tmp'/'resumed.mkv.work'
+    assert (workdir/'tmpout-01.mkv.done').exists()
+    # The second run only encodes the missing segment
+    commands.interrupt = None
+    commands.clear()
+    ffmpeg_editlist.main(args)
+    assert [pathlib.Path(cmd[-1]).name for cmd in commands if 'tmpout' in str(cmd[-1])] == ['tmpout-03.mkv']
+    runner.check_duration('resumed.mkv', 5)
+    assert not workdir.exists()
+
+def test_chunks(runner, monkeypatch):
+    monkeypatch.setenv('XDG_CACHE_HOME', str(runner.tmpdir/'cache'))
+    yaml = """
+- input: video-10s.mkv
+  output: chunked.mkv
+  editlist:
+    - start: 00:01
+    - cover: {begin: "00:05", end: "00:06"}
+    - stop: 00:09
+"""
+    runner.input = yaml
+    plan_file = runner.tmpdir/'plan.json'
+    ffmpeg_editlist.main([runner.input, 'sample/', '-o', runner.output, '--reencode', '--chunk-seconds=3',
+                          '--jobs=3', f'--plan-json={plan_file}', *TEST_OPTS])
+    runner.check_duration('chunked.mkv', 8)
+    chunks = json.load(open(plan_file))['outputs'][0]['segments'][0]['chunks']
+    assert [c['type'] for c in chunks] == ['video-chunk']*3 + ['audio']
+    # The cover (4-5 s in the output) is in the second chunk, in the right place
+    output = runner.get_output('chunked.mkv')
+    assert luma(output, 4.5) < 20
+    assert luma(output, 3.5) > 100 and luma(output, 5.5) > 100
+
+def test_process(runner):
+    editlist = [{'input': 'video-10s.mkv', 'output': 'api.mkv', 'title': 'API',
+                 'editlist': [{'start': '00:01'}, {'00:02': 'Chapter'}, {'stop': '00:04'}]}]
+    plan = ffmpeg_editlist.process(editlist, 'sample/', runner.output, reencode=True, crf=51, preset='veryfast')
+    assert plan.outputs[0].toc == [(1, 'Chapter')]
+    runner.check_duration('api.mkv', 3)
+    # Options are per call, nothing accumulates between calls
+    plan = ffmpeg_editlist.process(editlist, 'sample/', runner.output, reencode=True, crf=40, dry_run=True)
+    cmd = plan.outputs[0].segments[0].cmd
+    assert cmd.count('-crf') == 1 and cmd[cmd.index('-crf')+1] == '40'
+    with pytest.raises(ffmpeg_editlist.EditlistError):
+        ffmpeg_editlist.process(editlist, 'nonexistent/', runner.output)
+    with pytest.raises(TypeError):
+        ffmpeg_editlist.process(editlist, 'sample/', runner.output, no_such_option=True)
+    # The caller's editlist isn't changed, and profiling and progress work
+    editlist[0]['editlist'] = [{'begin': '00:01'}, {'end': '00:03'}]
+    trace_file = runner.tmpdir/'trace.json'
+    progress_file = runner.tmpdir/'progress.jsonl'
+    ffmpeg_editlist.process(editlist, 'sample/', runner.output, reencode=True, rebuild=True, crf=51,
+                            trace=trace_file, progress_json=progress_file)
+    assert editlist[0]['editlist'] == [{'begin': '00:01'}, {'end': '00:03'}]
+    assert json.load(open(trace_file))['traceEvents']
+    assert json.loads(open(progress_file).readlines()[-1])['fraction'] == 1
+    # Importing doesn't configure the program's logging
+    subprocess.check_call([sys.executable, '-c', 'import logging, ffmpeg_editlist; '
+                           'assert not logging.getLogger().handlers'])
+
+def test_process_async(runner):
+    import asyncio
+    def editlist(name, stop):
+        return [{'input': 'video-10s.mkv', 'output': name,
+                 'editlist': [{'start': '00:00'}, {'stop': stop}]}]
+    async def both():
+        return await asyncio.gather(
+            ffmpeg_editlist.process_async(editlist('async1.mkv', '00:02'), 'sample/', runner.output,
+                                          reencode=True, jobs=2, crf=51, preset='veryfast'),
+            ffmpeg_editlist.process_async(editlist('async2.mkv', '00:03'), 'sample/', runner.output,
+                                          reencode=True, jobs=2, crf=51, preset='veryfast'))
+    asyncio.run(both())
+    runner.check_duration('async1.mkv', 2)
+    runner.check_duration('async2.mkv', 3)
+    # Profiling and progress
+    trace_file = runner.tmpdir/'trace.json'
+    progress_file = runner.tmpdir/'progress.jsonl'
+    asyncio.run(ffmpeg_editlist.process_async(editlist('async3.mkv', '00:02'), 'sample/', runner.output,
+                                              reencode=True, crf=51, trace=trace_file,
+                                              progress_json=progress_file))
+    assert 'command' in {event['cat'] for event in json.load(open(trace_file))['traceEvents']}
+    reports = [json.loads(line) for line in open(progress_file)]
+    assert reports[-1]['fraction'] == 1
+    assert all(0 <= r['out_time'] <= r['duration'] for r in reports)
+    # Cancelling stops the encoding and leaves no output
+    async def cancelled():
+        task = asyncio.ensure_future(ffmpeg_editlist.process_async(
+            editlist('cancelled.mkv', '00:10'), 'sample/', runner.output, reencode=True, preset='veryslow', crf=0))
+        await asyncio.sleep(1)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+    asyncio.run(cancelled())
+    assert not list(pathlib.Path(runner.output).rglob('cancelled*'))